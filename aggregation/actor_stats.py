@@ -0,0 +1,212 @@
+from argparse import ArgumentParser
+from typing import Iterable, Optional
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from aggregation.pagination import keyset_filter
+from database_connection import actor_stats_coll, movies_coll
+from importer.mapping import split_cast
+
+"""
+The module answers the questions about actors from the cast_list field of the movies.
+
+cast_list is the cast already split into a list of names (see importer.mapping.split_cast),
+so the queries don't need $split/$trim on every document, and the multikey index
+on cast_list finds the movies of an actor without scanning the collection.
+
+The top actors are read from the *actor_stats* collection ({_id: actor, movie_count, movies}),
+updated incrementally by the importer and the model save methods as *director_stats*,
+instead of an $unwind/$group of all the movies at every call.
+
+Movies imported before cast_list existed are updated, and actor_stats is rebuilt or verified, with:
+    python -m aggregation.actor_stats backfill
+    python -m aggregation.actor_stats rebuild
+    python -m aggregation.actor_stats verify
+"""
+
+# only the actors with movies are listed (partial index of actor_stats)
+WITH_MOVIES = {'movie_count': {'$gt': 0}}
+
+
+def create_cast_indexes():
+    """
+    Creates the multikey index of the actor queries and the index of the top actors.
+    """
+    movies_coll.create_index([('cast_list', 1), ('title', 1)])
+    actor_stats_coll.create_index([('movie_count', DESCENDING), ('_id', ASCENDING)],
+                                  partialFilterExpression=WITH_MOVIES)
+
+
+def _actor_counts_pipeline() -> list:
+    # full computation of the movies of every actor from the movies collection
+    return [
+        {'$match': {'cast_list.0': {'$exists': True}}},  # movies with at least one actor
+        {'$project': {'_id': 0, 'title': 1, 'cast_list': 1}},
+        {'$unwind': '$cast_list'},
+        {
+            '$group': {
+                '_id': '$cast_list',
+                'movies': {'$addToSet': '$title'},
+                'movie_count': {'$sum': 1}
+            }
+        }
+    ]
+
+
+def top_actors_pipeline(number: int, after: Optional[tuple] = None) -> list:
+    """
+    Pipeline of the `number` actors with the most movies, computed from the movies (full scan):
+    used to rebuild and verify actor_stats, the queries read actor_stats (see top_actors_query).
+    after: (movie_count, actor) of the last actor of the previous page
+    """
+    pipeline = _actor_counts_pipeline() + [{'$sort': {'movie_count': -1, '_id': 1}}]
+    if after:
+        pipeline.append({'$match': keyset_filter('movie_count', *after)})
+    pipeline.append({'$limit': number})
+    return pipeline
+
+
+def top_actors_query(after: Optional[tuple] = None) -> dict:
+    """
+    Filter of the top actors in actor_stats (shared with the async queries), sorted by TOP_ACTORS_SORT.
+    after: (movie_count, actor) of the last actor of the previous page
+    """
+    return {**WITH_MOVIES, **keyset_filter('movie_count', *after)} if after else WITH_MOVIES
+
+
+TOP_ACTORS_SORT = [('movie_count', DESCENDING), ('_id', ASCENDING)]
+
+
+def top_actors(number: int, after: Optional[tuple] = None, batch_size: Optional[int] = None):
+    """
+    Returns a cursor over the `number` actors with the most movies: {'_id': actor, 'movies': [...], 'movie_count': n}
+    """
+    cursor = actor_stats_coll.find(top_actors_query(after)).sort(TOP_ACTORS_SORT).limit(number)
+    return cursor.batch_size(batch_size) if batch_size else cursor
+
+
+def actor_stats_requests(added: Iterable[dict] = (), removed: Iterable[dict] = ()) -> list:
+    """
+    Groups the changes of a batch by actor and returns the updates of actor_stats.
+
+    added: movies written to the database
+    removed: previous versions of the movies which were updated (their contribution is subtracted)
+    A removed title is pulled from the movies of the actor (also if the actor has another movie with the same title).
+    """
+    counts, added_titles, removed_titles = {}, {}, {}
+    for sign, movies, titles in ((1, added, added_titles), (-1, removed, removed_titles)):
+        for movie in movies:
+            for actor in movie.get('cast_list') or ():
+                counts[actor] = counts.get(actor, 0) + sign
+                titles.setdefault(actor, set()).add(movie['title'])
+
+    requests = []
+    for actor, count in counts.items():
+        new_titles = added_titles.get(actor, set()) - removed_titles.get(actor, set())
+        old_titles = removed_titles.get(actor, set()) - added_titles.get(actor, set())
+        # $pull and $addToSet can't change the same array in one update
+        if old_titles:
+            requests.append(UpdateOne({'_id': actor}, {'$pull': {'movies': {'$in': sorted(old_titles)}}}))
+        update = {}
+        if count:
+            update['$inc'] = {'movie_count': count}
+        if new_titles:
+            update['$addToSet'] = {'movies': {'$each': sorted(new_titles)}}
+        if update:
+            requests.append(UpdateOne({'_id': actor}, update, upsert=True))
+    return requests
+
+
+def update_actor_stats(added: Iterable[dict] = (), removed: Iterable[dict] = ()):
+    """
+    Applies the changes of some movies to the *actor_stats* collection.
+    """
+    requests = actor_stats_requests(added, removed)
+    if requests:
+        actor_stats_coll.bulk_write(requests, ordered=False)
+
+
+def rebuild_actor_stats():
+    """
+    Recomputes the whole *actor_stats* collection from the movies collection.
+    """
+    movies_coll.aggregate(_actor_counts_pipeline() + [{'$out': actor_stats_coll.name}])
+    create_cast_indexes()
+    print(f"The '{actor_stats_coll.name}' collection has been rebuilt: {actor_stats_coll.count_documents({})} actors.")
+
+
+def verify_actor_stats() -> int:
+    """
+    Compares the stored counts with a full computation and prints the differences.
+    Returns the number of actors whose count is wrong.
+    """
+    expected = {actor['_id']: actor['movie_count'] for actor in movies_coll.aggregate(_actor_counts_pipeline())}
+    stored = {actor['_id']: actor['movie_count'] for actor in actor_stats_coll.find(WITH_MOVIES, {'movie_count': 1})}
+
+    wrong = 0
+    for actor in expected.keys() | stored.keys():
+        if expected.get(actor, 0) != stored.get(actor, 0):
+            print(f"{actor}: movie_count is {stored.get(actor)}, expected {expected.get(actor)}")
+            wrong += 1
+
+    if wrong:
+        print(f"{wrong} actors have wrong counts, run the rebuild command.")
+    else:
+        print(f"The counts of the {len(expected)} actors are consistent.")
+    return wrong
+
+
+def movies_for_actor(actor: str) -> list:
+    """
+    Returns the movies of an actor (title and year), found with the cast_list index.
+    """
+    return list(movies_coll.find({'cast_list': actor}, {'_id': 0, 'title': 1, 'year': 1}).sort('title', 1))
+
+
+def co_stars(actor: str, number: Optional[int] = None) -> list:
+    """
+    Returns the actors who played with `actor`, with the number of movies they made together.
+    """
+    pipeline = [
+        {'$match': {'cast_list': actor}},  # uses the cast_list index
+        {'$project': {'_id': 0, 'cast_list': 1}},
+        {'$unwind': '$cast_list'},
+        {'$match': {'cast_list': {'$ne': actor}}},
+        {'$group': {'_id': '$cast_list', 'movie_count': {'$sum': 1}}},
+        {'$sort': {'movie_count': -1, '_id': 1}}
+    ]
+    if number:
+        pipeline.append({'$limit': number})
+    return list(movies_coll.aggregate(pipeline))
+
+
+def backfill_cast_lists(batch_size: int = 1000) -> int:
+    """
+    Adds cast_list to the movies which don't have it yet. Returns the number of updated movies.
+    """
+    updated = 0
+    requests = []
+    for movie in movies_coll.find({'cast_list': {'$exists': False}}, {'cast': 1}):
+        requests.append(UpdateOne({'_id': movie['_id']}, {'$set': {'cast_list': split_cast(movie.get('cast'))}}))
+        if len(requests) == batch_size:
+            updated += movies_coll.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += movies_coll.bulk_write(requests, ordered=False).modified_count
+
+    print(f"cast_list has been added to {updated} movies.")
+    return updated
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Maintenance of the cast_list field of the movies and of actor_stats")
+    parser.add_argument("command", choices=["backfill", "rebuild", "verify"])
+    args = parser.parse_args()
+
+    create_cast_indexes()
+    if args.command == "backfill":
+        backfill_cast_lists()
+    elif args.command == "rebuild":
+        rebuild_actor_stats()
+    else:
+        verify_actor_stats()
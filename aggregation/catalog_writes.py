@@ -0,0 +1,60 @@
+from typing import Dict, Iterable
+
+from pymongo import UpdateOne
+
+from aggregation.actor_stats import actor_stats_requests
+from aggregation.director_stats import EMPTY_STATS, stats_requests
+from aggregation.list_of_films import director_change_requests
+from aggregation.year_rollups import rollup_requests
+from database_connection import (actor_stats_coll, cinema_db, director_changes_coll, director_stats_coll,
+                                 year_director_rollups_coll, year_rollups_coll)
+
+"""
+The writes of the collections derived from the movies, in one place.
+
+Every path writing movies or directors (Movie.add_movie_by_user, Director.save_to_db, their async versions
+in models.async_queries and the importer's BatchWriter) gets its updates of the derived collections here,
+as {collection name: [UpdateOne, ...]}, and only executes them:
+    - director_stats (aggregation.director_stats)
+    - year_rollups and year_director_rollups (aggregation.year_rollups)
+    - actor_stats (aggregation.actor_stats)
+    - director_changes, the change log read by the refreshes (aggregation.list_of_films), written last
+A new derived collection is added to these functions only.
+"""
+
+
+def movie_write_requests(added: Iterable[dict] = (), removed: Iterable[dict] = ()) -> Dict[str, list]:
+    """
+    Returns the updates of the derived collections for some written movies, by collection name.
+    added: movies written to the database
+    removed: previous versions of the movies which were updated (their contribution is subtracted)
+    """
+    added, removed = list(added), list(removed)
+    year_requests, year_director_requests = rollup_requests(added, removed)
+    requests = {
+        director_stats_coll.name: stats_requests(added, removed),
+        year_rollups_coll.name: year_requests,
+        year_director_rollups_coll.name: year_director_requests,
+        actor_stats_coll.name: actor_stats_requests(added, removed),
+        director_changes_coll.name: director_change_requests(movie['director'] for movie in added + removed),
+    }
+    return {name: collection_requests for name, collection_requests in requests.items() if collection_requests}
+
+
+def director_write_requests(name: str) -> Dict[str, list]:
+    """
+    Returns the updates of the derived collections for a saved director, by collection name
+    (an empty stats document if the director doesn't have movies yet).
+    """
+    return {
+        director_stats_coll.name: [UpdateOne({'_id': name}, {'$setOnInsert': EMPTY_STATS}, upsert=True)],
+        director_changes_coll.name: director_change_requests([name]),
+    }
+
+
+def apply_write_requests(requests: Dict[str, list], database=cinema_db):
+    """
+    Executes the updates of the derived collections, one bulk_write per collection.
+    """
+    for name, collection_requests in requests.items():
+        database[name].bulk_write(collection_requests, ordered=False)
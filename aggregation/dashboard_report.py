@@ -0,0 +1,54 @@
+from typing import Iterable
+
+from instrumentation import instrumented
+from models.director import Director
+from models.movie import Movie
+from models.records import DashboardReport
+
+"""
+The module computes the statistics of the dashboard (main.py) from the pre-computed stats.
+
+No statistic reads the movies collection, each one is the first page of the top-N method of the models
+(with its query cache):
+    - the director tops: Director.top_rating, top_avg_lenght and top_number_of_movies, one indexed find each
+      on *director_stats*
+    - the top actors: Movie.top_number_of_films, one indexed find on *actor_stats*
+so the cost of the report depends on `number` and `actors`, not on the size of the catalog.
+
+    report = dashboard_report(5, actors=15, stats=('top_rating', 'top_number_of_films'))
+    report.top_rating, report.top_number_of_films
+"""
+
+# query of each statistic: the number of directors or actors -> records
+STATS = {
+    'top_rating': Director.top_rating,
+    'top_avg_length': Director.top_avg_lenght,
+    'top_number_of_movies': Director.top_number_of_movies,
+    'top_number_of_films': Movie.top_number_of_films,
+}
+ALL_STATS = tuple(STATS)
+
+
+@instrumented('dashboard_report')
+def dashboard_report(number: int = 5, actors: int = 15, stats: Iterable[str] = ALL_STATS) -> DashboardReport:
+    """
+    Returns the asked statistics of the dashboard, read from director_stats and actor_stats
+    (each top is cached by its model method until the next write).
+    number: number of directors of each top, actors: number of actors
+    """
+    stats = set(stats)
+    unknown = stats - set(ALL_STATS)
+    if unknown:
+        raise ValueError(f"Unknown statistics: {', '.join(sorted(unknown))} (expected: {', '.join(ALL_STATS)})")
+
+    def top(name: str, size: int):
+        if name not in stats:
+            return None
+        return list(STATS[name](size)) if size > 0 else []  # limit(0) would return all of them
+
+    return DashboardReport(
+        top_rating=top('top_rating', number),
+        top_avg_length=top('top_avg_length', number),
+        top_number_of_movies=top('top_number_of_movies', number),
+        top_number_of_films=top('top_number_of_films', actors)
+    )
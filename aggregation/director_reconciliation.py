@@ -0,0 +1,114 @@
+from argparse import ArgumentParser
+from typing import Dict, Iterable, Optional, Set
+
+from pymongo import UpdateOne
+
+from database_connection import cinema_db, director_changes_coll, directors_coll, metadata_coll, movies_coll
+from importer.mapping import director_key
+
+"""
+The module reconciles the *directors* collection with the movies collection in one grouped pass.
+
+Instead of one $addToSet upsert per director and per batch during the import (load_data.py --defer-directors),
+the movies are grouped by director once and merged into *directors* with $merge:
+the titles are added to the movies of the director with $setUnion, so the movies saved
+with Director.save_to_db which aren't in the movies collection are kept.
+
+The first run reads all the movies; the next ones only the directors logged in *director_changes*
+since the previous run:
+    python -m aggregation.director_reconciliation
+    python -m aggregation.director_reconciliation --full
+
+The live refresh (aggregation.live_refresh) knows the changed directors from the change stream instead:
+refresh_directors pulls the titles they lost (known from the pre-images of the changes), then merges
+their titles in the movies collection as above, so the titles saved with Director.save_to_db are kept.
+"""
+
+STATE_ID = 'reconcile:directors'
+
+
+def reconciliation_pipeline(match: dict) -> list:
+    """
+    Pipeline merging the titles of the matched movies into the documents of their directors.
+    """
+    return [
+        {'$match': match},
+        {'$group': {'_id': '$director', 'movies': {'$addToSet': '$title'}}},
+        {'$project': {'_id': 0, 'name': '$_id', 'movies': 1}},
+        {
+            '$merge': {
+                'into': directors_coll.name,
+                'on': 'name',  # unique index of the directors collection
+                'whenMatched': [{'$set': {'movies': {'$setUnion': [{'$ifNull': ['$movies', []]}, '$$new.movies']}}}],
+                'whenNotMatched': 'insert'
+            }
+        }
+    ]
+
+
+def reconcile_directors(director_names: Optional[Iterable[str]] = None, full: bool = False):
+    """
+    Adds the movies of the movies collection to their directors (all directors if director_names is None).
+    full=False: only the directors changed since the previous reconciliation, after the first one
+    """
+    state = None if full else metadata_coll.find_one({'_id': STATE_ID})
+
+    # server time, as the change log is written with $currentDate
+    started_at = cinema_db.client.admin.command('hello')['localTime']
+
+    keys = {director_key(name) for name in director_names} if director_names is not None else None
+    if state is not None:
+        touched = set(director_changes_coll.distinct('_id', {'updated_at': {'$gte': state['reconciled_at']}}))
+        keys = touched & keys if keys is not None else touched
+        if not keys:
+            print("No director has changed since the last reconciliation.")
+            return
+
+    match = {'director_key': {'$in': sorted(keys)}} if keys is not None else {}
+    movies_coll.aggregate(reconciliation_pipeline(match))
+
+    # only a reconciliation of all the (changed) directors is a starting point for the next incremental runs
+    if director_names is None:
+        metadata_coll.update_one({'_id': STATE_ID}, {'$set': {'reconciled_at': started_at}}, upsert=True)
+    print(f"The directors collection has been reconciled: "
+          f"{len(keys) if keys is not None else 'all'} directors, {directors_coll.count_documents({})} in total.")
+
+
+def lost_title_requests(changed: Dict[str, Set[str]]) -> list:
+    """
+    Returns the updates pulling the lost titles from their directors: {director: titles}.
+    """
+    return [UpdateOne({'name': name}, {'$pull': {'movies': {'$in': sorted(titles)}}})
+            for name, titles in changed.items() if titles]
+
+
+def refresh_directors(changed: Optional[Dict[str, Set[str]]]):
+    """
+    Refreshes the movies of the changed directors, without reading the change log.
+    changed: {director: titles the director lost (from the pre-images of the changes)}, None for all the directors
+
+    The lost titles are pulled first (a director without movies left has no group to merge, so only the pull
+    removes them), then the titles of the movies collection are merged with $setUnion: a pulled title which
+    is still a movie of the director comes back, the titles saved with Director.save_to_db are kept.
+    With None (the changes aren't known), all the movies are merged and nothing is removed.
+    """
+    if changed is None:
+        reconcile_directors(full=True)
+        return
+    if not changed:
+        return
+
+    requests = lost_title_requests(changed)
+    if requests:
+        directors_coll.bulk_write(requests, ordered=False)
+    keys = sorted({director_key(name) for name in changed})
+    movies_coll.aggregate(reconciliation_pipeline({'director_key': {'$in': keys}}))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Reconciliation of the directors collection with the movies")
+    parser.add_argument("directors", nargs="*", help="directors to reconcile (the changed ones by default)")
+    parser.add_argument("--full", action="store_true", help="read all the movies instead of the changed directors")
+    args = parser.parse_args()
+
+    reconcile_directors(args.directors or None, full=args.full)
@@ -0,0 +1,178 @@
+from argparse import ArgumentParser
+from typing import Iterable
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from database_connection import director_stats_coll, movies_coll
+
+"""
+The module maintains the *director_stats* collection: one document per director with
+    - movie_count
+    - rating_sum / rating_count and avg_rating
+    - runtime_sum / runtime_count and avg_runtime
+
+The importer and the model save methods update it incrementally, so the top-N queries of Director
+read a few documents of an indexed collection instead of grouping the whole movies collection.
+
+Rebuild or verify it from scratch with:
+    python -m aggregation.director_stats rebuild
+    python -m aggregation.director_stats verify
+"""
+
+COUNTERS = ('movie_count', 'rating_sum', 'rating_count', 'runtime_sum', 'runtime_count')
+
+# stats of a director without movies
+EMPTY_STATS = {**dict.fromkeys(COUNTERS, 0), 'avg_rating': None, 'avg_runtime': None}
+
+# only the directors with movies are listed in the top-N queries (partial indexes of director_stats)
+WITH_MOVIES = {'movie_count': {'$gt': 0}}
+
+
+def create_stats_indexes():
+    """
+    Creates the indexes of the top-N queries. Directors without movies are left out of them.
+    """
+    director_stats_coll.create_index([('avg_rating', DESCENDING), ('_id', ASCENDING)],
+                                     partialFilterExpression=WITH_MOVIES)
+    director_stats_coll.create_index([('avg_runtime', DESCENDING), ('_id', ASCENDING)],
+                                     partialFilterExpression=WITH_MOVIES)
+    director_stats_coll.create_index([('movie_count', DESCENDING), ('_id', ASCENDING)],
+                                     partialFilterExpression=WITH_MOVIES)
+
+
+def _is_number(value) -> bool:
+    # same rule as $avg: only numbers are counted, booleans and missing values are ignored
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def movie_delta(movie: dict, sign: int = 1) -> dict:
+    """
+    Returns what a movie adds (sign=1) or removes (sign=-1) from the stats of its director.
+    """
+    rating, runtime = movie.get('rating'), movie.get('runtime')
+    return {
+        'movie_count': sign,
+        'rating_sum': sign * rating if _is_number(rating) else 0,
+        'rating_count': sign if _is_number(rating) else 0,
+        'runtime_sum': sign * runtime if _is_number(runtime) else 0,
+        'runtime_count': sign if _is_number(runtime) else 0,
+    }
+
+
+def stats_requests(added: Iterable[dict] = (), removed: Iterable[dict] = ()) -> list:
+    """
+    Groups the changes of a batch by director and returns one upsert per director.
+
+    added: movies written to the database
+    removed: previous versions of the movies which were updated (their contribution is subtracted)
+    """
+    deltas = {}
+    for sign, movies in ((1, added), (-1, removed)):
+        for movie in movies:
+            delta = deltas.setdefault(movie['director'], dict.fromkeys(COUNTERS, 0))
+            for counter, value in movie_delta(movie, sign).items():
+                delta[counter] += value
+
+    return [
+        UpdateOne({'_id': director}, _increment_pipeline(delta), upsert=True)
+        for director, delta in deltas.items()
+        if any(delta.values())
+    ]
+
+
+def _increment_pipeline(delta: dict) -> list:
+    """
+    Update pipeline adding the delta to the counters and recomputing the averages in the same write.
+    """
+    return [
+        {'$set': {counter: {'$add': [{'$ifNull': [f'${counter}', 0]}, value]} for counter, value in delta.items()}},
+        {'$set': {
+            'avg_rating': {'$cond': [{'$gt': ['$rating_count', 0]},
+                                     {'$divide': ['$rating_sum', '$rating_count']}, None]},
+            'avg_runtime': {'$cond': [{'$gt': ['$runtime_count', 0]},
+                                      {'$divide': ['$runtime_sum', '$runtime_count']}, None]}
+        }}
+    ]
+
+
+def update_director_stats(added: Iterable[dict] = (), removed: Iterable[dict] = ()):
+    """
+    Applies the changes of some movies to the *director_stats* collection.
+    """
+    requests = stats_requests(added, removed)
+    if requests:
+        director_stats_coll.bulk_write(requests, ordered=False)
+
+
+def register_director(name: str):
+    """
+    Creates an empty stats document for a director who doesn't have movies in the database yet.
+    """
+    director_stats_coll.update_one(
+        {'_id': name},
+        {'$setOnInsert': EMPTY_STATS},
+        upsert=True
+    )
+
+
+def _stats_pipeline() -> list:
+    # full computation of the stats from the movies collection
+    return [
+        {
+            '$group': {
+                '_id': '$director',
+                'movie_count': {'$sum': 1},
+                'rating_sum': {'$sum': '$rating'},
+                'rating_count': {'$sum': {'$cond': [{'$isNumber': '$rating'}, 1, 0]}},
+                'runtime_sum': {'$sum': '$runtime'},
+                'runtime_count': {'$sum': {'$cond': [{'$isNumber': '$runtime'}, 1, 0]}},
+                'avg_rating': {'$avg': '$rating'},
+                'avg_runtime': {'$avg': '$runtime'}
+            }
+        }
+    ]
+
+
+def rebuild_director_stats():
+    """
+    Recomputes the whole *director_stats* collection from the movies collection.
+    """
+    movies_coll.aggregate(_stats_pipeline() + [{'$out': director_stats_coll.name}])
+    create_stats_indexes()
+    print(f"The '{director_stats_coll.name}' collection has been rebuilt: "
+          f"{director_stats_coll.count_documents({})} directors.")
+
+
+def verify_director_stats(tolerance: float = 1e-6) -> int:
+    """
+    Compares the stored stats with a full computation and prints the differences.
+    Returns the number of directors whose stats are wrong.
+    """
+    expected = {stats['_id']: stats for stats in movies_coll.aggregate(_stats_pipeline())}
+    stored = {stats['_id']: stats for stats in director_stats_coll.find(WITH_MOVIES)}
+
+    wrong = 0
+    for director in expected.keys() | stored.keys():
+        expected_stats, stored_stats = expected.get(director, {}), stored.get(director, {})
+        for counter in COUNTERS:
+            if abs((expected_stats.get(counter) or 0) - (stored_stats.get(counter) or 0)) > tolerance:
+                print(f"{director}: {counter} is {stored_stats.get(counter)}, expected {expected_stats.get(counter)}")
+                wrong += 1
+                break
+
+    if wrong:
+        print(f"{wrong} directors have wrong stats, run the rebuild command.")
+    else:
+        print(f"The stats of the {len(expected)} directors are consistent.")
+    return wrong
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Maintenance of the director_stats collection")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild_director_stats()
+    else:
+        verify_director_stats()
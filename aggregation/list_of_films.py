@@ -1,22 +1,78 @@
-from database_connection import movies_coll, directors_coll
+from argparse import ArgumentParser
+from typing import Iterable, Optional
+
+from pymongo import UpdateOne
+
+from database_connection import cinema_db, director_changes_coll, directors_coll, metadata_coll, movies_coll
+from importer.mapping import director_key
+from instrumentation import instrumented
 
 """
 The module contains 2 functions letting looking for a list of movies of:
 1. many directors: first function
 2. one director: second function
+
+The directors are found with exact lookups on the director_key index (normalized name).
+Movies imported before director_key existed are updated with:
+    python -m aggregation.list_of_films backfill
+
+The importer and the model save methods log the directors they change in the *director_changes* collection,
+so refresh_directors_movies only recomputes these directors with $merge instead of rewriting the whole output:
+    python -m aggregation.list_of_films refresh --output directors_with_movies
 """
 
+
+def create_director_key_index():
+    """
+    Creates the index of the director lookups and of the change log.
+    """
+    movies_coll.create_index([('director_key', 1), ('title', 1)])
+    director_changes_coll.create_index('updated_at')
+
+
+def director_change_requests(director_names: Iterable[str]) -> list:
+    """
+    Returns the upserts logging that the movies of these directors changed (server time in updated_at).
+    """
+    return [
+        UpdateOne({'_id': director_key(name)}, {'$set': {'name': name}, '$currentDate': {'updated_at': True}},
+                  upsert=True)
+        for name in set(director_names)
+    ]
+
+
+def log_director_changes(director_names: Iterable[str]):
+    """
+    Logs the directors whose movies changed in the *director_changes* collection.
+    """
+    requests = director_change_requests(director_names)
+    if requests:
+        director_changes_coll.bulk_write(requests, ordered=False)
+
+
+def directors_match(director_names, fuzzy: bool = False) -> dict:
+    """
+    Returns the $match condition selecting the movies of the given directors.
+
+    fuzzy=False: exact, case-insensitive names, answered by the director_key index
+    fuzzy=True: the old behaviour, a case-insensitive regex per name which also matches
+                parts of names ("Nolan" matches "Jonathan Nolan") and scans the whole collection
+    """
+    if fuzzy:
+        return {'$or': [{'director': {'$regex': name, '$options': 'i'}} for name in director_names]}
+    return {'director_key': {'$in': sorted({director_key(name) for name in director_names})}}
+
+
 # Enregistrer dans une nouvelle collection (ou vue, comme vous voulez) la liste des réalisateurs avec la liste de leurs films
-def save_directors_movies(director_names, output_collection:str = 'directors_with_movies'):
+@instrumented('save_directors_movies')
+def save_directors_movies(director_names, output_collection:str = 'directors_with_movies', fuzzy: bool = False):
     """
     Aggregates movies by the given list of directors and saves the result to a new collection.
     """
 
     # in order that the search is not case-sensitive
-    regex_conditions = [{'director': {'$regex': name, '$options': 'i'}} for name in director_names]
-
     pipeline = [
-        {'$match': {'$or': regex_conditions}},
+        {'$match': directors_match(director_names, fuzzy)},
         {
             '$group': {
                 '_id': '$director',
@@ -40,3 +96,89 @@ def save_directors_movies(director_names, output_collection:str = 'directors_wit
 
     print(f"The list of directors and movies was added to '{output_collection}' collection.")
 
+
+@instrumented('refresh_directors_movies')
+def refresh_directors_movies(director_names: Optional[Iterable[str]] = None,
+                             output_collection: str = 'directors_with_movies'):
+    """
+    Refreshes the list of directors with their movies in `output_collection` (all directors if director_names is None).
+
+    The first call builds the whole collection. The next ones recompute, with $merge, only the directors
+    logged in *director_changes* since the previous refresh, so their cost depends on the changes, not on the catalog.
+    The directors the collection is built for are saved with the refresh time: a call for other directors
+    (or for all of them after a subset) builds the collection again.
+    The output documents are keyed by the director name: {_id, name, director_key, movies, refreshed_at}.
+    """
+    state_id = f'refresh:{output_collection}'
+    state = metadata_coll.find_one({'_id': state_id})
+
+    # server time, as the change log is written with $currentDate
+    started_at = cinema_db.client.admin.command('hello')['localTime']
+
+    keys = {director_key(name) for name in director_names} if director_names is not None else None
+    built_for = sorted(keys) if keys is not None else 'all'
+    if state is None or state.get('director_keys') != built_for:
+        cinema_db.drop_collection(output_collection)
+        cinema_db[output_collection].create_index('director_key')
+    else:
+        touched = set(director_changes_coll.distinct('_id', {'updated_at': {'$gte': state['refreshed_at']}}))
+        keys = touched & keys if keys is not None else touched
+        if not keys:
+            metadata_coll.update_one({'_id': state_id}, {'$set': {'refreshed_at': started_at}})
+            print(f"No director of '{output_collection}' has changed since the last refresh.")
+            return
+
+    match = {'director_key': {'$in': sorted(keys)}} if keys is not None else {}
+    pipeline = [
+        {'$match': match},
+        {
+            '$group': {
+                '_id': '$director',
+                'director_key': {'$first': '$director_key'},
+                'movies': {'$addToSet': '$title'}
+            }
+        },
+        {'$set': {'name': '$_id', 'refreshed_at': {'$literal': started_at}}},
+        {'$merge': {'into': output_collection, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+    ]
+    movies_coll.aggregate(pipeline)
+
+    # the directors which don't have movies anymore weren't refreshed by $merge
+    removed = cinema_db[output_collection].delete_many({**match, 'refreshed_at': {'$lt': started_at}}).deleted_count
+
+    metadata_coll.update_one({'_id': state_id}, {'$set': {'refreshed_at': started_at, 'director_keys': built_for}},
+                             upsert=True)
+    print(f"'{output_collection}' has been refreshed: "
+          f"{len(keys) if keys is not None else 'all'} directors recomputed, {removed} removed.")
+
+
+def backfill_director_keys(batch_size: int = 1000) -> int:
+    """
+    Adds director_key to the movies which don't have it yet. Returns the number of updated movies.
+    """
+    updated = 0
+    requests = []
+    for movie in movies_coll.find({'director_key': {'$exists': False}}, {'director': 1}):
+        requests.append(UpdateOne({'_id': movie['_id']}, {'$set': {'director_key': director_key(movie.get('director'))}}))
+        if len(requests) == batch_size:
+            updated += movies_coll.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += movies_coll.bulk_write(requests, ordered=False).modified_count
+
+    print(f"director_key has been added to {updated} movies.")
+    return updated
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Maintenance of the director lookups and of the directors with movies collections")
+    parser.add_argument("command", choices=["backfill", "refresh"])
+    parser.add_argument("directors", nargs="*", help="directors of the refreshed collection (all by default)")
+    parser.add_argument("--output", default="directors_with_movies", help="collection refreshed by the refresh command")
+    args = parser.parse_args()
+
+    create_director_key_index()
+    if args.command == "backfill":
+        backfill_director_keys()
+    else:
+        refresh_directors_movies(args.directors or None, output_collection=args.output)
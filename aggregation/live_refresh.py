@@ -0,0 +1,205 @@
+import time
+from argparse import ArgumentParser
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from pymongo.errors import OperationFailure
+
+from aggregation.director_reconciliation import refresh_directors
+from aggregation.list_of_films import save_directors_movies
+from database_connection import cinema_db, metadata_coll, movies_coll
+from importer.mapping import director_key
+from query_cache import query_cache
+
+"""
+Long-running watcher keeping the collections derived from the movies up to date.
+
+It follows a change stream on the movies collection, groups the events into micro-batches
+(at most `batch_size` events or `max_wait` seconds) and gives the directors of the changed movies
+to every registered handler, once per batch, as a dict {director: titles it lost}:
+    - directors.movies: the lost titles are pulled and the titles of the movies are merged
+      (aggregation.director_reconciliation.refresh_directors)
+    - tarantino_nolan: the output of save_directors_movies is rebuilt when one of its directors changed
+    - query_cache: the cache of the process is emptied (when the watcher runs in the application process)
+A handler receives None instead of the directors when they aren't known (a lost resume token): it refreshes everything.
+
+The lost titles come from the previous version of the changed movies, so the watcher needs the pre-images
+of the movies collection (MongoDB 6.0+, enabled with enable_pre_images or --pre-images):
+a deleted movie or a movie moved to another director only refreshes its directors.
+
+The resume token of the stream is saved in *import_metadata* after each batch, so a restarted watcher
+continues after the last applied batch (a batch can be applied twice after a crash, the handlers are idempotent).
+
+Change streams need a replica set; a local single-node one is enough:
+    mongod --replSet rs0 --dbpath data/rs0
+    mongosh --eval "rs.initiate()"
+    MONGO_URI="mongodb://localhost:27017/?directConnection=true" python -m aggregation.live_refresh
+"""
+
+STATE_ID = 'watch:movies'
+HISTORY_LOST = 286  # ChangeStreamHistoryLost: the resume token is no longer in the oplog
+
+# handlers of the derived collections, by name: handler({director: lost titles} or None)
+handlers: Dict[str, Callable[[Optional[Dict[str, Set[str]]]], None]] = {}
+
+
+def register_handler(name: str, handler: Callable[[Optional[Dict[str, Set[str]]]], None]):
+    """
+    Registers the refresh of a derived collection, called with the directors of each batch of changes.
+    """
+    handlers[name] = handler
+
+
+def directors_collection_handler(director_names: Iterable[str], output_collection: str,
+                                 fuzzy: bool = False) -> Callable[[Optional[Dict[str, Set[str]]]], None]:
+    """
+    Returns the handler of a collection written by save_directors_movies for these directors:
+    it's rebuilt (indexed lookup of its directors only) when one of them is in the batch.
+    """
+    director_names = list(director_names)
+    keys = {director_key(name) for name in director_names}
+
+    def handler(changed: Optional[Dict[str, Set[str]]]):
+        if changed is None or fuzzy or keys & {director_key(name) for name in changed}:
+            save_directors_movies(director_names, output_collection, fuzzy)
+    return handler
+
+
+register_handler('directors.movies', refresh_directors)
+register_handler('tarantino_nolan', directors_collection_handler(["christopher nolan", "Quentin Tarantino"],
+                                                                 'tarantino_nolan'))
+register_handler('query_cache', lambda changed: query_cache.invalidate())
+
+
+def enable_pre_images():
+    """
+    Keeps the previous version of the changed movies (MongoDB 6.0+), read by the watcher.
+    """
+    cinema_db.command('collMod', movies_coll.name, changeStreamPreAndPostImages={'enabled': True})
+
+
+def pre_images_enabled() -> bool:
+    """
+    Returns True if the pre-images of the movies collection are kept.
+    """
+    collection = next(cinema_db.list_collections(filter={'name': movies_coll.name}), {})
+    return bool(collection.get('options', {}).get('changeStreamPreAndPostImages', {}).get('enabled'))
+
+
+def event_directors(event: dict) -> Dict[str, Set[str]]:
+    """
+    Returns the directors concerned by a change event (before and after the change) with the titles they lost:
+    the title of the pre-image, unless the movie kept its title and its director.
+    """
+    before, after = event.get('fullDocumentBeforeChange'), event.get('fullDocument')
+    if before is None and event['operationType'] != 'insert':
+        raise ValueError(f"The {event['operationType']} event of {event['documentKey']['_id']} has no pre-image, "
+                         f"enable them with enable_pre_images()")
+
+    directors = {}
+    if after and after.get('director'):
+        directors.setdefault(after['director'], set())
+    if before and before.get('director'):
+        lost = after is None or (after.get('director'), after.get('title')) != (before['director'], before.get('title'))
+        directors.setdefault(before['director'], set()).update((before.get('title'),) if lost else ())
+    return directors
+
+
+def batch_directors(events: list) -> Dict[str, Set[str]]:
+    """
+    Returns the directors concerned by a batch of events with the titles they lost.
+    """
+    changed = {}
+    for event in events:
+        for director, titles in event_directors(event).items():
+            changed.setdefault(director, set()).update(titles)
+    return changed
+
+
+def refresh(changed: Optional[Dict[str, Set[str]]], names: Optional[Iterable[str]] = None):
+    """
+    Gives the changed directors (None: all of them) to the handlers (all the registered ones by default).
+    """
+    names = list(names or handlers)
+    if changed is not None and not changed:
+        return
+    for name in names:
+        handlers[name](changed)
+    print(f"{', '.join(names)} refreshed for {len(changed) if changed is not None else 'all'} directors.")
+
+
+def _save_token(token):
+    metadata_coll.update_one({'_id': STATE_ID}, {'$set': {'resume_token': token}}, upsert=True)
+
+
+def watch(batch_size: int = 100, max_wait: float = 1.0, names: Optional[Iterable[str]] = None,
+          stop: Optional[Callable[[], bool]] = None):
+    """
+    Applies the changes of the movies to the derived collections until stop() returns True (forever by default).
+    batch_size, max_wait: a batch is applied when it has batch_size events or its first event is max_wait seconds old
+    The pre-images of the movies must be enabled (see enable_pre_images).
+    """
+    if not pre_images_enabled():
+        raise RuntimeError(f"The pre-images of '{movies_coll.name}' aren't enabled: run the watcher with --pre-images "
+                           f"once (MongoDB 6.0+)")
+    names = list(names) if names is not None else None
+    state = metadata_coll.find_one({'_id': STATE_ID}) or {}
+    options = {
+        'pipeline': [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}],
+        'full_document': 'updateLookup',
+        'full_document_before_change': 'required',
+        'max_await_time_ms': int(max_wait * 1000),
+    }
+    try:
+        stream = movies_coll.watch(resume_after=state.get('resume_token'), **options)
+    except OperationFailure as e:
+        if e.code != HISTORY_LOST:
+            raise
+        # the changes since the token are lost: everything is refreshed, then the stream starts from now
+        print("The resume token is too old, the derived collections are refreshed entirely.")
+        stream = movies_coll.watch(**options)
+        refresh(None, names)
+
+    with stream:
+        events, first_at, saved_token = [], None, state.get('resume_token')
+        while stop is None or not stop():
+            event = stream.try_next()
+            if event is not None:
+                events.append(event)
+                first_at = first_at or time.monotonic()
+            if events and (len(events) >= batch_size or time.monotonic() - first_at >= max_wait):
+                refresh(batch_directors(events), names)
+                events, first_at = [], None
+            # the token of the last applied event (or of the server position when idle)
+            if not events and stream.resume_token is not None and stream.resume_token != saved_token:
+                _save_token(stream.resume_token)
+                saved_token = stream.resume_token
+        if events:
+            refresh(batch_directors(events), names)
+            _save_token(stream.resume_token)
+
+
+def reset():
+    """
+    Forgets the resume token: the next watcher starts from the current changes.
+    """
+    metadata_coll.delete_one({'_id': STATE_ID})
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Live refresh of the collections derived from the movies")
+    parser.add_argument("--batch-size", type=int, default=100, help="maximum number of events of a batch")
+    parser.add_argument("--max-wait", type=float, default=1.0, help="maximum age of a batch in seconds")
+    parser.add_argument("--handler", action="append", choices=sorted(handlers),
+                        help="derived collection to refresh (all by default, can be repeated)")
+    parser.add_argument("--pre-images", action="store_true", help="enable the pre-images of the movies first")
+    parser.add_argument("--reset", action="store_true", help="start from the current changes, not the saved token")
+    args = parser.parse_args()
+
+    if args.pre_images:
+        enable_pre_images()
+    if args.reset:
+        reset()
+    try:
+        watch(args.batch_size, args.max_wait, args.handler)
+    except KeyboardInterrupt:
+        print("Watcher stopped.")
@@ -0,0 +1,142 @@
+from argparse import ArgumentParser
+from typing import Iterable, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from database_connection import metadata_coll, movie_details_coll, movies_coll
+
+"""
+Optional storage layout moving the long text fields of the movies to the *movie_details* collection.
+
+The aggregations read the title, director, year, runtime, rating and cast of the movies,
+but every scanned document also carries its summaries, poster, trailer and writers.
+With the split layout:
+    - *movies* keeps the fields of the queries (and their indexes)
+    - *movie_details* keeps the long text fields, under the _id of the movie
+so the working set of the scans is the small documents only. Movie loads the details when they're read,
+the importer and the model save methods write both parts.
+
+The layout is saved in *import_metadata*, so every process uses the same one. Changing it moves the fields:
+    python -m aggregation.movie_details split
+    python -m aggregation.movie_details join
+"""
+
+DETAIL_FIELDS = ('summary', 'short_summary', 'movie_poster', 'youtube_trailer', 'writers')
+
+LAYOUT_ID = 'layout:movies'
+
+# layout read from import_metadata, once per process
+_split = None
+
+
+def split_layout() -> bool:
+    """
+    Returns True if the long text fields are stored in *movie_details*.
+    """
+    global _split
+    if _split is None:
+        layout = metadata_coll.find_one({'_id': LAYOUT_ID})
+        _split = bool(layout and layout.get('split_details'))
+    return _split
+
+
+def _save_layout(split: bool):
+    global _split
+    metadata_coll.update_one({'_id': LAYOUT_ID}, {'$set': {'split_details': split}}, upsert=True)
+    _split = split
+
+
+def split_document(document: dict) -> Tuple[dict, dict]:
+    """
+    Returns the part of a movie document stored in *movies* and its long text fields.
+    """
+    movie = {name: value for name, value in document.items() if name not in DETAIL_FIELDS}
+    details = {name: document[name] for name in DETAIL_FIELDS if name in document}
+    return movie, details
+
+
+def details_request(movie_id, details: dict) -> Optional[UpdateOne]:
+    """
+    Returns the upsert of the details of a movie (None if it has no long text field).
+    As the update of the movie itself ($set), the fields which aren't given are left as they are.
+    """
+    return UpdateOne({'_id': movie_id}, {'$set': details}, upsert=True) if details else None
+
+
+def load_details(movie_id) -> dict:
+    """
+    Returns the long text fields of a movie.
+    """
+    return movie_details_coll.find_one({'_id': movie_id}, {'_id': 0}) or {}
+
+
+def full_movies(query: Optional[dict] = None, projection: Optional[dict] = None) -> Iterable[dict]:
+    """
+    Returns the movies with their long text fields, whatever the layout.
+    """
+    if not split_layout():
+        return movies_coll.find(query or {}, projection)
+    pipeline = [
+        {'$match': query or {}},
+        {'$lookup': {'from': movie_details_coll.name, 'localField': '_id', 'foreignField': '_id', 'as': 'details'}},
+        {'$replaceWith': {'$mergeObjects': [{'$arrayElemAt': ['$details', 0]}, '$$ROOT']}},
+        {'$unset': 'details'},
+    ]
+    if projection:
+        pipeline.append({'$project': projection})
+    return movies_coll.aggregate(pipeline)
+
+
+def create_details_indexes():
+    """
+    Creates the text index of the long text fields (the search reads it with the one of movies).
+    """
+    from aggregation.movie_search import SEARCH_WEIGHTS
+
+    weights = {name: weight for name, weight in SEARCH_WEIGHTS.items() if name in DETAIL_FIELDS}
+    movie_details_coll.create_index([(name, 'text') for name in weights], weights=weights,
+                                    name='movie_details_search')
+
+
+def split_movies():
+    """
+    Moves the long text fields of the movies to *movie_details* and switches to the split layout.
+    """
+    has_details = {'$or': [{name: {'$exists': True}} for name in DETAIL_FIELDS]}
+    movies_coll.aggregate([
+        {'$match': has_details},
+        {'$project': {name: 1 for name in DETAIL_FIELDS}},
+        {'$merge': {'into': movie_details_coll.name, 'on': '_id', 'whenMatched': 'merge',
+                    'whenNotMatched': 'insert'}}
+    ])
+    create_details_indexes()
+
+    # the details are read from movie_details before they are removed from movies
+    _save_layout(True)
+    result = movies_coll.update_many(has_details, {'$unset': dict.fromkeys(DETAIL_FIELDS, '')})
+    print(f"The long text fields of {result.modified_count} movies have been moved to '{movie_details_coll.name}'.")
+
+
+def join_movies():
+    """
+    Moves the long text fields back to the movies and switches to the single collection layout.
+    """
+    movie_details_coll.aggregate([
+        {'$merge': {'into': movies_coll.name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}}
+    ])
+    _save_layout(False)
+    movie_details_coll.drop()
+    print(f"The long text fields have been moved back to '{movies_coll.name}'.")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Storage layout of the long text fields of the movies")
+    parser.add_argument("command", choices=["split", "join", "status"])
+    args = parser.parse_args()
+
+    if args.command == "split":
+        split_movies()
+    elif args.command == "join":
+        join_movies()
+    else:
+        print(f"Layout: {'split (movies + movie_details)' if split_layout() else 'single collection'}")
@@ -0,0 +1,108 @@
+from typing import Optional
+
+from aggregation.movie_details import create_details_indexes, split_layout
+from database_connection import movie_details_coll, movies_coll
+
+"""
+Full-text search of the movies, on a text index instead of $regex scans.
+
+The text index covers the title, the cast, the writers and the summaries, with weights
+(a word of the title counts more than a word of the cast, which counts more than a word of the summary).
+The results are sorted by relevance (textScore).
+
+year, rating and runtime are suffix fields of the text index, so the filters
+on them are checked in the index and the movies which don't match are never read.
+
+With the split layout (aggregation.movie_details) the writers and the summaries are indexed in *movie_details*:
+both text indexes are searched and the scores of a movie are added. The candidates are the `limit` best
+movies of each collection, so a movie which is only average in both can be missed, and an excluded word
+(-word) only excludes the movies where it is in the same collection as the searched words.
+"""
+
+SEARCH_INDEX = 'movies_search'
+
+SEARCH_WEIGHTS = {'title': 10, 'cast': 5, 'writers': 3, 'summary': 2, 'short_summary': 2}
+
+# fields of the search results
+SEARCH_PROJECTION = {'_id': 0, 'title': 1, 'year': 1, 'director': 1, 'rating': 1, 'runtime': 1,
+                     'score': {'$meta': 'textScore'}}
+
+
+def create_search_index():
+    """
+    Creates the text index of the search (a collection can only have one text index).
+    """
+    movies_coll.create_index([(field, 'text') for field in SEARCH_WEIGHTS]
+                             + [('year', 1), ('rating', 1), ('runtime', 1)],
+                             weights=SEARCH_WEIGHTS, name=SEARCH_INDEX)
+    if split_layout():
+        create_details_indexes()
+
+
+def _range(low, high) -> Optional[dict]:
+    condition = {}
+    if low is not None:
+        condition['$gte'] = low
+    if high is not None:
+        condition['$lte'] = high
+    return condition or None
+
+
+def search_query(text: str, year_from: Optional[int] = None, year_to: Optional[int] = None,
+                 min_rating: Optional[float] = None, max_rating: Optional[float] = None,
+                 min_runtime: Optional[int] = None, max_runtime: Optional[int] = None) -> dict:
+    """
+    Returns the filter of a search: words of `text` (or "exact phrases", -excluded words) and ranges.
+    """
+    query = {'$text': {'$search': text}}
+    for field, condition in (('year', _range(year_from, year_to)), ('rating', _range(min_rating, max_rating)),
+                             ('runtime', _range(min_runtime, max_runtime))):
+        if condition:
+            query[field] = condition
+    return query
+
+
+def _search_details(text: str, limit: int, movie_filter: dict) -> list:
+    # best matches of the long text fields, with their movie if it passes the filters
+    return list(movie_details_coll.aggregate([
+        {'$match': {'$text': {'$search': text}}},
+        {'$project': {'score': {'$meta': 'textScore'}}},
+        {'$sort': {'score': {'$meta': 'textScore'}}},
+        {
+            '$lookup': {
+                'from': movies_coll.name,
+                'localField': '_id',
+                'foreignField': '_id',
+                'pipeline': [{'$match': movie_filter},
+                             {'$project': {**SEARCH_PROJECTION, '_id': 1, 'score': {'$literal': 0}}}],
+                'as': 'movie'
+            }
+        },
+        {'$unwind': '$movie'},
+        {'$limit': limit},
+        {'$replaceWith': {'$mergeObjects': ['$movie', {'score': '$score'}]}}
+    ]))
+
+
+def search_movies(text: str, limit: int = 20, **filters):
+    """
+    Returns a cursor over the `limit` most relevant movies:
+    {'title', 'year', 'director', 'rating', 'runtime', 'score'}
+    """
+    query = search_query(text, **filters)
+    if not split_layout():
+        return movies_coll.find(query, SEARCH_PROJECTION) \
+            .sort([('score', {'$meta': 'textScore'}), ('title', 1)]) \
+            .limit(limit)
+
+    movies = {}
+    for movie in movies_coll.find(query, {**SEARCH_PROJECTION, '_id': 1}) \
+            .sort([('score', {'$meta': 'textScore'})]).limit(limit):
+        movies[movie['_id']] = movie
+    movie_filter = {field: condition for field, condition in query.items() if field != '$text'}
+    for movie in _search_details(text, limit, movie_filter):
+        found = movies.setdefault(movie['_id'], {**movie, 'score': 0})
+        found['score'] += movie['score']
+
+    results = sorted(movies.values(), key=lambda movie: (-movie['score'], movie['title']))[:limit]
+    return iter([{field: value for field, value in movie.items() if field != '_id'} for movie in results])
@@ -0,0 +1,22 @@
+'''
+Keyset pagination of the top-N queries.
+
+The next page starts after the last record of the previous one: the query filters on the sort key
+(value, _id) instead of using $skip, so page N costs as much as the first page when the sort key is indexed.
+'''
+
+
+def keyset_filter(field: str, last_value, last_id) -> dict:
+    """
+    Returns the filter of the documents coming after (last_value, last_id) in the order
+    {field: -1, _id: 1}. Documents without a value (null) come last, as in the MongoDB sort.
+    """
+    if last_value is None:
+        return {field: None, '_id': {'$gt': last_id}}
+    return {
+        '$or': [
+            {field: {'$lt': last_value}},
+            {field: last_value, '_id': {'$gt': last_id}},
+            {field: None}
+        ]
+    }
@@ -0,0 +1,166 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+from aggregation.director_stats import COUNTERS
+from database_connection import movies_coll
+
+"""
+Scatter-gather version of the top-N queries, for a catalog partitioned over several servers
+(e.g. by year range, see MONGO_PARTITION_URIS in database_connection).
+
+Each partition computes partial aggregates of its own movies, the partitions run concurrently
+in a thread pool, and the partials are merged here:
+    - directors: sums and counts per director (not averages, which can't be merged), so the
+      averages computed from the merged sums are exact
+    - actors: the exact top-N is found in three rounds, without sending the counts of all the actors:
+        1. each partition sends its own top-N; the sum of these partial counts gives a lower bound `tau`
+           of the count of the N-th actor
+        2. each partition sends the actors having at least tau / (number of partitions) movies in it:
+           an actor below this threshold everywhere has less than tau movies in total
+        3. the exact counts of these candidates are summed over the partitions
+
+    Director.top_rating(5, partitions=get_partitions())
+"""
+
+
+def _scatter(partitions: list, function: Callable, *args) -> list:
+    """
+    Runs function(database, *args) on every partition concurrently and returns the results in the same order.
+    """
+    if not partitions:
+        raise ValueError("No partition is configured (MONGO_PARTITION_URIS)")
+    with ThreadPoolExecutor(max_workers=len(partitions)) as pool:
+        return list(pool.map(lambda database: function(database, *args), partitions))
+
+
+def _order(value, name: str) -> tuple:
+    # order of the top-N queries: value descending, missing values last, then name
+    return value is None, -(value or 0), name
+
+
+def _after(rows: list, field: str, after: Optional[tuple]) -> list:
+    if after is None:
+        return rows
+    last = _order(*after)
+    return [row for row in rows if _order(row[field], row['_id']) > last]
+
+
+def partial_director_stats(database) -> list:
+    """
+    Returns the sums and counts of the movies of one partition, per director.
+    """
+    return list(database[movies_coll.name].aggregate([
+        {
+            '$group': {
+                '_id': '$director',
+                'movie_count': {'$sum': 1},
+                'rating_sum': {'$sum': '$rating'},
+                'rating_count': {'$sum': {'$cond': [{'$isNumber': '$rating'}, 1, 0]}},
+                'runtime_sum': {'$sum': '$runtime'},
+                'runtime_count': {'$sum': {'$cond': [{'$isNumber': '$runtime'}, 1, 0]}}
+            }
+        }
+    ]))
+
+
+def merge_director_stats(partials: Iterable[list]) -> dict:
+    """
+    Adds the partial stats of the partitions and computes the averages, per director.
+    """
+    merged = {}
+    for partial in partials:
+        for stats in partial:
+            director = merged.setdefault(stats['_id'], dict.fromkeys(COUNTERS, 0))
+            for counter in COUNTERS:
+                director[counter] += stats.get(counter) or 0
+
+    for director in merged.values():
+        director['avg_rating'] = director['rating_sum'] / director['rating_count'] if director['rating_count'] else None
+        director['avg_runtime'] = director['runtime_sum'] / director['runtime_count'] \
+            if director['runtime_count'] else None
+    return merged
+
+
+def top_directors(number: int, field: str, partitions: list, after: Optional[tuple] = None) -> List[dict]:
+    """
+    Returns the `number` first directors by `field` (avg_rating, avg_runtime or movie_count) over all the partitions,
+    as the documents of director_stats: {'_id': director, field: value}
+    after: (value, director) of the last director of the previous page
+    """
+    merged = merge_director_stats(_scatter(partitions, partial_director_stats))
+    rows = sorted(({'_id': director, field: stats[field]} for director, stats in merged.items()
+                   if stats['movie_count']), key=lambda row: _order(row[field], row['_id']))
+    return _after(rows, field, after)[:number]
+
+
+def partial_actor_counts(database, limit: Optional[int] = None, min_count: Optional[float] = None,
+                         actors: Optional[list] = None) -> list:
+    """
+    Returns the number of movies per actor in one partition: the `limit` first ones, the ones with at least
+    `min_count` movies, or the given actors.
+    """
+    match = {'cast_list': {'$in': actors}} if actors is not None else {'cast_list.0': {'$exists': True}}
+    pipeline = [
+        {'$match': match},
+        {'$project': {'_id': 0, 'cast_list': 1}},
+        {'$unwind': '$cast_list'},
+    ]
+    if actors is not None:
+        pipeline.append({'$match': {'cast_list': {'$in': actors}}})
+    pipeline.append({'$group': {'_id': '$cast_list', 'movie_count': {'$sum': 1}}})
+    if min_count is not None:
+        pipeline.append({'$match': {'movie_count': {'$gte': min_count}}})
+    if limit is not None:
+        pipeline += [{'$sort': {'movie_count': -1, '_id': 1}}, {'$limit': limit}]
+    return list(database[movies_coll.name].aggregate(pipeline))
+
+
+def _sum_counts(partials: Iterable[list]) -> dict:
+    counts = {}
+    for partial in partials:
+        for actor in partial:
+            counts[actor['_id']] = counts.get(actor['_id'], 0) + actor['movie_count']
+    return counts
+
+
+def _actor_titles(database, actors: list) -> list:
+    return list(database[movies_coll.name].aggregate([
+        {'$match': {'cast_list': {'$in': actors}}},
+        {'$project': {'_id': 0, 'title': 1, 'cast_list': 1}},
+        {'$unwind': '$cast_list'},
+        {'$match': {'cast_list': {'$in': actors}}},
+        {'$group': {'_id': '$cast_list', 'movies': {'$addToSet': '$title'}}}
+    ]))
+
+
+def top_actors(number: int, partitions: list, after: Optional[tuple] = None) -> List[dict]:
+    """
+    Returns the `number` actors with the most movies over all the partitions:
+    {'_id': actor, 'movies': [...], 'movie_count': n}
+    after: (movie_count, actor) of the last actor of the previous page (the next pages merge the counts of all
+    the actors, as the threshold of the first page doesn't apply to them)
+    """
+    if number <= 0:
+        return []
+    if after is None:
+        # round 1: lower bound of the count of the N-th actor
+        partial_counts = _sum_counts(_scatter(partitions, partial_actor_counts, number))
+        tau = sorted(partial_counts.values(), reverse=True)[number - 1] if len(partial_counts) >= number else 0
+
+        # round 2: actors which can reach tau, round 3: their exact counts
+        candidates = sorted({actor['_id'] for partial in _scatter(partitions, partial_actor_counts, None,
+                                                                    tau / len(partitions))
+                             for actor in partial})
+        counts = _sum_counts(_scatter(partitions, partial_actor_counts, None, None, candidates))
+    else:
+        counts = _sum_counts(_scatter(partitions, partial_actor_counts))
+
+    rows = sorted(({'_id': actor, 'movie_count': count} for actor, count in counts.items()),
+                  key=lambda row: _order(row['movie_count'], row['_id']))
+    rows = _after(rows, 'movie_count', after)[:number]
+
+    titles = {}
+    for partial in _scatter(partitions, _actor_titles, [row['_id'] for row in rows]):
+        for actor in partial:
+            titles.setdefault(actor['_id'], set()).update(actor['movies'])
+    return [{**row, 'movies': sorted(titles.get(row['_id'], ()))} for row in rows]
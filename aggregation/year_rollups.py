@@ -0,0 +1,243 @@
+from argparse import ArgumentParser
+from typing import Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from aggregation.director_stats import COUNTERS, movie_delta
+from database_connection import movies_coll, year_director_rollups_coll, year_rollups_coll
+from models.records import DirectorLength, DirectorMovieCount, DirectorRating, PeriodStats, YearStats
+
+"""
+The module maintains the rollups of the movies per year, so the reports on a period read
+one document per year (or per year and director) instead of scanning the movies:
+    - *year_rollups*: {_id: year, movie_count, rating_sum, rating_count, runtime_sum, runtime_count,
+      rating_histogram: {'0': n, ..., '9': n}} (bucket of a rating: its integer part, 10 counts in '9')
+    - *year_director_rollups*: {_id: {year, director}, year, director, and the same counters}
+
+The importer and the model save methods update them incrementally, as the director stats.
+The movies without a known year (year = 0 or missing) are left out of the rollups.
+
+    period_stats(1970, 1999)
+    top_directors_of_period(5, 'avg_rating', 1990, 1999)
+
+Rebuild or verify them from scratch with:
+    python -m aggregation.year_rollups rebuild
+    python -m aggregation.year_rollups verify
+"""
+
+# movies with a known year
+KNOWN_YEAR = {'year': {'$gt': 0}}
+
+# rollups with movies (the counters of the rollups of updated movies can go back to 0)
+WITH_MOVIES = {'movie_count': {'$gt': 0}}
+
+# field of the rollups ordering the top directors, and its record
+DIRECTOR_RECORDS = {'avg_rating': DirectorRating, 'avg_runtime': DirectorLength, 'movie_count': DirectorMovieCount}
+
+
+def create_rollup_indexes():
+    """
+    Creates the index of the year ranges on the movies and on the rollups per director.
+    """
+    movies_coll.create_index('year')
+    year_director_rollups_coll.create_index([('year', 1), ('director', 1)])
+
+
+def _known_year(movie: dict) -> bool:
+    year = movie.get('year')
+    return isinstance(year, int) and not isinstance(year, bool) and year > 0
+
+
+def rating_bucket(rating) -> Optional[str]:
+    """
+    Returns the histogram bucket of a rating ('0' to '9'), None if there is no rating.
+    """
+    if not isinstance(rating, (int, float)) or isinstance(rating, bool):
+        return None
+    return str(min(int(rating), 9))
+
+
+def rollup_requests(added: Iterable[dict] = (), removed: Iterable[dict] = ()) -> Tuple[list, list]:
+    """
+    Groups the changes of a batch by year and by (year, director) and returns the upserts
+    of year_rollups and of year_director_rollups.
+
+    added: movies written to the database
+    removed: previous versions of the movies which were updated (their contribution is subtracted)
+    """
+    years, year_directors = {}, {}
+    for sign, movies in ((1, added), (-1, removed)):
+        for movie in movies:
+            if not _known_year(movie):
+                continue
+            delta = movie_delta(movie, sign)
+            year = years.setdefault(movie['year'], {})
+            for counter, value in delta.items():
+                year[counter] = year.get(counter, 0) + value
+            bucket = rating_bucket(movie.get('rating'))
+            if bucket is not None:
+                year[f'rating_histogram.{bucket}'] = year.get(f'rating_histogram.{bucket}', 0) + sign
+
+            year_director = year_directors.setdefault((movie['year'], movie['director']), dict.fromkeys(COUNTERS, 0))
+            for counter, value in delta.items():
+                year_director[counter] += value
+
+    year_requests = [UpdateOne({'_id': year}, {'$inc': delta}, upsert=True)
+                     for year, delta in years.items() if any(delta.values())]
+    director_requests = [
+        UpdateOne({'_id': {'year': year, 'director': director}},
+                  {'$inc': delta, '$setOnInsert': {'year': year, 'director': director}}, upsert=True)
+        for (year, director), delta in year_directors.items() if any(delta.values())
+    ]
+    return year_requests, director_requests
+
+
+def update_year_rollups(added: Iterable[dict] = (), removed: Iterable[dict] = ()):
+    """
+    Applies the changes of some movies to the rollups.
+    """
+    year_requests, director_requests = rollup_requests(added, removed)
+    if year_requests:
+        year_rollups_coll.bulk_write(year_requests, ordered=False)
+    if director_requests:
+        year_director_rollups_coll.bulk_write(director_requests, ordered=False)
+
+
+def _year_range(year_from: Optional[int], year_to: Optional[int], field: str = '_id') -> dict:
+    condition = {'$gt': 0}
+    if year_from is not None:
+        condition['$gte'] = year_from
+    if year_to is not None:
+        condition['$lte'] = year_to
+    return {field: condition}
+
+
+def _average(total, count) -> Optional[float]:
+    return total / count if count else None
+
+
+def year_stats(year_from: Optional[int] = None, year_to: Optional[int] = None) -> List[YearStats]:
+    """
+    Returns the stats of each year of the range (both ends included, open if None) which has movies.
+    """
+    return [
+        YearStats(rollup['_id'], rollup['movie_count'], _average(rollup['rating_sum'], rollup['rating_count']),
+                  _average(rollup['runtime_sum'], rollup['runtime_count']), rollup.get('rating_histogram', {}))
+        for rollup in year_rollups_coll.find({**_year_range(year_from, year_to), **WITH_MOVIES}).sort('_id', 1)
+    ]
+
+
+def period_stats(year_from: Optional[int] = None, year_to: Optional[int] = None) -> PeriodStats:
+    """
+    Returns the stats of all the movies of the range, merged from the rollups of its years.
+    """
+    totals = dict.fromkeys(COUNTERS, 0)
+    histogram = {}
+    for rollup in year_rollups_coll.find({**_year_range(year_from, year_to), **WITH_MOVIES}):
+        for counter in COUNTERS:
+            totals[counter] += rollup.get(counter) or 0
+        for bucket, count in rollup.get('rating_histogram', {}).items():
+            histogram[bucket] = histogram.get(bucket, 0) + count
+    return PeriodStats(year_from, year_to, totals['movie_count'],
+                       _average(totals['rating_sum'], totals['rating_count']),
+                       _average(totals['runtime_sum'], totals['runtime_count']),
+                       {bucket: histogram[bucket] for bucket in sorted(histogram) if histogram[bucket]})
+
+
+def decade_stats(decade: int) -> PeriodStats:
+    """
+    Returns the stats of the movies of a decade, e.g. decade_stats(1990) for 1990-1999.
+    """
+    decade -= decade % 10
+    return period_stats(decade, decade + 9)
+
+
+def top_directors_of_period(number: int, field: str = 'avg_rating', year_from: Optional[int] = None,
+                            year_to: Optional[int] = None) -> list:
+    """
+    Returns the `number` first directors of the range by `field` (avg_rating, avg_runtime or movie_count),
+    as DirectorRating, DirectorLength or DirectorMovieCount, merged from the rollups per year and director.
+    """
+    if field not in DIRECTOR_RECORDS:
+        raise ValueError(f"Unknown field: {field} (expected: {', '.join(DIRECTOR_RECORDS)})")
+    record = DIRECTOR_RECORDS[field]
+    pipeline = [
+        {'$match': {**_year_range(year_from, year_to, 'year'), **WITH_MOVIES}},
+        {'$group': {'_id': '$director', **{counter: {'$sum': f'${counter}'} for counter in COUNTERS}}},
+        {'$set': {
+            'avg_rating': {'$cond': [{'$gt': ['$rating_count', 0]}, {'$divide': ['$rating_sum', '$rating_count']},
+                                     None]},
+            'avg_runtime': {'$cond': [{'$gt': ['$runtime_count', 0]},
+                                      {'$divide': ['$runtime_sum', '$runtime_count']}, None]}
+        }},
+        {'$sort': {field: -1, '_id': 1}},
+        {'$limit': number}
+    ]
+    return [record(director['_id'], director[field]) for director in year_director_rollups_coll.aggregate(pipeline)]
+
+
+def rebuild_year_rollups(batch_size: int = 10000):
+    """
+    Recomputes both rollups from the movies collection, `batch_size` movies at a time.
+    """
+    year_rollups_coll.drop()
+    year_director_rollups_coll.drop()
+    create_rollup_indexes()
+
+    batch = []
+    cursor = movies_coll.find(KNOWN_YEAR, {'_id': 0, 'year': 1, 'director': 1, 'rating': 1, 'runtime': 1})
+    for movie in cursor.batch_size(batch_size):
+        batch.append(movie)
+        if len(batch) == batch_size:
+            update_year_rollups(added=batch)
+            batch = []
+    update_year_rollups(added=batch)
+    print(f"The year rollups have been rebuilt: {year_rollups_coll.count_documents({})} years, "
+          f"{year_director_rollups_coll.count_documents({})} years and directors.")
+
+
+def verify_year_rollups(tolerance: float = 1e-6) -> int:
+    """
+    Compares the stored rollups per year with a full computation and prints the differences.
+    Returns the number of years whose rollup is wrong.
+    """
+    expected = {stats['_id']: stats for stats in movies_coll.aggregate([
+        {'$match': KNOWN_YEAR},
+        {
+            '$group': {
+                '_id': '$year',
+                'movie_count': {'$sum': 1},
+                'rating_sum': {'$sum': '$rating'},
+                'rating_count': {'$sum': {'$cond': [{'$isNumber': '$rating'}, 1, 0]}},
+                'runtime_sum': {'$sum': '$runtime'},
+                'runtime_count': {'$sum': {'$cond': [{'$isNumber': '$runtime'}, 1, 0]}}
+            }
+        }
+    ])}
+    stored = {rollup['_id']: rollup for rollup in year_rollups_coll.find(WITH_MOVIES)}
+
+    wrong = 0
+    for year in expected.keys() | stored.keys():
+        expected_stats, stored_stats = expected.get(year, {}), stored.get(year, {})
+        for counter in COUNTERS:
+            if abs((expected_stats.get(counter) or 0) - (stored_stats.get(counter) or 0)) > tolerance:
+                print(f"{year}: {counter} is {stored_stats.get(counter)}, expected {expected_stats.get(counter)}")
+                wrong += 1
+                break
+
+    if wrong:
+        print(f"{wrong} years have wrong rollups, run the rebuild command.")
+    else:
+        print(f"The rollups of the {len(expected)} years are consistent.")
+    return wrong
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Maintenance of the year rollups")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild_year_rollups()
+    else:
+        verify_year_rollups()
@@ -0,0 +1,268 @@
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from argparse import ArgumentParser
+from array import array
+from typing import Iterable, Iterator, Optional
+
+from aggregation.movie_details import full_movies
+from analytics.snapshot import LAZY_FIELDS, MISSING_RUNTIME, CatalogSnapshot, StringColumn
+from database_connection import movies_coll
+from importer.mapping import content_hash, director_key, split_cast
+from importer.parallel_csv import parse_csv
+
+'''
+Binary file of the normalized catalog, read with a memory map.
+
+The file is written once (from the csv file or from the movies collection) and then:
+    - seeds a database with bulk inserts, without parsing and normalizing the csv again:
+        python load_data.py catalog.bin --catalog
+    - gives a CatalogSnapshot whose columns are views on the memory map (no copy, no database):
+        snapshot = CatalogFile('catalog.bin').snapshot()
+
+Layout (little or big endian as the machine which wrote it, 8 bytes aligned sections):
+    MAGIC | version (uint32) | length of the table of contents (uint32) | table of contents (json)
+    sections: numeric columns, and for each text column its utf-8 heap, offsets ('q') and null flags ('B')
+
+Export with:
+    python -m analytics.catalog_file export catalog.bin
+    python -m analytics.catalog_file export catalog.bin --csv movies.csv
+'''
+
+MAGIC = b'DGCATLG\x00'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<II')
+
+# numeric columns of the file, as in CatalogSnapshot
+NUMERIC_COLUMNS = {'years': 'i', 'runtimes': 'i', 'ratings': 'd', 'director_ids': 'i',
+                   'cast_offsets': 'q', 'cast_ids': 'i'}
+
+# text columns of the file: the short ones of the snapshot, the names, and the long text fields
+TEXT_COLUMNS = ('titles', 'imdb_ids', 'directors', 'actors') + LAZY_FIELDS
+
+
+def _align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+class _TextColumnBuilder:
+    """utf-8 heap, offsets and null flags of a text column being written."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+        self.nulls = bytearray()
+
+    def append(self, text: Optional[str]):
+        self.nulls.append(text is None)
+        self.data += (text or '').encode('utf-8')
+        self.offsets.append(len(self.data))
+
+
+def write_catalog(movies: Iterable[dict], path: str) -> int:
+    """
+    Writes mapped movies (as map_csv_movie or the movies collection) to a catalog file.
+    Returns the number of movies. The file is replaced only once it is complete.
+    """
+    numeric = {name: array(typecode) for name, typecode in NUMERIC_COLUMNS.items()}
+    numeric['cast_offsets'].append(0)
+    texts = {name: _TextColumnBuilder() for name in TEXT_COLUMNS}
+    directors, actors = {}, {}
+
+    for movie in movies:
+        numeric['years'].append(movie.get('year') or 0)
+        runtime, rating = movie.get('runtime'), movie.get('rating')
+        numeric['runtimes'].append(runtime if isinstance(runtime, int) else MISSING_RUNTIME)
+        numeric['ratings'].append(float(rating) if isinstance(rating, (int, float)) else math.nan)
+
+        numeric['director_ids'].append(directors.setdefault(movie.get('director', ''), len(directors)))
+        cast = movie['cast_list'] if 'cast_list' in movie else split_cast(movie.get('cast'))
+        numeric['cast_ids'].extend(actors.setdefault(actor, len(actors)) for actor in cast)
+        numeric['cast_offsets'].append(len(numeric['cast_ids']))
+
+        texts['titles'].append(movie.get('title', ''))
+        texts['imdb_ids'].append(movie.get('imdb_id'))
+        for field in LAZY_FIELDS:
+            texts[field].append(movie.get(field))
+
+    for name in directors:
+        texts['directors'].append(name)
+    for name in actors:
+        texts['actors'].append(name)
+
+    sections = dict(numeric)
+    for name, column in texts.items():
+        sections[f'{name}.data'] = column.data
+        sections[f'{name}.offsets'] = column.offsets
+        sections[f'{name}.nulls'] = column.nulls
+
+    # position of each section after the header
+    contents = {'rows': len(numeric['years']), 'byteorder': sys.byteorder, 'sections': {}}
+    position = 0
+    for name, section in sections.items():
+        typecode = section.typecode if isinstance(section, array) else 'B'
+        nbytes = len(memoryview(section).cast('B'))
+        contents['sections'][name] = [position, nbytes, typecode]
+        position = _align(position + nbytes)
+
+    toc = json.dumps(contents).encode('utf-8')
+    header = MAGIC + _HEADER.pack(FORMAT_VERSION, len(toc)) + toc
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as catalog:
+        catalog.write(header + b'\x00' * (_align(len(header)) - len(header)))
+        for section in sections.values():
+            nbytes = len(memoryview(section).cast('B'))
+            catalog.write(section)
+            catalog.write(b'\x00' * (_align(nbytes) - nbytes))
+    os.replace(temporary_path, path)
+    return contents['rows']
+
+
+def export_collection(path: str, collection=movies_coll, query: Optional[dict] = None) -> int:
+    """
+    Writes the movies of the collection to a catalog file.
+    """
+    if collection is movies_coll:
+        # with the long text fields of the split layout
+        return write_catalog(full_movies(query, {'_id': 0, 'content_hash': 0}), path)
+    return write_catalog(collection.find(query or {}, {'_id': 0, 'content_hash': 0}), path)
+
+
+def export_csv(csv_path: str, path: str, workers: Optional[int] = None) -> int:
+    """
+    Writes the movies of a csv file to a catalog file (parsed and normalized as by the importer).
+    """
+    def movies():
+        for chunk in parse_csv(csv_path, workers=workers):
+            for error in chunk.errors:
+                print(error)
+            yield from chunk.rows
+
+    return write_catalog(movies(), path)
+
+
+class CatalogFile:
+    """Catalog file opened with a memory map. The columns are views on the file, nothing is copied."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as catalog:
+            self._mmap = mmap.mmap(catalog.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} isn't a catalog file")
+        version, toc_length = _HEADER.unpack_from(view, len(MAGIC))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} has the version {version} of the catalog format, expected {FORMAT_VERSION}")
+        toc_start = len(MAGIC) + _HEADER.size
+        contents = json.loads(bytes(view[toc_start:toc_start + toc_length]))
+        if contents['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path} was written on a {contents['byteorder']} endian machine")
+
+        data_start = _align(toc_start + toc_length)
+        self.rows = contents['rows']
+        self._sections = {
+            name: view[data_start + offset:data_start + offset + nbytes].cast(typecode)
+            for name, (offset, nbytes, typecode) in contents['sections'].items()
+        }
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self) -> 'CatalogFile':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes the memory map. The columns (and the snapshots) of the file can't be used after it.
+        """
+        for section in self._sections.values():
+            section.release()
+        self._sections = {}
+        self._mmap.close()
+
+    def column(self, name: str) -> memoryview:
+        """
+        Returns a numeric column (memoryview on the file).
+        """
+        if name not in NUMERIC_COLUMNS:
+            raise KeyError(f"{name} isn't a numeric column of the catalog")
+        return self._sections[name]
+
+    def strings(self, name: str) -> StringColumn:
+        """
+        Returns a text column (empty strings for the null values, see text()).
+        """
+        return StringColumn(self._sections[f'{name}.data'], self._sections[f'{name}.offsets'])
+
+    def text(self, index: int, name: str) -> Optional[str]:
+        """
+        Returns the value of a text column for one movie, None if it was missing.
+        """
+        if self._sections[f'{name}.nulls'][index]:
+            return None
+        return self.strings(name)[index]
+
+    def snapshot(self) -> CatalogSnapshot:
+        """
+        Returns a snapshot whose columns are read from the memory map. The long text fields are read from the file.
+        """
+        return CatalogSnapshot(self.strings('titles'), self.strings('imdb_ids'), self.column('years'),
+                               self.column('runtimes'), self.column('ratings'), self.column('director_ids'),
+                               list(self.strings('directors')), self.column('cast_offsets'), self.column('cast_ids'),
+                               list(self.strings('actors')), text_loader=self.text)
+
+    def documents(self) -> Iterator[dict]:
+        """
+        Yields the movies as documents of the movies collection (as the importer writes them).
+        """
+        directors, actors = list(self.strings('directors')), list(self.strings('actors'))
+        director_ids, cast_offsets, cast_ids = self.column('director_ids'), self.column('cast_offsets'), \
+            self.column('cast_ids')
+        years, runtimes, ratings = self.column('years'), self.column('runtimes'), self.column('ratings')
+
+        for index in range(self.rows):
+            director = directors[director_ids[index]]
+            cast = self.text(index, 'cast')
+            movie = {
+                'title': self.text(index, 'titles'),
+                'year': years[index],
+                'director': director,
+                'director_key': director_key(director),
+                'cast': cast,
+                'cast_list': [actors[actor_id] for actor_id in cast_ids[cast_offsets[index]:cast_offsets[index + 1]]]
+                if cast is not None else None,
+                'summary': self.text(index, 'summary'),
+                'short_summary': self.text(index, 'short_summary'),
+                'imdb_id': self.text(index, 'imdb_ids'),
+                'runtime': runtimes[index] if runtimes[index] != MISSING_RUNTIME else None,
+                'youtube_trailer': self.text(index, 'youtube_trailer'),
+                'rating': None if math.isnan(ratings[index]) else ratings[index],
+                'movie_poster': self.text(index, 'movie_poster'),
+                'writers': self.text(index, 'writers')
+            }
+            movie = {key: value for key, value in movie.items() if value is not None}
+            movie['content_hash'] = content_hash(movie)
+            yield movie
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Export of the catalog to a binary file")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("path", help="path of the catalog file")
+    parser.add_argument("--csv", default=None, help="export this csv file instead of the movies collection")
+    args = parser.parse_args()
+
+    if args.csv:
+        rows = export_csv(args.csv, args.path)
+    else:
+        rows = export_collection(args.path)
+    print(f"{rows} movies have been exported to {args.path} ({os.path.getsize(args.path)} bytes).")
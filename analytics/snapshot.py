@@ -0,0 +1,324 @@
+import math
+from array import array
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from bson import ObjectId
+
+from aggregation.movie_details import DETAIL_FIELDS, load_details, split_layout
+from database_connection import movies_coll
+from importer.mapping import split_cast
+
+'''
+Read-only, columnar snapshot of the movies collection for the offline analytics.
+
+Instead of one Movie object (with its __dict__ and twelve strings) per movie, the snapshot keeps:
+    - the numeric fields in arrays: year, runtime (-1 if missing), rating (nan if missing)
+    - the directors and actors once, as lists of names, and the movies refer to them by integer ids
+    - the titles and IMDb ids in string heaps (utf-8 bytes + offsets)
+    - the _id of the movies packed in one buffer of 12 bytes per movie, as ObjectId only when a text is loaded
+    - the long text fields (summary, writers, ...) nowhere: they are loaded when they are read
+
+MovieRow and DirectorRow are __slots__ views on a row of the snapshot, created when iterating.
+
+    snapshot = CatalogSnapshot.from_collection()
+    for movie in snapshot:
+        print(movie.title, movie.director, movie.rating)
+'''
+
+# text fields which are not kept in memory, loaded on access
+LAZY_FIELDS = ('cast', 'summary', 'short_summary', 'youtube_trailer', 'movie_poster', 'writers')
+
+MISSING_RUNTIME = -1
+
+
+class StringColumn:
+    """Strings stored as one utf-8 buffer and the offsets of each string in it."""
+
+    __slots__ = ('_data', '_offsets')
+
+    def __init__(self, data, offsets):
+        self._data = data  # bytes-like
+        self._offsets = offsets  # len(column) + 1 offsets
+
+    @classmethod
+    def build(cls, strings: Iterable[str]) -> 'StringColumn':
+        data, offsets = bytearray(), array('q', [0])
+        for string in strings:
+            data += (string or '').encode('utf-8')
+            offsets.append(len(data))
+        return cls(bytes(data), offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return bytes(self._data[self._offsets[index]:self._offsets[index + 1]]).decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+
+class ObjectIdColumn:
+    """ObjectIds stored as one buffer of their 12 bytes."""
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data  # bytes-like, 12 bytes per id
+
+    @classmethod
+    def build(cls, ids: Iterable[ObjectId]) -> 'ObjectIdColumn':
+        data = bytearray()
+        for object_id in ids:
+            data += object_id.binary
+        return cls(bytes(data))
+
+    def __len__(self):
+        return len(self._data) // 12
+
+    def __getitem__(self, index: int) -> ObjectId:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return ObjectId(bytes(self._data[index * 12:index * 12 + 12]))
+
+    def __iter__(self) -> Iterator[ObjectId]:
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._data)
+
+
+class CatalogSnapshot:
+    """Columns of the movies, indexed by the position of the movie in the snapshot."""
+
+    __slots__ = ('titles', 'imdb_ids', 'years', 'runtimes', 'ratings', 'director_ids', 'directors',
+                 'cast_offsets', 'cast_ids', 'actors', 'movie_ids', '_text_loader', '_director_index',
+                 '_director_movies')
+
+    def __init__(self, titles, imdb_ids, years, runtimes, ratings, director_ids, directors: List[str],
+                 cast_offsets, cast_ids, actors: List[str], movie_ids: Optional[ObjectIdColumn] = None,
+                 text_loader: Optional[Callable[[int, str], Optional[str]]] = None):
+        self.titles = titles
+        self.imdb_ids = imdb_ids
+        self.years = years
+        self.runtimes = runtimes
+        self.ratings = ratings
+        self.director_ids = director_ids
+        self.directors = directors
+        self.cast_offsets = cast_offsets  # cast of movie i: cast_ids[cast_offsets[i]:cast_offsets[i + 1]]
+        self.cast_ids = cast_ids
+        self.actors = actors
+        self.movie_ids = movie_ids  # _id of the movies, used by the default text loader
+        self._text_loader = text_loader or self._load_from_database
+        self._director_index = {name: director_id for director_id, name in enumerate(directors)}
+        self._director_movies = None
+
+    @classmethod
+    def from_collection(cls, collection=movies_coll, query: Optional[dict] = None,
+                        batch_size: int = 10000) -> 'CatalogSnapshot':
+        """
+        Builds the snapshot with one pass over the collection, reading only the short fields.
+        The projection of the cast uses $cond in find, which needs MongoDB 4.4 or later.
+        """
+        # the string heaps are filled while reading, no list of the strings is kept
+        titles, title_offsets = bytearray(), array('q', [0])
+        imdb_ids, imdb_id_offsets = bytearray(), array('q', [0])
+        movie_ids = bytearray()
+        years, runtimes, ratings = array('i'), array('i'), array('d')
+        director_ids, cast_offsets, cast_ids = array('i'), array('q', [0]), array('i')
+        directors, actors = {}, {}
+
+        # the cast string is only read for the movies without cast_list (imported before it existed)
+        projection = {'title': 1, 'imdb_id': 1, 'year': 1, 'runtime': 1, 'rating': 1, 'director': 1,
+                      'cast_list': 1, 'cast': {'$cond': [{'$isArray': '$cast_list'}, '$$REMOVE', '$cast']}}
+        for movie in collection.find(query or {}, projection).batch_size(batch_size):
+            movie_ids += movie['_id'].binary
+            titles += (movie.get('title') or '').encode('utf-8')
+            title_offsets.append(len(titles))
+            imdb_ids += (movie.get('imdb_id') or '').encode('utf-8')
+            imdb_id_offsets.append(len(imdb_ids))
+            years.append(movie.get('year') or 0)
+            runtimes.append(movie['runtime'] if isinstance(movie.get('runtime'), int) else MISSING_RUNTIME)
+            ratings.append(float(movie['rating']) if isinstance(movie.get('rating'), (int, float)) else math.nan)
+
+            # the names are stored once, the movies keep their ids
+            director_ids.append(directors.setdefault(movie.get('director', ''), len(directors)))
+            cast = movie['cast_list'] if 'cast_list' in movie else split_cast(movie.get('cast'))
+            cast_ids.extend(actors.setdefault(actor, len(actors)) for actor in cast)
+            cast_offsets.append(len(cast_ids))
+
+        return cls(StringColumn(bytes(titles), title_offsets), StringColumn(bytes(imdb_ids), imdb_id_offsets),
+                   years, runtimes, ratings, director_ids, list(directors), cast_offsets, cast_ids, list(actors),
+                   ObjectIdColumn(bytes(movie_ids)))
+
+    def __len__(self):
+        return len(self.years)
+
+    def __getitem__(self, index: int) -> 'MovieRow':
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return MovieRow(self, index)
+
+    def __iter__(self) -> Iterator['MovieRow']:
+        for index in range(len(self)):
+            yield MovieRow(self, index)
+
+    def director(self, name: str) -> 'DirectorRow':
+        """
+        Returns the view of a director of the snapshot.
+        """
+        if name not in self._director_index:
+            raise KeyError(f"No director {name} in the snapshot")
+        return DirectorRow(self, self._director_index[name])
+
+    def director_id(self, name: str) -> Optional[int]:
+        """
+        Returns the id of a director in the snapshot, or None if the director has no movies in it.
+        """
+        return self._director_index.get(name)
+
+    def iter_directors(self) -> Iterator['DirectorRow']:
+        for director_id in range(len(self.directors)):
+            yield DirectorRow(self, director_id)
+
+    def cast(self, index: int) -> List[str]:
+        """
+        Returns the actors of a movie.
+        """
+        return [self.actors[actor_id] for actor_id in self.cast_ids[self.cast_offsets[index]:self.cast_offsets[index + 1]]]
+
+    def movies_of_director(self, director_id: int) -> array:
+        """
+        Returns the positions of the movies of a director (grouped once for all the directors, at the first call).
+        """
+        if self._director_movies is None:
+            # counting sort of the movies by director
+            offsets = array('q', [0]) * (len(self.directors) + 1)
+            for movie_director in self.director_ids:
+                offsets[movie_director + 1] += 1
+            for director in range(len(self.directors)):
+                offsets[director + 1] += offsets[director]
+            positions = array('q', offsets)
+            movies = array('q', [0]) * len(self)
+            for index, movie_director in enumerate(self.director_ids):
+                movies[positions[movie_director]] = index
+                positions[movie_director] += 1
+            self._director_movies = (offsets, movies)
+
+        offsets, movies = self._director_movies
+        return movies[offsets[director_id]:offsets[director_id + 1]]
+
+    def load_text(self, index: int, field: str) -> Optional[str]:
+        """
+        Returns a long text field of a movie, which isn't kept in the snapshot.
+        """
+        if field not in LAZY_FIELDS:
+            raise KeyError(f"{field} isn't a text field of the movies")
+        return self._text_loader(index, field)
+
+    def _load_from_database(self, index: int, field: str) -> Optional[str]:
+        if field in DETAIL_FIELDS and split_layout():
+            return load_details(self.movie_ids[index]).get(field)
+        movie = movies_coll.find_one({'_id': self.movie_ids[index]}, {field: 1})
+        return movie.get(field) if movie else None
+
+    def numpy_column(self, name: str):
+        """
+        Returns a numeric column as a NumPy array sharing the memory of the snapshot (no copy).
+        """
+        import numpy
+        column = getattr(self, name)
+        return numpy.frombuffer(column, dtype=numpy.dtype(column.typecode if isinstance(column, array)
+                                                          else column.format))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate memory used by the columns (without the lists of directors and actors).
+        """
+        arrays = (self.years, self.runtimes, self.ratings, self.director_ids, self.cast_offsets, self.cast_ids)
+        ids = self.movie_ids.nbytes if self.movie_ids is not None else 0
+        return (self.titles.nbytes + self.imdb_ids.nbytes + ids
+                + sum(column.itemsize * len(column) for column in arrays))
+
+
+class MovieRow:
+    """View on one movie of a snapshot."""
+
+    __slots__ = ('_snapshot', '_index')
+
+    def __init__(self, snapshot: CatalogSnapshot, index: int):
+        self._snapshot = snapshot
+        self._index = index
+
+    @property
+    def title(self) -> str:
+        return self._snapshot.titles[self._index]
+
+    @property
+    def imdb_id(self) -> str:
+        return self._snapshot.imdb_ids[self._index]
+
+    @property
+    def year(self) -> int:
+        return self._snapshot.years[self._index]
+
+    @property
+    def runtime(self) -> Optional[int]:
+        runtime = self._snapshot.runtimes[self._index]
+        return runtime if runtime != MISSING_RUNTIME else None
+
+    @property
+    def rating(self) -> Optional[float]:
+        rating = self._snapshot.ratings[self._index]
+        return None if math.isnan(rating) else rating
+
+    @property
+    def director(self) -> str:
+        return self._snapshot.directors[self._snapshot.director_ids[self._index]]
+
+    @property
+    def cast_list(self) -> List[str]:
+        return self._snapshot.cast(self._index)
+
+    def __getattr__(self, field: str):
+        # long text fields, loaded on access
+        if field in LAZY_FIELDS:
+            return self._snapshot.load_text(self._index, field)
+        raise AttributeError(field)
+
+    def __repr__(self):
+        return f"MovieRow({self.title!r}, {self.year}, {self.director!r})"
+
+
+class DirectorRow:
+    """View on one director of a snapshot."""
+
+    __slots__ = ('_snapshot', '_id')
+
+    def __init__(self, snapshot: CatalogSnapshot, director_id: int):
+        self._snapshot = snapshot
+        self._id = director_id
+
+    @property
+    def name(self) -> str:
+        return self._snapshot.directors[self._id]
+
+    @property
+    def movie_count(self) -> int:
+        return len(self._snapshot.movies_of_director(self._id))
+
+    @property
+    def movies(self) -> Iterator[MovieRow]:
+        for index in self._snapshot.movies_of_director(self._id):
+            yield MovieRow(self._snapshot, index)
+
+    def __repr__(self):
+        return f"DirectorRow({self.name!r})"
@@ -0,0 +1,167 @@
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+from analytics.snapshot import MISSING_RUNTIME, CatalogSnapshot
+from models.records import ActorMovies, DirectorLength, DirectorMovieCount, DirectorRating
+
+'''
+In-process, vectorized versions of the Director and Movie aggregations, computed on a CatalogSnapshot.
+
+The group-by uses the integer ids of the snapshot with numpy.bincount, and the top-N selects the candidates
+with numpy.partition before sorting only them. Report jobs running many aggregations with different filters
+build the snapshot once and don't go back to mongod:
+
+    snapshot = CatalogSnapshot.from_collection()
+    nineties = snapshot_mask(snapshot, year_from=1990, year_to=1999)
+    top_rating(snapshot, 5, nineties)
+
+The results are ordered as the MongoDB queries: value descending (missing values last), then name.
+'''
+
+
+def snapshot_mask(snapshot: CatalogSnapshot, year_from: Optional[int] = None, year_to: Optional[int] = None,
+                  min_rating: Optional[float] = None, max_rating: Optional[float] = None,
+                  directors: Optional[Iterable[str]] = None) -> np.ndarray:
+    """
+    Returns the boolean mask of the movies matching the filters.
+    """
+    years = snapshot.numpy_column('years')
+    ratings = snapshot.numpy_column('ratings')
+    mask = np.ones(len(snapshot), dtype=bool)
+
+    if year_from is not None:
+        mask &= years >= year_from
+    if year_to is not None:
+        mask &= years <= year_to
+    if min_rating is not None:
+        mask &= ratings >= min_rating
+    if max_rating is not None:
+        mask &= ratings <= max_rating
+    if directors is not None:
+        director_ids = [snapshot.director_id(name) for name in directors if snapshot.director_id(name) is not None]
+        mask &= np.isin(snapshot.numpy_column('director_ids'), director_ids)
+    return mask
+
+
+def director_aggregates(snapshot: CatalogSnapshot, mask: Optional[np.ndarray] = None) -> dict:
+    """
+    Returns the stats of every director (arrays indexed by director id), as in the director_stats collection.
+    """
+    director_ids = snapshot.numpy_column('director_ids')
+    ratings = snapshot.numpy_column('ratings')
+    runtimes = snapshot.numpy_column('runtimes')
+    if mask is not None:
+        director_ids, ratings, runtimes = director_ids[mask], ratings[mask], runtimes[mask]
+
+    size = len(snapshot.directors)
+    has_rating = ~np.isnan(ratings)
+    has_runtime = runtimes != MISSING_RUNTIME
+
+    stats = {
+        'movie_count': np.bincount(director_ids, minlength=size),
+        'rating_sum': np.bincount(director_ids[has_rating], weights=ratings[has_rating], minlength=size),
+        'rating_count': np.bincount(director_ids[has_rating], minlength=size),
+        'runtime_sum': np.bincount(director_ids[has_runtime], weights=runtimes[has_runtime], minlength=size),
+        'runtime_count': np.bincount(director_ids[has_runtime], minlength=size),
+    }
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['avg_rating'] = np.where(stats['rating_count'] > 0, stats['rating_sum'] / stats['rating_count'], np.nan)
+        stats['avg_runtime'] = np.where(stats['runtime_count'] > 0, stats['runtime_sum'] / stats['runtime_count'],
+                                        np.nan)
+    return stats
+
+
+def top_n(values: np.ndarray, names: List[str], number: int, valid: np.ndarray,
+          after: Optional[tuple] = None) -> List[int]:
+    """
+    Returns the ids of the `number` first keys in the order (value descending with nan last, name).
+    after: (value, name) of the last key of the previous page, as the keyset pagination of the models
+    """
+    candidates = np.flatnonzero(valid)
+    # nan (no value) is sorted after all the values, as null in MongoDB
+    sort_values = np.where(np.isnan(values), -np.inf, values).astype(float)
+
+    if after is not None:
+        last_value, last_name = after
+        candidate_names = np.array([names[key] for key in candidates], dtype=object)
+        if last_value is None:
+            keep = np.isnan(values[candidates]) & (candidate_names > last_name)
+        else:
+            keep = (np.isnan(values[candidates]) | (sort_values[candidates] < last_value)
+                    | ((sort_values[candidates] == last_value) & (candidate_names > last_name)))
+        candidates = candidates[keep]
+
+    # only the keys which can be in the top are sorted, with all the ties of the last value
+    if len(candidates) > number > 0:
+        kth = len(candidates) - number
+        threshold = np.partition(sort_values[candidates], kth)[kth]
+        candidates = candidates[sort_values[candidates] >= threshold]
+
+    ordered = sorted(candidates.tolist(), key=lambda key: (-sort_values[key], names[key]))
+    return ordered[:number]
+
+
+def _value(value) -> Optional[float]:
+    return None if np.isnan(value) else float(value)
+
+
+def get_avg_rating(snapshot: CatalogSnapshot, director_name: str,
+                   mask: Optional[np.ndarray] = None) -> Optional[DirectorRating]:
+    director_id = snapshot.director_id(director_name)
+    if director_id is None:
+        return None
+    stats = director_aggregates(snapshot, mask)
+    if not stats['movie_count'][director_id]:
+        return None
+    return DirectorRating(director_name, _value(stats['avg_rating'][director_id]))
+
+
+def top_rating(snapshot: CatalogSnapshot, number: int, mask: Optional[np.ndarray] = None,
+               after: Optional[DirectorRating] = None) -> List[DirectorRating]:
+    stats = director_aggregates(snapshot, mask)
+    keys = top_n(stats['avg_rating'], snapshot.directors, number, stats['movie_count'] > 0,
+                 (after.avg_rating, after.name) if after else None)
+    return [DirectorRating(snapshot.directors[key], _value(stats['avg_rating'][key])) for key in keys]
+
+
+def top_avg_length(snapshot: CatalogSnapshot, number: int, mask: Optional[np.ndarray] = None,
+                   after: Optional[DirectorLength] = None) -> List[DirectorLength]:
+    stats = director_aggregates(snapshot, mask)
+    keys = top_n(stats['avg_runtime'], snapshot.directors, number, stats['movie_count'] > 0,
+                 (after.avg_length, after.name) if after else None)
+    return [DirectorLength(snapshot.directors[key], _value(stats['avg_runtime'][key])) for key in keys]
+
+
+def top_number_of_movies(snapshot: CatalogSnapshot, number: int, mask: Optional[np.ndarray] = None,
+                         after: Optional[DirectorMovieCount] = None) -> List[DirectorMovieCount]:
+    stats = director_aggregates(snapshot, mask)
+    counts = stats['movie_count'].astype(float)
+    keys = top_n(counts, snapshot.directors, number, counts > 0, (after.movie_count, after.name) if after else None)
+    return [DirectorMovieCount(snapshot.directors[key], int(counts[key])) for key in keys]
+
+
+def top_actors(snapshot: CatalogSnapshot, number: int, mask: Optional[np.ndarray] = None,
+               after: Optional[ActorMovies] = None) -> List[ActorMovies]:
+    """
+    Returns the `number` actors with the most movies, as Movie.top_number_of_films.
+    """
+    cast_ids = snapshot.numpy_column('cast_ids')
+    cast_offsets = snapshot.numpy_column('cast_offsets')
+    if mask is not None:
+        # the mask of the movies is repeated for each actor of their cast
+        cast_mask = np.repeat(mask, np.diff(cast_offsets))
+    else:
+        cast_mask = np.ones(len(cast_ids), dtype=bool)
+
+    counts = np.bincount(cast_ids[cast_mask], minlength=len(snapshot.actors)).astype(float)
+    keys = top_n(counts, snapshot.actors, number, counts > 0, (after.movie_count, after.name) if after else None)
+
+    result = []
+    for key in keys:
+        # movies of the actor: position in cast_ids -> position of the movie
+        positions = np.flatnonzero((cast_ids == key) & cast_mask)
+        movie_indexes = np.searchsorted(cast_offsets, positions, side='right') - 1
+        titles = sorted({snapshot.titles[index] for index in movie_indexes.tolist()})
+        result.append(ActorMovies(snapshot.actors[key], titles, int(counts[key])))
+    return result
@@ -0,0 +1,52 @@
+import json
+from argparse import ArgumentParser
+
+'''
+Compares two results of benchmarks.run (e.g. before and after a commit) and lists the regressions.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+
+The exit code is 1 if the import throughput or a query latency (p50 or p95) is worse by more than `threshold` percent.
+'''
+
+
+def compare(before: dict, after: dict, threshold: float = 10.0) -> list:
+    """
+    Prints the changes between two results and returns the list of regressions.
+    """
+    regressions = []
+
+    def check(name: str, old: float, new: float, higher_is_better: bool = False):
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold:
+            flag = '  <-- regression'
+            regressions.append(name)
+        print(f"{name:55} {old:12.2f} {new:12.2f} {change:+8.1f}%{flag}")
+
+    print(f"{'':55} {'before':>12} {'after':>12} {'change':>9}")
+    check('import rows/s', before['import']['rows_per_second'], after['import']['rows_per_second'],
+          higher_is_better=True)
+    for name, old in before['queries'].items():
+        new = after['queries'].get(name)
+        if new is None or 'error' in old or 'error' in new:
+            print(f"{name:55} {'not comparable':>35}")
+            continue
+        for percentile in ('p50_ms', 'p95_ms'):
+            check(f"{name} {percentile}", old[percentile], new[percentile])
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compares two results of the benchmarks")
+    parser.add_argument("before", help="json file of the reference results")
+    parser.add_argument("after", help="json file of the new results")
+    parser.add_argument("--threshold", type=float, default=10.0, help="tolerated slowdown in percent")
+    args = parser.parse_args()
+
+    with open(args.before) as before, open(args.after) as after:
+        regressions = compare(json.load(before), json.load(after), args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold}%")
+        raise SystemExit(1)
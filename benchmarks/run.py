@@ -0,0 +1,221 @@
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+import database_connection
+from aggregation.actor_stats import create_cast_indexes
+from aggregation.dashboard_report import dashboard_report
+from aggregation.director_stats import create_stats_indexes
+from aggregation.list_of_films import (create_director_key_index, log_director_changes, refresh_directors_movies,
+                                      save_directors_movies)
+from aggregation.movie_search import create_search_index
+from aggregation.year_rollups import period_stats, top_directors_of_period
+from benchmarks.synthetic import generate_catalog
+from database_connection import directors_coll, movies_coll
+from load_data import create_collections, import_csv
+from models.director import Director
+from models.movie import Movie
+from query_cache import query_cache
+
+'''
+Benchmarks of the import and of the queries, on a synthetic catalog.
+
+    python -m benchmarks.run --size 100000 --output before.json
+    python -m benchmarks.run --size 100000 --output after.json
+    python -m benchmarks.compare before.json after.json
+
+The benchmarks use their own database (cinema_benchmark by default), which is dropped first, on the server
+of the MONGO_URI setting. --in-memory runs them on mongomock instead, to check the harness without a server
+(its timings don't say anything about MongoDB, and the queries it doesn't support are reported as errors).
+
+The result is a json document: rows per second of the import, and p50 / p95 / p99 latency of each query
+in milliseconds. The query cache is emptied before each run, so the database is measured.
+The incremental refresh gets the same changes (the directors of DIRECTORS logged as changed) before each run,
+otherwise every run after the first one would find nothing to recompute.
+'''
+
+# names of the synthetic catalog: the first director and actor have the most movies
+DIRECTORS = ['Director 0', 'Director 1', 'Director 2']
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of the samples.
+    """
+    ordered = sorted(samples)
+    rank = max(int(round(percent / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def benchmark_queries() -> dict:
+    """
+    Returns the queries of the models and of list_of_films, by name.
+    """
+    director = Director(DIRECTORS[0])
+    return {
+        'director.get_avg_rating': director.get_avg_rating,
+        'director.get_movies': lambda: list(director.get_movies()),
+        'director.top_rating': lambda: list(Director.top_rating(10)),
+        'director.top_avg_lenght': lambda: list(Director.top_avg_lenght(10)),
+        'director.top_number_of_movies': lambda: list(Director.top_number_of_movies(10)),
+        'movie.top_number_of_films': lambda: list(Movie.top_number_of_films(15)),
+        'dashboard_report': lambda: dashboard_report(10, actors=15),
+        'year_rollups.period_stats': lambda: period_stats(1970, 1999),
+        'year_rollups.top_directors_of_period': lambda: top_directors_of_period(5, 'avg_rating', 1990, 1999),
+        'movie.search': lambda: list(Movie.search('space alien', limit=20, year_from=1990)),
+        'list_of_films.save_directors_movies': lambda: save_directors_movies(DIRECTORS, 'benchmark_directors_movies'),
+        'list_of_films.refresh_directors_movies': lambda: refresh_directors_movies(
+            output_collection='benchmark_directors_refresh'),
+    }
+
+
+def benchmark_setups() -> dict:
+    """
+    Returns the preparation of the queries which need one before each run (not measured), by name.
+    """
+    return {
+        'list_of_films.refresh_directors_movies': lambda: log_director_changes(DIRECTORS),
+    }
+
+
+def measure(query: Callable, repeat: int, warmup: int = 1, setup: Optional[Callable] = None) -> dict:
+    """
+    Runs a query `warmup` + `repeat` times and returns its latency percentiles in milliseconds.
+    setup: called before each run, out of the measure
+    """
+    samples = []
+    for run in range(warmup + repeat):
+        query_cache.invalidate()
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            query()
+        if run >= warmup:
+            samples.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'runs': repeat,
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+        'max_ms': max(samples),
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _prepare_database(database: str, in_memory: bool):
+    if in_memory:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("--in-memory needs mongomock: pip install -r requirements-dev.txt")
+        database_connection.configure(database=database)
+        database_connection.set_client(mongomock.MongoClient())
+    else:
+        database_connection.configure(database=database)
+        database_connection.get_client().drop_database(database)
+
+    with redirect_stdout(io.StringIO()):
+        if in_memory:
+            # mongomock has no validators, only the indexes are created
+            movies_coll.create_index([("title", 1), ("imdb_id", 1)], unique=True)
+            directors_coll.create_index("name", unique=True)
+            create_stats_indexes()
+            create_cast_indexes()
+            create_director_key_index()
+            create_search_index()
+        else:
+            create_collections()
+
+
+def run_benchmarks(size: int, repeat: int = 20, in_memory: bool = False, database: str = 'cinema_benchmark',
+                   csv_path: Optional[str] = None, workers: Optional[int] = None, batch_size: int = 1000,
+                   skew: float = 1.1, seed: int = 0) -> dict:
+    """
+    Imports a synthetic catalog of `size` movies, measures the queries and returns the results.
+    """
+    _prepare_database(database, in_memory)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = csv_path or os.path.join(directory, 'movies.csv')
+        if not csv_path:
+            generate_catalog(path, size, skew=skew, seed=seed)
+
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            totals = import_csv(path, batch_size=batch_size, workers=workers)
+        elapsed = time.perf_counter() - start
+        file_size = os.path.getsize(path)
+
+    rows = totals.inserted + totals.duplicates + totals.failed
+    results = {
+        'commit': _commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'backend': 'mongomock' if in_memory else database_connection.settings.uri,
+        'size': size,
+        'skew': skew,
+        'import': {
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed,
+            'megabytes_per_second': file_size / elapsed / 1e6,
+            'batch_size': batch_size,
+            'workers': workers or os.cpu_count(),
+        },
+        'queries': {},
+    }
+
+    setups = benchmark_setups()
+    for name, query in benchmark_queries().items():
+        try:
+            results['queries'][name] = measure(query, repeat, setup=setups.get(name))
+        except Exception as e:
+            # e.g. a stage or an operator which isn't supported by the server or by mongomock
+            results['queries'][name] = {'error': f"{type(e).__name__}: {e}"}
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks of the import and of the queries")
+    parser.add_argument("--size", type=int, default=10000, help="number of movies of the synthetic catalog")
+    parser.add_argument("--repeat", type=int, default=20, help="number of measured runs of each query")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock instead of a MongoDB server")
+    parser.add_argument("--database", default="cinema_benchmark", help="database of the benchmarks (dropped first)")
+    parser.add_argument("--csv", default=None, help="import this csv file instead of a synthetic one")
+    parser.add_argument("--workers", type=int, default=None, help="number of parsing processes of the import")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of rows sent in one bulk write")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of the directors and actors")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="json file of the results (printed by default)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.size, args.repeat, args.in_memory, args.database, args.csv, args.workers,
+                             args.batch_size, args.skew, args.seed)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+        print(f"Import: {results['import']['rows_per_second']:.0f} rows/s")
+        for name, result in results['queries'].items():
+            print(f"{name}: " + (result['error'] if 'error' in result
+                                 else f"p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms, "
+                                      f"p99 {result['p99_ms']:.2f} ms"))
+    else:
+        print(report)
@@ -0,0 +1,83 @@
+import csv
+import random
+from argparse import ArgumentParser
+from itertools import accumulate
+from typing import List, Optional
+
+'''
+Generator of synthetic movies csv files, in the format of the real one, for the benchmarks.
+
+The directors and the actors follow a Zipf distribution (a few of them have most of the movies, as in
+the real catalog), so the group-by and top-N queries meet the same skew as in production.
+
+    python -m benchmarks.synthetic movies_100k.csv --size 100000
+'''
+
+FIELDNAMES = ['Title', 'Year', 'Director', 'Cast', 'Summary', 'Short Summary', 'IMDB ID', 'Runtime',
+              'YouTube Trailer', 'Rating', 'Movie Poster', 'Writers']
+
+WORDS = ('love', 'war', 'night', 'city', 'dark', 'space', 'family', 'murder', 'secret', 'journey', 'king',
+         'island', 'ghost', 'summer', 'revenge', 'dream', 'river', 'heist', 'alien', 'detective', 'storm',
+         'music', 'prison', 'train', 'desert', 'winter', 'hunter', 'mirror', 'empire', 'shadow')
+
+
+def zipf_weights(count: int, skew: float) -> List[float]:
+    """
+    Returns the cumulated weights of `count` names, the name of rank r having a weight of 1 / r^skew.
+    """
+    return list(accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choices(WORDS, k=words))
+
+
+def generate_catalog(path: str, size: int, directors: Optional[int] = None, actors: Optional[int] = None,
+                     skew: float = 1.1, cast_size: int = 4, seed: int = 0) -> int:
+    """
+    Writes a csv file of `size` movies and returns its size in bytes.
+    directors, actors: number of distinct names (size / 10 and size / 4 by default)
+    """
+    rng = random.Random(seed)
+    directors = directors or max(size // 10, 1)
+    actors = actors or max(size // 4, cast_size)
+    director_weights = zipf_weights(directors, skew)
+    actor_weights = zipf_weights(actors, skew)
+    director_names, actor_names = range(directors), range(actors)
+
+    with open(path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+        for number in range(size):
+            # names are already title-cased, as the importer would store them
+            director = rng.choices(director_names, cum_weights=director_weights)[0]
+            cast = set(rng.choices(actor_names, cum_weights=actor_weights, k=cast_size))
+            writer.writerow([
+                f'{_sentence(rng, 2).title()} {number}',
+                rng.randint(1920, 2024),
+                f'Director {director}',
+                '|'.join(f'Actor {actor}' for actor in sorted(cast)),
+                _sentence(rng, 30),
+                _sentence(rng, 8),
+                f'tt{number:08d}',
+                rng.randint(70, 200),
+                f'https://www.youtube.com/watch?v={number}',
+                round(rng.uniform(1, 10), 1),
+                f'https://posters.example/{number}.jpg',
+                f'Writer {rng.randint(0, directors)}'
+            ])
+        return csvfile.tell()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generates a synthetic movies csv file")
+    parser.add_argument("path", help="path of the csv file")
+    parser.add_argument("--size", type=int, default=10000, help="number of movies")
+    parser.add_argument("--directors", type=int, default=None, help="number of directors (size / 10 by default)")
+    parser.add_argument("--actors", type=int, default=None, help="number of actors (size / 4 by default)")
+    parser.add_argument("--skew", type=float, default=1.1, help="exponent of the Zipf distribution of the names")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    written = generate_catalog(args.path, args.size, args.directors, args.actors, args.skew, seed=args.seed)
+    print(f"{args.size} movies have been written to {args.path} ({written} bytes).")
@@ -1,35 +1,193 @@
+import os
+from dataclasses import dataclass, fields, replace
+from threading import Lock
+from typing import Optional
+
 from pymongo import MongoClient
 
 
 '''
-First module to run
 This module is responsible for daily connection to the database
+
+The client is created lazily, at the first query, so importing this module (main.py, the import workers,
+the command line tools) does no network I/O. The client is created again in a forked process,
+as a MongoClient must not be shared between processes.
+
+The connection is configured with environment variables (or configure() before the first query):
+    MONGO_URI, MONGO_DATABASE, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_READ_PREFERENCE, MONGO_WRITE_CONCERN,
+    MONGO_PARTITION_URIS (servers of the partitions of the catalog, read by aggregation.scatter_gather)
+
+The collections, validators and indexes are created by an explicit command:
+    python load_data.py --init
 '''
-# connection with the local server on the port 27017 (default)
-client = MongoClient('localhost', 27017)
 
-# connection with the database (created already in mongodb)
-cinema_db = client['cinema']
 
-# connection with the collections
-movies_coll = cinema_db["movies"]
-directors_coll = cinema_db["directors"]
+@dataclass(frozen=True)
+class ConnectionSettings:
+    """Settings of the MongoDB client."""
+
+    uri: str = 'mongodb://localhost:27017'  # connection with the local server on the port 27017 (default)
+    database: str = 'cinema'
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    connect_timeout_ms: int = 20000
+    server_selection_timeout_ms: int = 30000
+    socket_timeout_ms: Optional[int] = None
+    read_preference: str = 'primary'
+    write_concern: str = '1'  # number of nodes or 'majority'
+    partition_uris: str = ''  # servers of the partitions of the catalog (comma separated), for scatter-gather
+
+    @classmethod
+    def from_env(cls) -> 'ConnectionSettings':
+        """
+        Reads the settings from the MONGO_* environment variables, with the defaults above.
+        """
+        values = {}
+        for setting in fields(cls):
+            value = os.environ.get(f'MONGO_{setting.name.upper()}')
+            if value is None:
+                continue
+            values[setting.name] = value if setting.name in ('uri', 'database', 'read_preference', 'write_concern',
+                                                             'partition_uris') else int(value)
+        return cls(**values)
+
+    def client_options(self) -> dict:
+        """
+        Returns the options of MongoClient.
+        """
+        return {
+            'maxPoolSize': self.max_pool_size,
+            'minPoolSize': self.min_pool_size,
+            'connectTimeoutMS': self.connect_timeout_ms,
+            'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+            'socketTimeoutMS': self.socket_timeout_ms,
+            'readPreference': self.read_preference,
+            'w': int(self.write_concern) if self.write_concern.isdigit() else self.write_concern,
+        }
+
+
+settings = ConnectionSettings.from_env()
+
+_client = None
+_client_pid = None
+_partition_clients = None  # clients of the partitions, created at the first scatter-gather query
+_partition_pid = None
+_lock = Lock()
+
+
+def configure(**overrides):
+    """
+    Changes the settings of the connection, e.g. configure(uri='mongodb://db:27017', max_pool_size=20).
+    The current client is closed, the next query creates a new one.
+    """
+    global settings, _client, _partition_clients
+    with _lock:
+        settings = replace(settings, **overrides)
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        if _partition_clients is not None and _partition_pid == os.getpid():
+            for client in _partition_clients:
+                client.close()
+        _client = None
+        _partition_clients = None
+
+
+def set_client(client):
+    """
+    Uses an existing client for the current process instead of creating one (e.g. the in-memory stand-in
+    of the benchmarks). configure() goes back to a client created from the settings.
+    """
+    global _client, _client_pid
+    with _lock:
+        _client = client
+        _client_pid = os.getpid()
+
 
-# Function initailizing the collections in case they don't exist
-def initialize_collections():
-    if 'movies' not in cinema_db.list_collection_names():
-        cinema_db.create_collection('movies')
-    if 'directors' not in cinema_db.list_collection_names():
-        cinema_db.create_collection('directors')
+def get_client() -> MongoClient:
+    """
+    Returns the client of the current process, created at the first call.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            # a client inherited from the parent process isn't used after a fork
+            if _client is None or _client_pid != os.getpid():
+                _client = MongoClient(settings.uri, connect=False, **settings.client_options())
+                _client_pid = os.getpid()
+    return _client
 
-    # indexes creation
-    movies_coll.create_index([("title", 1), ("imdb_id", 1)], unique=True)
-    directors_coll.create_index("name", unique=True)
 
-# initializing collections
-initialize_collections()
+def get_database():
+    """
+    Returns the database of the application.
+    """
+    return get_client()[settings.database]
 
-print("The connection with the database has been established")
 
+def set_partition_clients(clients: list):
+    """
+    Uses existing clients as the partitions of the catalog (e.g. in-memory stand-ins) instead of partition_uris.
+    """
+    global _partition_clients, _partition_pid
+    with _lock:
+        _partition_clients = list(clients)
+        _partition_pid = os.getpid()
 
 
+def get_partitions() -> list:
+    """
+    Returns the database of the application on each partition of the catalog (empty if there are no partitions).
+    """
+    global _partition_clients, _partition_pid
+    if _partition_clients is None or _partition_pid != os.getpid():
+        with _lock:
+            if _partition_clients is None or _partition_pid != os.getpid():
+                uris = [uri.strip() for uri in settings.partition_uris.split(',') if uri.strip()]
+                _partition_clients = [MongoClient(uri, connect=False, **settings.client_options()) for uri in uris]
+                _partition_pid = os.getpid()
+    return [client[settings.database] for client in _partition_clients]
+
+
+class _LazyDatabase:
+    """Stands for the database until the first query, which creates the client."""
+
+    def __getattr__(self, attribute):
+        return getattr(get_database(), attribute)
+
+    def __getitem__(self, collection_name):
+        return get_database()[collection_name]
+
+    def __repr__(self):
+        return f"LazyDatabase({settings.database!r})"
+
+
+class _LazyCollection:
+    """Stands for a collection until the first query, which creates the client."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_database()[self.name], attribute)
+
+    def __getitem__(self, sub_collection_name):
+        return get_database()[self.name][sub_collection_name]
+
+    def __repr__(self):
+        return f"LazyCollection({self.name!r})"
+
+
+# connection with the database (created already in mongodb)
+cinema_db = _LazyDatabase()
+
+# connection with the collections
+movies_coll = _LazyCollection("movies")
+directors_coll = _LazyCollection("directors")
+metadata_coll = _LazyCollection("import_metadata")  # checkpoints of the incremental import
+director_stats_coll = _LazyCollection("director_stats")  # pre-computed stats per director
+actor_stats_coll = _LazyCollection("actor_stats")  # pre-computed movies per actor
+director_changes_coll = _LazyCollection("director_changes")  # directors whose movies changed, read by the refreshes
+movie_details_coll = _LazyCollection("movie_details")  # long text fields of the movies (split layout)
+year_rollups_coll = _LazyCollection("year_rollups")  # pre-computed stats per year
+year_director_rollups_coll = _LazyCollection("year_director_rollups")  # pre-computed stats per year and director
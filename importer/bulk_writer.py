@@ -0,0 +1,308 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import database_connection
+from aggregation.catalog_writes import movie_write_requests
+from aggregation.movie_details import details_request, split_document
+from importer.dedup import DuplicateFilter
+
+'''
+The module writes the mapped csv rows to the database in batches.
+
+Instead of two round-trips per movie (insert_one + update_one), one batch costs:
+1. one bulk_write of InsertOne requests for the movies
+2. one bulk_write of UpdateOne requests for the directors, one per director of the batch ($addToSet with $each),
+   or nothing if the directors are reconciled after the import (defer_directors), and one $pull per previous
+   director of the movies moved to another director
+3. with the split layout (aggregation.movie_details), one bulk_write of the long text fields of the written movies
+4. one bulk_write per derived collection, with the updates of aggregation.catalog_writes (same as the model
+   save methods): the director stats, the year rollups and the actor stats (one update per director, year or
+   actor of the batch), then the change log read by the refreshes
+'''
+
+# error code returned by MongoDB when the unique index rejects a document
+DUPLICATE_KEY_ERROR = 11000
+
+
+@dataclass
+class BatchReport:
+    """Result of writing one batch of movies to the database."""
+
+    batch_number: int
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    duplicates: int = 0
+    failed: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    def add(self, other: 'BatchReport'):
+        """
+        Adds the counters of another report (used for the totals of the whole import).
+        """
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+        self.duplicates += other.duplicates
+        self.failed += other.failed
+
+    def __str__(self):
+        changes = f"{self.updated} updated, {self.unchanged} unchanged, " if self.updated or self.unchanged else ""
+        return (f"Batch {self.batch_number}: {self.inserted} inserted, {changes}"
+                f"{self.duplicates} duplicates, {self.failed} failed")
+
+
+def group_by_director(rows: list) -> dict:
+    """
+    Groups the movie titles of a batch by director.
+    """
+    movies_by_director = {}
+    for row in rows:
+        movies_by_director.setdefault(row['director'], []).append(row['title'])
+    return movies_by_director
+
+
+class BatchWriter:
+    """
+    Writes batches of mapped movies to the movies and directors collections.
+
+    ordered=False lets MongoDB insert all valid documents of a batch even if some of them are duplicates.
+    ordered=True stops the batch at the first error; the rows after it are reported as failed.
+    upsert_changed=True (incremental import) upserts only the movies whose content_hash
+    differs from the stored one, instead of inserting every row.
+    stats_coll: the *director_stats* collection, updated with the written movies if given
+    changes_coll: the *director_changes* collection, where the directors of the written movies are logged if given
+    defer_directors=True doesn't update the directors collection: it is reconciled with the movies
+    in one pass after the import (aggregation.director_reconciliation)
+    duplicates: the DuplicateFilter removing the movies already imported (importer.dedup), sized for
+    a million rows by default
+    run_id: id of the incremental import run, saved as import_run on the written movies so a movie repeated
+    later in the file is a duplicate (a new id by default when upsert_changed=True)
+    details_coll: the *movie_details* collection, where the long text fields are written if given (split layout)
+    rollups_coll, director_rollups_coll: the *year_rollups* and *year_director_rollups* collections,
+    updated with the written movies if given
+    actor_stats_coll: the *actor_stats* collection, updated with the written movies if given
+    """
+
+    def __init__(self, movies_coll, directors_coll, ordered: bool = False, upsert_changed: bool = False,
+                 stats_coll=None, changes_coll=None, defer_directors: bool = False,
+                 duplicates: Optional[DuplicateFilter] = None, details_coll=None, rollups_coll=None,
+                 director_rollups_coll=None, actor_stats_coll=None, run_id=None):
+        self.movies_coll = movies_coll
+        self.directors_coll = directors_coll
+        self.details_coll = details_coll
+        # the given derived collections, by the name under which catalog_writes returns their updates
+        self.derived_colls = {
+            name: collection for name, collection in (
+                (database_connection.director_stats_coll.name, stats_coll),
+                (database_connection.year_rollups_coll.name, rollups_coll),
+                (database_connection.year_director_rollups_coll.name, director_rollups_coll),
+                (database_connection.actor_stats_coll.name, actor_stats_coll),
+                (database_connection.director_changes_coll.name, changes_coll),
+            ) if collection is not None
+        }
+        self.ordered = ordered
+        self.upsert_changed = upsert_changed
+        self.defer_directors = defer_directors
+        self.batch_number = 0
+        self.totals = BatchReport(batch_number=0)
+
+        self.run_id = run_id if run_id is not None or not upsert_changed else ObjectId()
+        # keys (imdb_id, title) already imported, in a fixed amount of memory
+        self.duplicates = duplicates or DuplicateFilter(movies_coll, run_id=self.run_id)
+
+    def write(self, rows: list, failed: int = 0) -> BatchReport:
+        """
+        Writes one batch of mapped rows and returns the report of the batch.
+        `failed` is the number of rows of the batch which could not be mapped before.
+        """
+        self.batch_number += 1
+        report = BatchReport(batch_number=self.batch_number, failed=failed)
+
+        # duplicates are removed before reaching the database
+        new_rows, report.duplicates = self.duplicates.split(rows)
+        if self.run_id is not None:
+            for row in new_rows:
+                row['import_run'] = self.run_id
+
+        # previous versions of the updated movies
+        replaced_movies = []
+        if self.upsert_changed:
+            written_rows = self._upsert_changed_movies(new_rows, report, replaced_movies)
+        else:
+            written_rows = self._insert_movies(new_rows, report)
+        self._write_details(written_rows, report)
+        self._update_directors(written_rows, replaced_movies, report)
+        self._update_derived(written_rows, replaced_movies, report)
+
+        self.totals.add(report)
+        return report
+
+    def _insert_movies(self, rows: list, report: BatchReport) -> list:
+        """
+        Inserts the movies with one bulk_write and returns the rows which were really inserted.
+        """
+        if not rows:
+            return []
+
+        movies = rows
+        if self.details_coll is not None:
+            # the id of the movie is known before the insert, to write its details under it
+            for row in rows:
+                row.setdefault('_id', ObjectId())
+            movies = [split_document(row)[0] for row in rows]
+
+        try:
+            self.movies_coll.bulk_write([InsertOne(movie) for movie in movies], ordered=self.ordered)
+            report.inserted += len(rows)
+            return rows
+        except BulkWriteError as bwe:
+            write_errors = bwe.details.get('writeErrors', [])
+
+        failed_indexes = set()
+        for error in write_errors:
+            failed_indexes.add(error['index'])
+            if error['code'] == DUPLICATE_KEY_ERROR:
+                report.duplicates += 1
+            else:
+                report.failed += 1
+                report.errors.append(f"{rows[error['index']]['title']}: {error['errmsg']}")
+
+        # in the ordered mode MongoDB doesn't try the rows after the first error
+        last_attempted = len(rows)
+        if self.ordered and write_errors:
+            last_attempted = min(failed_indexes) + 1
+            report.failed += len(rows) - last_attempted
+
+        inserted_rows = [row for index, row in enumerate(rows[:last_attempted]) if index not in failed_indexes]
+        report.inserted += len(inserted_rows)
+        return inserted_rows
+
+    def _upsert_changed_movies(self, rows: list, report: BatchReport, replaced_movies: list) -> list:
+        """
+        Upserts the movies which are new or whose content changed and returns them.
+        The stored hashes are read with one query on the (title, imdb_id) index.
+        The stored versions of the updated movies are added to `replaced_movies`.
+        """
+        if not rows:
+            return []
+
+        stored_movies = {
+            (movie.get('imdb_id'), movie['title']): movie
+            for movie in self.movies_coll.find(
+                {'title': {'$in': [row['title'] for row in rows]}},
+                {'title': 1, 'imdb_id': 1, 'content_hash': 1, 'director': 1, 'year': 1, 'rating': 1, 'runtime': 1,
+                 'cast_list': 1}
+            )
+        }
+
+        changed_rows = [row for row in rows
+                        if stored_movies.get((row['imdb_id'], row['title']), {}).get('content_hash') != row['content_hash']]
+        report.unchanged += len(rows) - len(changed_rows)
+        if not changed_rows:
+            return []
+
+        requests = []
+        for row in changed_rows:
+            update = {'$set': row}
+            if self.details_coll is not None:
+                stored_movie = stored_movies.get((row['imdb_id'], row['title']))
+                row['_id'] = stored_movie['_id'] if stored_movie else ObjectId()
+                movie = split_document(row)[0]
+                del movie['_id']
+                update = {'$set': movie, '$setOnInsert': {'_id': row['_id']}}
+            requests.append(UpdateOne({'title': row['title'], 'imdb_id': row['imdb_id']}, update, upsert=True))
+
+        failed_indexes = set()
+        try:
+            self.movies_coll.bulk_write(requests, ordered=self.ordered)
+        except BulkWriteError as bwe:
+            for error in bwe.details.get('writeErrors', []):
+                failed_indexes.add(error['index'])
+                report.errors.append(f"{changed_rows[error['index']]['title']}: {error['errmsg']}")
+            if self.ordered and failed_indexes:
+                failed_indexes.update(range(min(failed_indexes), len(changed_rows)))
+        report.failed += len(failed_indexes)
+
+        written_rows = []
+        for index, row in enumerate(changed_rows):
+            if index in failed_indexes:
+                continue
+            written_rows.append(row)
+            stored_movie = stored_movies.get((row['imdb_id'], row['title']))
+            if stored_movie:
+                replaced_movies.append(stored_movie)
+                report.updated += 1
+            else:
+                report.inserted += 1
+        return written_rows
+
+    def _write_details(self, rows: list, report: BatchReport):
+        """
+        Writes the long text fields of the written movies to *movie_details* (split layout only).
+        """
+        if self.details_coll is None:
+            return
+
+        requests = [request for request in (details_request(row['_id'], split_document(row)[1]) for row in rows)
+                    if request is not None]
+        if not requests:
+            return
+
+        try:
+            self.details_coll.bulk_write(requests, ordered=False)
+        except BulkWriteError as bwe:
+            for error in bwe.details.get('writeErrors', []):
+                report.errors.append(f"Movie details write failed: {error['errmsg']}")
+
+    def _update_directors(self, rows: list, replaced_movies: list, report: BatchReport):
+        """
+        Adds the written movies to their directors, one upsert per director of the batch,
+        and removes the movies moved to another director from their previous director.
+        """
+        # the replaced movies are the stored versions of written rows, with the same (imdb_id, title)
+        new_directors = {(row.get('imdb_id'), row['title']): row['director'] for row in rows}
+        moved_movies = [movie for movie in replaced_movies if movie.get('director')
+                        and movie['director'] != new_directors[(movie.get('imdb_id'), movie['title'])]]
+        requests = [
+            UpdateOne({"name": director_name}, {"$pull": {"movies": {"$in": titles}}})
+            for director_name, titles in group_by_director(moved_movies).items()
+        ]
+        # the reconciliation after the import only adds titles, the moved movies are removed in any case
+        if not self.defer_directors:
+            requests += [
+                UpdateOne(
+                    {"name": director_name},
+                    {"$addToSet": {"movies": {"$each": titles}}},
+                    upsert=True
+                )
+                for director_name, titles in group_by_director(rows).items()
+            ]
+        if not requests:
+            return
+
+        try:
+            self.directors_coll.bulk_write(requests, ordered=False)
+        except BulkWriteError as bwe:
+            for error in bwe.details.get('writeErrors', []):
+                report.errors.append(f"Director update failed: {error['errmsg']}")
+
+    def _update_derived(self, rows: list, replaced_movies: list, report: BatchReport):
+        """
+        Applies the written movies to the derived collections, one bulk_write per collection.
+        """
+        if not self.derived_colls or not rows:
+            return
+
+        for name, requests in movie_write_requests(added=rows, removed=replaced_movies).items():
+            if name not in self.derived_colls:
+                continue
+            try:
+                self.derived_colls[name].bulk_write(requests, ordered=False)
+            except BulkWriteError as bwe:
+                for error in bwe.details.get('writeErrors', []):
+                    report.errors.append(f"Update of {name} failed: {error['errmsg']}")
@@ -0,0 +1,67 @@
+import hashlib
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Optional
+
+from bson import ObjectId
+
+'''
+The module keeps the checkpoints of the incremental import in a metadata collection.
+
+A checkpoint is saved after every chunk written to the database:
+    - fingerprint: hash of the content of the csv file
+    - offset: byte offset of the first row which isn't in the database yet
+    - rows_committed: number of rows written so far
+    - run_id: id of the import run, kept when the import is resumed (see importer.dedup)
+'''
+
+
+@dataclass
+class Checkpoint:
+    """Progress of the import of one csv file."""
+
+    path: str
+    fingerprint: str
+    offset: int = 0
+    rows_committed: int = 0
+    completed: bool = False
+    run_id: ObjectId = field(default_factory=ObjectId)
+
+
+def file_fingerprint(path: str, block_size: int = 1024 * 1024) -> str:
+    """
+    Returns the sha256 of the file content, read by blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as csvfile:
+        for block in iter(lambda: csvfile.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_checkpoint(metadata_coll, path: str) -> Optional[Checkpoint]:
+    """
+    Returns the last checkpoint saved for the file, or None if it has never been imported.
+    """
+    document = metadata_coll.find_one({'_id': os.path.abspath(path)})
+    if not document:
+        return None
+    return Checkpoint(
+        path=document['_id'],
+        fingerprint=document['fingerprint'],
+        offset=document['offset'],
+        rows_committed=document['rows_committed'],
+        completed=document['completed'],
+        run_id=document.get('run_id') or ObjectId()
+    )
+
+
+def save_checkpoint(metadata_coll, checkpoint: Checkpoint):
+    """
+    Saves the checkpoint (one document per csv file).
+    """
+    document = asdict(checkpoint)
+    document['_id'] = os.path.abspath(document.pop('path'))
+    document['updated_at'] = datetime.now(timezone.utc)
+    metadata_coll.replace_one({'_id': document['_id']}, document, upsert=True)
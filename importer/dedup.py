@@ -0,0 +1,136 @@
+import hashlib
+import math
+from typing import List, Tuple
+
+'''
+The module detects the duplicate movies of an import with a fixed amount of memory.
+
+Instead of a set of all the keys (imdb_id, title) seen in the file, which grows with the file,
+the keys go through a Bloom filter sized once from the expected number of rows:
+    - a key which isn't in the filter is new (no false negative), nothing is queried
+    - a key which may be in the filter (a duplicate, or a false positive at the configured rate)
+      is checked exactly with one query per batch on the unique (title, imdb_id) index
+
+Seeded with the keys of the movies collection, the filter also recognizes the movies imported before,
+which then aren't sent to the database only to be rejected by the unique index.
+
+The incremental import updates the movies imported before, so only the movies written by the same import
+are duplicates: it tags the written movies with the id of its run (import_run), and the exact check
+only looks for the movies of this run.
+'''
+
+
+class BloomFilter:
+    """Set of strings with false positives at a chosen rate, in a fixed number of bits."""
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01):
+        if capacity <= 0:
+            raise ValueError("The capacity of the filter must be a positive number")
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("The false positive rate must be between 0 and 1")
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))  # bits
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> List[int]:
+        # double hashing: the k positions come from the two halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hash_count)]
+
+    def add(self, key: str) -> bool:
+        """
+        Adds the key and returns True if it may have been added before.
+        """
+        present = True
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] >> bit & 1:
+                present = False
+                self.bits[byte] |= 1 << bit
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position // 8] >> (position % 8) & 1 for position in self._positions(key))
+
+    def __len__(self) -> int:
+        # number of distinct keys added (keys taken for false positives aren't counted)
+        return self.count
+
+
+def movie_key(row: dict) -> str:
+    """
+    Returns the key of a movie in the filter, the fields of the unique index.
+    """
+    return f"{row.get('imdb_id')}\x1f{row['title']}"
+
+
+class DuplicateFilter:
+    """
+    Removes the movies already imported from the batches: the ones seen earlier in the file
+    and, if seeded, the ones already in the movies collection.
+
+    expected_rows: number of movies the filter is sized for (more rows only raise the rate of exact checks)
+    run_id: id of the incremental import run: only the stored movies tagged with it (import_run) are duplicates,
+    the other ones are passed on to be compared with the row
+    """
+
+    def __init__(self, movies_coll, expected_rows: int = 1000000, false_positive_rate: float = 0.01,
+                 run_id=None):
+        self.movies_coll = movies_coll
+        self.run_id = run_id
+        self.filter = BloomFilter(expected_rows, false_positive_rate)
+        self.exact_checks = 0  # possible duplicates checked in the database
+        self.false_positives = 0  # possible duplicates which weren't imported before (by this run if run_id)
+
+    def seed(self, batch_size: int = 10000) -> int:
+        """
+        Adds the keys of the movies collection to the filter (read from the unique index only) and returns their number.
+        """
+        cursor = self.movies_coll.find({}, {'_id': 0, 'title': 1, 'imdb_id': 1}) \
+            .hint([('title', 1), ('imdb_id', 1)]).batch_size(batch_size)
+        seeded = 0
+        for movie in cursor:
+            self.filter.add(movie_key(movie))
+            seeded += 1
+        return seeded
+
+    def split(self, rows: list) -> Tuple[list, int]:
+        """
+        Returns the new rows of a batch and the number of duplicates removed.
+        """
+        batch_keys = set()
+        candidates = []  # (row, may be a duplicate), in the order of the batch
+        duplicates = 0
+        for row in rows:
+            key = movie_key(row)
+            if key in batch_keys:
+                duplicates += 1
+                continue
+            batch_keys.add(key)
+            candidates.append((row, self.filter.add(key)))
+
+        stored = set()
+        possible_titles = [row['title'] for row, possible in candidates if possible]
+        if possible_titles:
+            self.exact_checks += len(possible_titles)
+            query = {'title': {'$in': possible_titles}}
+            if self.run_id is not None:
+                query['import_run'] = self.run_id
+            stored = {movie_key(movie) for movie in self.movies_coll.find(query, {'_id': 0, 'title': 1, 'imdb_id': 1})}
+
+        new_rows = []
+        for row, possible in candidates:
+            if possible:
+                if movie_key(row) in stored:
+                    duplicates += 1
+                    continue
+                self.false_positives += 1
+            new_rows.append(row)
+        return new_rows, duplicates
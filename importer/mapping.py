@@ -0,0 +1,81 @@
+import hashlib
+import json
+
+'''
+The module maps the rows of the csv file to the MongoDB schema.
+
+It doesn't import the database connection, so it can be loaded by the worker processes of the importer.
+'''
+
+
+def split_cast(cast: str) -> list:
+    """
+    Splits the cast (actors separated by |) into a list of trimmed names, without empty names or repetitions.
+    Stored next to `cast` in the cast_list field, which has a multikey index.
+    """
+    actors = []
+    for actor in (cast or '').split('|'):
+        actor = actor.strip()
+        if actor and actor not in actors:
+            actors.append(actor)
+    return actors
+
+
+def director_key(name: str) -> str:
+    """
+    Returns the normalized name of a director (case folded, single spaces) stored in the director_key field.
+    Exact lookups on its index replace the case-insensitive regex searches.
+    """
+    return ' '.join((name or '').split()).casefold()
+
+
+# creating a mapping function
+'''
+Maps the CSV row fields to the corresponding MongoDB schema fields.
+
+Data normalization and data cleaning:
+    - casts the year, the runtime and the rating
+    - trims the white space
+    - provides consistent formatting, such as capitalizing the cast and the summaries
+The title, the director and the split cast are validated and formatted by Movie.from_rows, with the rules of Movie
+(the importer converts a whole chunk of rows with one call, see importer.parallel_csv).
+'''
+def csv_movie_fields(row) -> dict:
+    """
+    Returns the fields of a Movie for a CSV row. Raises ValueError if a number can't be parsed.
+    """
+    return {
+        'title': row.get('Title', ''),
+        'year': int(row.get('Year', 0)),
+        'director': row.get('Director', ''),
+        'cast': row.get('Cast', '').strip().title(),
+        'summary': row.get('Summary', '').strip().capitalize(),
+        'short_summary': row.get('Short Summary', '').strip().capitalize(),
+        'imdb_id': row.get('IMDB ID', '').strip(),
+        'runtime': int(row.get('Runtime', '').strip()),
+        'youtube_trailer': row.get('YouTube Trailer', '').strip(),
+        'rating': float(row.get('Rating', '').strip()),
+        'movie_poster': row.get('Movie Poster', '').strip(),
+        'writers': row.get('Writers', '').strip().title()
+    }
+
+
+def map_csv_movie(row) -> dict:
+    """
+    Returns the document of one CSV row. Raises ValueError if the row is invalid.
+    """
+    from models.movie import Movie  # models.movie imports this module
+
+    batch = Movie.from_rows([csv_movie_fields(row)])
+    if batch.errors:
+        raise ValueError(batch.errors[0][1])
+    return batch.documents[0]
+
+
+def content_hash(movie: dict) -> str:
+    """
+    Returns a hash of the content of a mapped movie.
+    The incremental import compares it with the stored one to update only the movies which changed.
+    """
+    content = {key: value for key, value in movie.items() if key not in ('_id', 'content_hash')}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
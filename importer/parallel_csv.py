@@ -0,0 +1,128 @@
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from csv import DictReader, reader
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+from importer.mapping import content_hash, csv_movie_fields
+from models.movie import Movie
+
+'''
+The module parses and normalizes the csv file in parallel.
+
+1. the main process splits the file into byte ranges ending on a record boundary
+2. a pool of processes parses and maps (csv_movie_fields + Movie.from_rows + content_hash) each range
+3. the parsed chunks are given back in the order of the file to a single writer
+
+Only `max_in_flight` chunks are submitted at the same time, so the memory doesn't grow with the size of the file.
+'''
+
+# default size of one chunk of the file
+CHUNK_BYTES = 4 * 1024 * 1024
+
+
+@dataclass
+class ParsedChunk:
+    """Normalized rows of one byte range [start, end) of the csv file."""
+
+    start: int
+    end: int
+    rows: List[dict] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+
+def read_header(path: str) -> tuple:
+    """
+    Returns the column names of the csv file and the byte offset of the first record.
+    """
+    with open(path, "rb") as csvfile:
+        header = csvfile.readline()
+    fieldnames = next(reader([header.decode("utf-8-sig")]))
+    return fieldnames, len(header)
+
+
+def split_chunks(path: str, start: int, chunk_bytes: int = CHUNK_BYTES) -> Iterator[tuple]:
+    """
+    Yields (start, end) byte ranges of about `chunk_bytes` bytes.
+
+    A range only ends on a new line which is outside of a quoted field,
+    so a summary written on many lines is never cut in two.
+    """
+    with open(path, "rb") as csvfile:
+        csvfile.seek(start)
+        chunk_start, position, quotes = start, start, 0
+
+        for line in csvfile:
+            position += len(line)
+            quotes += line.count(b'"')
+
+            # an even number of quotes means that the line ends a record
+            if quotes % 2 == 0 and position - chunk_start >= chunk_bytes:
+                yield chunk_start, position
+                chunk_start, quotes = position, 0
+
+        if position > chunk_start:
+            yield chunk_start, position
+
+
+def parse_chunk(path: str, start: int, end: int, fieldnames: list) -> ParsedChunk:
+    """
+    Reads one byte range of the file and maps its rows. Runs in a worker process.
+    """
+    with open(path, "rb") as csvfile:
+        csvfile.seek(start)
+        data = csvfile.read(end - start).decode("utf-8")
+
+    chunk = ParsedChunk(start=start, end=end)
+    rows, movie_fields = [], []
+    for row in DictReader(io.StringIO(data, newline=""), fieldnames=fieldnames):
+        try:
+            movie_fields.append(csv_movie_fields(row))
+        except ValueError as e:
+            chunk.errors.append(f"Invalid row {row.get('Title', '')}: {e}")
+            continue
+        rows.append(row)
+
+    # the rows of the chunk are validated and formatted at once, with the rules of Movie
+    batch = Movie.from_rows(movie_fields)
+    chunk.errors.extend(f"Invalid row {rows[position].get('Title', '')}: {message}"
+                        for position, message in batch.errors)
+    for movie in batch.documents:
+        # hashing here keeps the cpu work of the incremental import in the workers
+        movie['content_hash'] = content_hash(movie)
+        chunk.rows.append(movie)
+    return chunk
+
+
+def parse_csv(path: str, start: Optional[int] = None, workers: Optional[int] = None,
+              chunk_bytes: int = CHUNK_BYTES, max_in_flight: Optional[int] = None) -> Iterator[ParsedChunk]:
+    """
+    Yields the parsed chunks of the csv file in the order of the file.
+
+    start: byte offset of the first record to read (the first record after the header by default)
+    workers: number of worker processes, 1 parses in the current process
+    max_in_flight: number of chunks submitted to the pool at the same time (2 per worker by default)
+    """
+    fieldnames, first_record = read_header(path)
+    ranges = split_chunks(path, start if start is not None else first_record, chunk_bytes)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk_start, chunk_end in ranges:
+            yield parse_chunk(path, chunk_start, chunk_end, fieldnames)
+        return
+
+    max_in_flight = max_in_flight or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for chunk_start, chunk_end in ranges:
+            in_flight.append(pool.submit(parse_chunk, path, chunk_start, chunk_end, fieldnames))
+
+            # waiting for the oldest chunk keeps the order of the file and bounds the memory
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
@@ -0,0 +1,425 @@
+import logging
+import threading
+import time
+from argparse import ArgumentParser
+from bisect import bisect_left
+from collections import deque
+from dataclasses import dataclass, field
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List, Optional
+
+from pymongo import monitoring
+
+import database_connection
+from query_cache import query_cache
+
+'''
+Instrumentation of the queries: latency, slow queries and query plans.
+
+    instrumentation.enable(slow_threshold_ms=200)
+    ... queries ...
+    print(instrumentation.metrics_text())
+
+Once enabled:
+    - a PyMongo command listener times every command sent to the server (by command and collection),
+      and logs the reads slower than the threshold with their filter or pipeline
+    - the model methods decorated with @instrumented are timed too (their lazy results until they are consumed),
+      and the commands they send are attributed to them in the slow query log
+    - explain_command() / explain() give the plan of a query: documents examined vs returned and the index used
+
+metrics_text() returns the counters in the Prometheus text format, start_metrics_server() serves them over HTTP.
+
+The plans of the main queries can be checked without running the application:
+    python -m instrumentation explain
+'''
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# commands whose filter or pipeline is kept for the slow query log
+READ_COMMANDS = ('find', 'aggregate', 'count', 'distinct')
+
+# plan stages reading an index instead of the whole collection
+INDEX_STAGES = ('IXSCAN', 'EXPRESS_IXSCAN', 'IDHACK', 'COUNT_SCAN', 'DISTINCT_SCAN', 'TEXT', 'TEXT_MATCH')
+
+slow_query_log = logging.getLogger('digicinema.slow_queries')
+
+
+class Histogram:
+    """Cumulative latency histogram, as a Prometheus histogram."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+@dataclass
+class SlowQuery:
+    """Read command slower than the threshold."""
+
+    command_name: str
+    collection: str
+    duration_ms: float
+    command: dict
+    query: Optional[str] = None  # model method which sent it
+
+
+@dataclass
+class QueryPlan:
+    """Summary of the explain output of a query."""
+
+    name: str
+    stages: List[str] = field(default_factory=list)
+    indexes: List[str] = field(default_factory=list)
+    docs_examined: int = 0
+    keys_examined: int = 0
+    returned: int = 0
+
+    @property
+    def index_used(self) -> bool:
+        return any(stage in INDEX_STAGES for stage in self.stages)
+
+    @property
+    def collection_scan(self) -> bool:
+        return 'COLLSCAN' in self.stages
+
+    def __str__(self):
+        access = f"index {', '.join(self.indexes)}" if self.index_used else 'no index'
+        scan = ', COLLECTION SCAN' if self.collection_scan else ''
+        return (f"{self.name}: {access}{scan}, {self.docs_examined} documents and {self.keys_examined} keys examined, "
+                f"{self.returned} returned")
+
+
+class Instrumentation:
+    """Counters of the queries of the process."""
+
+    def __init__(self, slow_threshold_ms: float = 100.0, max_slow_queries: int = 100):
+        self.enabled = False
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self.query_latency = {}  # model method -> Histogram
+        self.command_latency = {}  # (command, collection) -> Histogram
+        self.command_failures = {}  # (command, collection) -> count
+        self.slow_query_count = 0
+        self.plans = {}  # query name -> last QueryPlan
+        self._lock = threading.Lock()
+        self._context = threading.local()
+        self._listener = None
+
+    @property
+    def current_query(self) -> Optional[str]:
+        return getattr(self._context, 'query', None)
+
+    @current_query.setter
+    def current_query(self, name: Optional[str]):
+        self._context.query = name
+
+    def observe_query(self, name: str, seconds: float):
+        with self._lock:
+            self.query_latency.setdefault(name, Histogram()).observe(seconds)
+
+    def observe_command(self, command_name: str, collection: str, seconds: float, command: Optional[dict] = None,
+                        query: Optional[str] = None):
+        with self._lock:
+            self.command_latency.setdefault((command_name, collection), Histogram()).observe(seconds)
+            if command is None or seconds * 1000 < self.slow_threshold_ms:
+                return
+            slow_query = SlowQuery(command_name, collection, seconds * 1000, command, query)
+            self.slow_queries.append(slow_query)
+            self.slow_query_count += 1
+        slow_query_log.warning("Slow %s on %s (%.1f ms%s): %s", command_name, collection, seconds * 1000,
+                               f", {query}" if query else '', _query_part(command))
+
+    def observe_failure(self, command_name: str, collection: str):
+        with self._lock:
+            key = (command_name, collection)
+            self.command_failures[key] = self.command_failures.get(key, 0) + 1
+
+    def reset(self):
+        """
+        Clears the counters, the slow queries and the plans.
+        """
+        with self._lock:
+            self.query_latency.clear()
+            self.command_latency.clear()
+            self.command_failures.clear()
+            self.slow_queries.clear()
+            self.slow_query_count = 0
+            self.plans.clear()
+
+    def metrics_text(self) -> str:
+        """
+        Returns the counters in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            _histogram_lines(lines, 'digicinema_query_duration_seconds', 'Duration of the model queries',
+                             {(('query', name),): histogram for name, histogram in self.query_latency.items()})
+            _histogram_lines(lines, 'digicinema_command_duration_seconds', 'Duration of the MongoDB commands',
+                             {(('command', command), ('collection', collection)): histogram
+                              for (command, collection), histogram in self.command_latency.items()})
+
+            lines += ['# HELP digicinema_command_failures_total Failed MongoDB commands',
+                      '# TYPE digicinema_command_failures_total counter']
+            lines += [f'digicinema_command_failures_total{_labels((("command", command), ("collection", collection)))} '
+                      f'{count}' for (command, collection), count in self.command_failures.items()]
+            lines += ['# HELP digicinema_slow_queries_total Reads slower than the threshold',
+                      '# TYPE digicinema_slow_queries_total counter',
+                      f'digicinema_slow_queries_total {self.slow_query_count}']
+
+            for metric, attribute, help_text in (
+                    ('digicinema_query_docs_examined', 'docs_examined', 'Documents examined by the last plan'),
+                    ('digicinema_query_docs_returned', 'returned', 'Documents returned by the last plan'),
+                    ('digicinema_query_index_used', 'index_used', '1 if the last plan used an index')):
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge']
+                lines += [f'{metric}{_labels((("query", name),))} {int(getattr(plan, attribute))}'
+                          for name, plan in self.plans.items()]
+
+        for counter, value in query_cache.stats().items():
+            kind = 'gauge' if counter == 'size' else 'counter'
+            metric = f'digicinema_query_cache_{counter}' + ('_total' if kind == 'counter' else '')
+            lines += [f'# TYPE {metric} {kind}', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: tuple) -> str:
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _histogram_lines(lines: list, metric: str, help_text: str, histograms: dict):
+    lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+    for labels, histogram in histograms.items():
+        cumulated = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+            cumulated += count
+            lines.append(f'{metric}_bucket{_labels(labels + (("le", bound),))} {cumulated}')
+        lines.append(f'{metric}_sum{_labels(labels)} {histogram.sum}')
+        lines.append(f'{metric}_count{_labels(labels)} {histogram.count}')
+
+
+def _query_part(command: dict) -> dict:
+    # filter, sort or pipeline of a command, without the session and cluster fields
+    return {key: value for key, value in command.items()
+            if not key.startswith('$') and key not in ('lsid', 'txnNumber')}
+
+
+class _CommandTimer(monitoring.CommandListener):
+    """Times the commands sent by the clients created after enable()."""
+
+    def __init__(self, instrumentation: Instrumentation):
+        self.instrumentation = instrumentation
+        self._started = {}  # (connection, request id) -> (collection, command, model method)
+
+    def started(self, event):
+        if not self.instrumentation.enabled:
+            return
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        command = dict(event.command) if event.command_name in READ_COMMANDS else None
+        self._started[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else '', command, self.instrumentation.current_query)
+
+    def succeeded(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started:
+            collection, command, query = started
+            self.instrumentation.observe_command(event.command_name, collection, event.duration_micros / 1e6,
+                                                 command, query)
+
+    def failed(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started:
+            self.instrumentation.observe_failure(event.command_name, started[0])
+
+
+# counters of the process
+instrumentation = Instrumentation()
+
+
+def enable(slow_threshold_ms: Optional[float] = None):
+    """
+    Starts timing the commands and the model methods. The client is created again to use the listener.
+    """
+    if slow_threshold_ms is not None:
+        instrumentation.slow_threshold_ms = slow_threshold_ms
+    if instrumentation._listener is None:
+        instrumentation._listener = _CommandTimer(instrumentation)
+        monitoring.register(instrumentation._listener)
+        database_connection.configure()
+    instrumentation.enabled = True
+
+
+def disable():
+    """
+    Stops the timing (the listener stays registered but does nothing).
+    """
+    instrumentation.enabled = False
+
+
+def metrics_text() -> str:
+    return instrumentation.metrics_text()
+
+
+def _timed_iterator(iterator: Iterator, name: str, elapsed: float) -> Iterator:
+    # only the time spent in the iterator (fetching the results) is counted, not the time of the caller
+    try:
+        while True:
+            start = time.perf_counter()
+            previous, instrumentation.current_query = instrumentation.current_query, name
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                instrumentation.current_query = previous
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        instrumentation.observe_query(name, elapsed)
+
+
+def instrumented(name: str):
+    """
+    Times a query method while the instrumentation is enabled. Lazy results are timed until they are consumed.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            previous, instrumentation.current_query = instrumentation.current_query, name
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                instrumentation.current_query = previous
+            elapsed = time.perf_counter() - start
+
+            if isinstance(result, Iterator):
+                return _timed_iterator(result, name, elapsed)
+            instrumentation.observe_query(name, elapsed)
+            return result
+        return wrapper
+    return decorator
+
+
+def _plan_nodes(node, plan: QueryPlan, stats: list):
+    # walks the explain output (find, aggregate, sharded or not) looking for the plan stages and their statistics
+    if isinstance(node, dict):
+        if 'stage' in node:
+            if node['stage'] not in plan.stages:
+                plan.stages.append(node['stage'])
+            if node.get('indexName') and node['indexName'] not in plan.indexes:
+                plan.indexes.append(node['indexName'])
+        if isinstance(node.get('executionStats'), dict):
+            stats.append(node['executionStats'])
+        for value in node.values():
+            _plan_nodes(value, plan, stats)
+    elif isinstance(node, list):
+        for value in node:
+            _plan_nodes(value, plan, stats)
+
+
+def explain_command(command: dict, name: Optional[str] = None) -> QueryPlan:
+    """
+    Explains a command (e.g. the `command` of a SlowQuery) and keeps its plan in the metrics.
+    """
+    command = _query_part(command)
+    if 'aggregate' in command:
+        command.setdefault('cursor', {})
+    name = name or f"{next(iter(command))} {command[next(iter(command))]}"
+    output = database_connection.get_database().command('explain', command, verbosity='executionStats')
+
+    plan, stats = QueryPlan(name), []
+    _plan_nodes(output, plan, stats)
+    plan.docs_examined = sum(stats_part.get('totalDocsExamined', 0) for stats_part in stats)
+    plan.keys_examined = sum(stats_part.get('totalKeysExamined', 0) for stats_part in stats)
+    plan.returned = stats[0].get('nReturned', 0) if stats else 0
+    with instrumentation._lock:
+        instrumentation.plans[name] = plan
+    return plan
+
+
+def explain(name: str, collection, pipeline: Optional[list] = None, query: Optional[dict] = None,
+            sort: Optional[dict] = None, limit: Optional[int] = None) -> QueryPlan:
+    """
+    Explains an aggregation (pipeline) or a find (query, sort, limit) on a collection.
+    """
+    if pipeline is not None:
+        return explain_command({'aggregate': collection.name, 'pipeline': pipeline}, name)
+    command = {'find': collection.name, 'filter': query or {}}
+    if sort:
+        command['sort'] = sort
+    if limit:
+        command['limit'] = limit
+    return explain_command(command, name)
+
+
+def explain_dashboard(director_names: tuple = ('Quentin Tarantino', 'Christopher Nolan')) -> List[QueryPlan]:
+    """
+    Explains the queries of main.py and prints their plans.
+    """
+    from aggregation.actor_stats import WITH_MOVIES as ACTORS_WITH_MOVIES
+    from aggregation.director_stats import WITH_MOVIES
+    from aggregation.list_of_films import directors_match
+    from database_connection import actor_stats_coll, director_stats_coll, directors_coll, movies_coll
+
+    plans = [
+        explain('Director.get_movies', directors_coll, query={'name': director_names[0]}),
+        explain('Director.get_avg_rating', director_stats_coll, query={'_id': director_names[0], **WITH_MOVIES}),
+        explain('Director.top_rating', director_stats_coll, query=WITH_MOVIES,
+                sort={'avg_rating': -1, '_id': 1}, limit=5),
+        explain('Director.top_number_of_movies', director_stats_coll, query=WITH_MOVIES,
+                sort={'movie_count': -1, '_id': 1}, limit=5),
+        explain('Movie.top_number_of_films', actor_stats_coll, query=ACTORS_WITH_MOVIES,
+                sort={'movie_count': -1, '_id': 1}, limit=15),
+        explain('save_directors_movies', movies_coll, pipeline=[{'$match': directors_match(director_names)}]),
+        explain('save_directors_movies (fuzzy)', movies_coll,
+                pipeline=[{'$match': directors_match(director_names, fuzzy=True)}]),
+    ]
+    for plan in plans:
+        print(plan)
+    return plans
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = 9100, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serves metrics_text() over HTTP in a background thread, for a Prometheus scraper.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Query plans of the main queries")
+    parser.add_argument("command", choices=["explain"])
+    args = parser.parse_args()
+
+    explain_dashboard()
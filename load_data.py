@@ -1,8 +1,26 @@
+import os
+from argparse import ArgumentParser
+from typing import Optional
+
 from pymongo.errors import CollectionInvalid, OperationFailure
 from tqdm import tqdm
-from csv import DictReader
 
-from database_connection import cinema_db, directors_coll, movies_coll
+from aggregation.actor_stats import create_cast_indexes
+from aggregation.director_reconciliation import reconcile_directors
+from aggregation.director_stats import create_stats_indexes
+from aggregation.list_of_films import create_director_key_index
+from aggregation.movie_details import split_layout
+from aggregation.movie_search import create_search_index
+from aggregation.year_rollups import create_rollup_indexes
+from database_connection import (actor_stats_coll, cinema_db, director_changes_coll, director_stats_coll,
+                                 directors_coll, metadata_coll, movie_details_coll, movies_coll,
+                                 year_director_rollups_coll, year_rollups_coll)
+from importer.bulk_writer import BatchReport, BatchWriter
+from importer.dedup import DuplicateFilter
+from importer.checkpoint import Checkpoint, file_fingerprint, load_checkpoint, save_checkpoint
+from importer.mapping import map_csv_movie  # still importable from load_data
+from importer.parallel_csv import CHUNK_BYTES, parse_csv
+from query_cache import query_cache
 
 '''
 This module initializes the dababases and creates collections for the first time 
@@ -29,11 +47,22 @@ movies_validator = {
       "director": {
         "bsonType": "string",
         "description": "must be a string and is required"
+      },
+      "director_key": {
+        "bsonType": "string",
+        "description": "normalized director name used by the indexed lookups"
       },
        "cast": {
         "bsonType": "string",
         "description": "must be a string if provided"
       },
+      "cast_list": {
+        "bsonType": "array",
+        "items": {
+          "bsonType": "string"
+        },
+        "description": "cast split into a list of actors"
+      },
       "summary": {
         "bsonType": "string",
         "description": "must be a string if provided"
@@ -65,6 +94,10 @@ movies_validator = {
       "writers": {
         "bsonType": "string",
         "description": "must be a string if provided"
+      },
+      "content_hash": {
+        "bsonType": "string",
+        "description": "hash of the imported content, used by the incremental import"
       }
     }
   }
@@ -118,6 +151,13 @@ def create_collections():
     # Ensure that the unique constraints are enforced
     movies_coll.create_index([("title", 1), ("imdb_id", 1)], unique=True)
     directors_coll.create_index("name", unique=True)
+    create_stats_indexes()
+    create_cast_indexes()
+    create_director_key_index()
+    create_search_index()
+    create_rollup_indexes()
+
+    print("The collections and indexes of the database are ready")
 
 '''
 Part 2: importing csv file from local + data cleaning and normalization
@@ -126,69 +166,185 @@ Part 2: importing csv file from local + data cleaning and normalization
 # defining the file path
 csv_path = r"C:\Users\filip\OneDrive\Pulpit\Diginamic\27 - MongoDB avec Python\movies.csv"
 
-# creating a mapping function
 '''
-Maps the CSV row fields to the corresponding MongoDB schema fields.
+Part 3: importing the csv file to the database in batches
 
-Data normalization and data cleaning:
-    - casts the year
-    - trims the white space
-    - provides consistent formatting, such as capitalizing the title and director names
+Data cleaning: duplicates removal (importer/dedup.py), in a fixed amount of memory
 '''
-def map_csv_movie(row):
-    return {
-        'title': row.get('Title', '').strip().title(),  # Normalizing title to lowercase
-        'year': int(row.get('Year', 0)),
-        'director': row.get('Director', '').strip().title(),
-        'cast': row.get('Cast', '').strip().title(),
-        'summary': row.get('Summary', '').strip().capitalize(),
-        'short_summary': row.get('Short Summary', '').strip().capitalize(),
-        'imdb_id': row.get('IMDB ID', '').strip(),
-        'runtime': int(row.get('Runtime', '').strip()),
-        'youtube_trailer': row.get('YouTube Trailer', '').strip(),
-        'rating': float(row.get('Rating', '').strip()),
-        'movie_poster': row.get('Movie Poster', '').strip(),
-        'writers': row.get('Writers', '').strip().title()
-    }
 
-'''
-Imports the csv file to the database
+# rough size of a row of the csv file, to size the duplicate filter from the size of the file
+ESTIMATED_ROW_BYTES = 300
 
-Data cleaning: duplicates removal
-'''
 
-if __name__ == "__main__":
+def duplicate_filter(expected_rows: int, false_positive_rate: float = 0.01, seed: bool = False,
+                     run_id=None) -> DuplicateFilter:
+    """
+    Returns the duplicate filter of an import, seeded with the keys of the movies collection if asked.
+    run_id: id of the incremental import run (see importer.dedup)
+    """
+    duplicates = DuplicateFilter(movies_coll, max(expected_rows, 1), false_positive_rate, run_id=run_id)
+    if seed:
+        print(f"{duplicates.seed()} movies of the database added to the duplicate filter.")
+    return duplicates
 
-    create_collections()
 
-    # creating the set to keep the duplicated movies
-    existing_movies = set()
+def import_csv(path: str, batch_size: int = 1000, ordered: bool = False, workers: Optional[int] = None,
+               chunk_bytes: int = CHUNK_BYTES, incremental: bool = False, defer_directors: bool = False,
+               expected_rows: Optional[int] = None, false_positive_rate: float = 0.01,
+               seed_duplicates: bool = False) -> BatchReport:
+    """
+    Imports the csv file with one bulk_write per batch for the movies, the directors and the director stats.
+
+    The file is parsed and normalized by `workers` processes, chunk by chunk, while
+    the batches are written by the current process in the order of the file.
+    Prints a report of inserted, duplicated and failed rows per batch.
+
+    incremental=True saves a checkpoint after every chunk:
+        - the same file is resumed from the last checkpoint (or skipped if it was fully imported)
+        - a changed file is read again, but only the new or changed movies are written
+
+    defer_directors=True doesn't update the directors collection batch by batch, but reconciles it
+    with the movies in one grouped pass at the end of the import.
+
+    expected_rows, false_positive_rate: size of the duplicate filter (estimated from the size of the file by default)
+    seed_duplicates=True adds the movies already in the database to the duplicate filter first
+    """
+    checkpoint = None
+    start = None
+
+    if incremental:
+        fingerprint = file_fingerprint(path)
+        checkpoint = load_checkpoint(metadata_coll, path)
+
+        if checkpoint and checkpoint.fingerprint == fingerprint:
+            if checkpoint.completed:
+                print(f"{path} has already been imported, nothing to do.")
+                return BatchReport(batch_number=0)
+            print(f"Resuming the import after {checkpoint.rows_committed} rows.")
+            start = checkpoint.offset
+        else:
+            checkpoint = Checkpoint(path=path, fingerprint=fingerprint)
 
-    # opening the file in the read mode, encoding utf-8
-    with open(csv_path, "r", encoding="utf-8") as csvfile:
-        movies_data = DictReader(csvfile)
+    # a resumed import keeps its run id: the movies written before the crash are still duplicates
+    run_id = checkpoint.run_id if checkpoint else None
+    duplicates = duplicate_filter(expected_rows or os.path.getsize(path) // ESTIMATED_ROW_BYTES,
+                                  false_positive_rate, seed_duplicates, run_id)
+    writer = BatchWriter(movies_coll, directors_coll, ordered=ordered, upsert_changed=incremental,
+                         stats_coll=director_stats_coll, changes_coll=director_changes_coll,
+                         defer_directors=defer_directors, duplicates=duplicates,
+                         details_coll=movie_details_coll if split_layout() else None,
+                         rollups_coll=year_rollups_coll, director_rollups_coll=year_director_rollups_coll,
+                         actor_stats_coll=actor_stats_coll, run_id=run_id)
 
-        for row in tqdm(movies_data, desc="Importing movies data", unit=" movies"):
-            mapped_row = map_csv_movie(row)
-            movie_key = (mapped_row['imdb_id'], mapped_row['title'])
+    with tqdm(total=os.path.getsize(path), initial=start or 0,
+              desc="Importing movies data", unit="B", unit_scale=True) as progress:
+        for chunk in parse_csv(path, start=start, workers=workers, chunk_bytes=chunk_bytes):
+            for error in chunk.errors:
+                tqdm.write(error)
 
-            if movie_key in existing_movies:
-                print(f"Duplicate found: {mapped_row['title']}, IMDb ID: {mapped_row['imdb_id']}")
-            else:
-                # Update the movies collection
-                movies_coll.insert_one(mapped_row)
-                existing_movies.add(movie_key)
+            # the rows which couldn't be mapped are reported with the first batch of the chunk
+            failed = len(chunk.errors)
+            for first_row in range(0, max(len(chunk.rows), 1), batch_size):
+                report = writer.write(chunk.rows[first_row:first_row + batch_size], failed=failed)
+                query_cache.invalidate()
+                failed = 0
+                tqdm.write(str(report))
+                for error in report.errors:
+                    tqdm.write(f"  - {error}")
 
-                # Update the directors collection as well
-                director_name = mapped_row['director']
-                movie_title = mapped_row['title']
+            # the chunk is committed: a crash after this point resumes from the next chunk
+            if checkpoint:
+                checkpoint.offset = chunk.end
+                checkpoint.rows_committed += len(chunk.rows) + len(chunk.errors)
+                save_checkpoint(metadata_coll, checkpoint)
 
-                directors_coll.update_one(
-                    {"name": director_name},
-                    {"$addToSet": {"movies": movie_title}},
-                    upsert=True
-                )
+            progress.update(chunk.end - chunk.start)
 
+    if checkpoint:
+        checkpoint.completed = True
+        save_checkpoint(metadata_coll, checkpoint)
+
+    if defer_directors:
+        reconcile_directors()
+
+    return writer.totals
+
+
+def import_catalog(path: str, batch_size: int = 1000, ordered: bool = False, defer_directors: bool = False,
+                   false_positive_rate: float = 0.01, seed_duplicates: bool = False) -> BatchReport:
+    """
+    Imports a catalog file (analytics/catalog_file.py) with the same batches as import_csv.
+    The movies of the file are already normalized, so there is nothing to parse.
+    """
+    from analytics.catalog_file import CatalogFile
+
+    with CatalogFile(path) as catalog, \
+            tqdm(total=len(catalog), desc="Importing movies data", unit="movies") as progress:
+        # the catalog knows its number of movies
+        duplicates = duplicate_filter(len(catalog), false_positive_rate, seed_duplicates)
+        writer = BatchWriter(movies_coll, directors_coll, ordered=ordered, stats_coll=director_stats_coll,
+                             changes_coll=director_changes_coll, defer_directors=defer_directors,
+                             duplicates=duplicates, details_coll=movie_details_coll if split_layout() else None,
+                             rollups_coll=year_rollups_coll, director_rollups_coll=year_director_rollups_coll,
+                             actor_stats_coll=actor_stats_coll)
+        batch = []
+        for movie in catalog.documents():
+            batch.append(movie)
+            if len(batch) == batch_size:
+                tqdm.write(str(writer.write(batch)))
+                query_cache.invalidate()
+                progress.update(len(batch))
+                batch = []
+        if batch:
+            tqdm.write(str(writer.write(batch)))
+            query_cache.invalidate()
+            progress.update(len(batch))
+
+    if defer_directors:
+        reconcile_directors()
+
+    return writer.totals
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Imports the movies csv file to the database")
+    parser.add_argument("csv_path", nargs="?", default=csv_path, help="path to the csv file")
+    parser.add_argument("--init", action="store_true",
+                        help="only create the collections, validators and indexes, without importing")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of rows sent in one bulk write")
+    parser.add_argument("--ordered", action="store_true", help="stop each batch at its first error")
+    parser.add_argument("--workers", type=int, default=None, help="number of parsing processes (all cores by default)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_BYTES, help="size in bytes of the chunks parsed by the workers")
+    parser.add_argument("--incremental", action="store_true",
+                        help="resume from the last checkpoint and write only the new or changed movies")
+    parser.add_argument("--catalog", action="store_true",
+                        help="the file is a binary catalog (python -m analytics.catalog_file export) instead of a csv file")
+    parser.add_argument("--defer-directors", action="store_true",
+                        help="reconcile the directors collection at the end instead of updating it in every batch")
+    parser.add_argument("--expected-rows", type=int, default=None,
+                        help="rows the duplicate filter is sized for (estimated from the file size by default)")
+    parser.add_argument("--false-positive-rate", type=float, default=0.01,
+                        help="rate of the possible duplicates checked in the database which are new movies")
+    parser.add_argument("--seed-duplicates", action="store_true",
+                        help="add the movies already in the database to the duplicate filter before the import")
+    args = parser.parse_args()
+
+    create_collections()
+    if args.init:
+        raise SystemExit(0)
+
+    if args.catalog:
+        totals = import_catalog(args.csv_path, batch_size=args.batch_size, ordered=args.ordered,
+                                defer_directors=args.defer_directors, false_positive_rate=args.false_positive_rate,
+                                seed_duplicates=args.seed_duplicates)
+    else:
+        totals = import_csv(args.csv_path, batch_size=args.batch_size, ordered=args.ordered,
+                            workers=args.workers, chunk_bytes=args.chunk_size, incremental=args.incremental,
+                            defer_directors=args.defer_directors, expected_rows=args.expected_rows,
+                            false_positive_rate=args.false_positive_rate, seed_duplicates=args.seed_duplicates)
+    print(f"Import finished: {totals.inserted} inserted, {totals.updated} updated, {totals.unchanged} unchanged, "
+          f"{totals.duplicates} duplicates, {totals.failed} failed")
 
     # final message informing of the result
     if movies_coll.count_documents({}) != 0:
@@ -197,6 +353,3 @@ if __name__ == "__main__":
               f"{directors_coll.count_documents({})} directors ")
     elif movies_coll.count_documents({}) == 0:
         print("No movies has been added to the database")
-
-
-
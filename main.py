@@ -1,6 +1,7 @@
+from aggregation.dashboard_report import dashboard_report
 from aggregation.list_of_films import save_directors_movies
 from models.director import Director
-from models.movie import Movie
+from models.records import round_length
 
 # inserting David Lynch data as it's my favourite director. 5 random movies
 lynch = Director("David Lynch", {"Blue Velvet", "Mulholland Drive", "Twin Peaks", "The Elephant Man"})
@@ -15,27 +16,41 @@ save_directors_movies(directors, output_collection='tarantino_nolan')
 
 # TP: Implémenter la méthode permettant de lister les films d'un réalisateur
 # test
-lynch.get_movies()
+print(f"Movies directed by {lynch.name}:")
+for movie in lynch.get_movies():
+    print(f"- {movie}")
 
 # Implémenter la méthode permettant de connaitre la note moyenne d'un réalisateur (dans sa classe)
-lynch.get_avg_rating()
+avg_rating = lynch.get_avg_rating()
+if avg_rating:
+    print(f"The average rating of {avg_rating.name} is {avg_rating.avg_rating}")
+else:
+    print(f"No data found for director: {lynch.name}")
 
 # Implémenter la méthode d'ajout de film par interaction utilisateur
 #Movie.add_movie_by_user()
 
+# The statistics below are read from the pre-computed director and actor stats (aggregation.dashboard_report)
+report = dashboard_report(5, actors=15)
+
 # Lister les 5 réalisateurs les mieux notés
-# Comment: I gave the user an option to choose a number of directors they want to see
-Director.top_rating(5)
+print("\nTop 5 directors by average rating:")
+for i, director in enumerate(report.top_rating, start=1):
+    print(f"{i}. {director.name}, rating: {director.avg_rating}")
 
 # Les 5 réalisateurs dont les films ont la durée moyenne la plus importante
-# Comment: Again I gave a user an option to choose
-Director.top_avg_lenght(5)
+print("\nTop 5 directors by average lenght of the movies:")
+for i, director in enumerate(report.top_avg_length, start=1):
+    print(f"{i}. {director.name}, average length: {round_length(director.avg_length)} minutes")
 
 # Les 5 réalisateurs ayant le plus de films
-# Comment: Again I gave a user an option to choose
-Director.top_number_of_movies(5)
+print("\nTop 5 directors by number of movies:")
+for i, director in enumerate(report.top_number_of_movies, start=1):
+    print(f"{i}. {director.name}, {director.movie_count} films")
 
 # Requête d'agrégation : Le résultat de cette requête doit me donner la liste et le nombre de films
 # des 15 acteurs le splus présents (avec leurs films,cf screenshot ci-dessus)
-Movie.top_number_of_films(15)
-
+# Comment: Director.top_rating(5), Movie.top_number_of_films(5, after=...) etc. still answer one statistic at a time
+print("\nTop 15 of actors by number of appearances/films:")
+for actor in report.top_number_of_films:
+    print(f"Actor: {actor.name}, Movies: {actor.movies}, Total Movies: {actor.movie_count}")
@@ -0,0 +1,171 @@
+import asyncio
+import os
+import weakref
+from typing import List, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+import database_connection
+from aggregation.actor_stats import TOP_ACTORS_SORT, top_actors_query
+from aggregation.catalog_writes import director_write_requests, movie_write_requests
+from aggregation.director_stats import WITH_MOVIES
+from aggregation.movie_details import details_request
+from aggregation.pagination import keyset_filter
+from database_connection import actor_stats_coll, director_stats_coll, directors_coll, movie_details_coll, movies_coll
+from models.director import Director
+from models.movie import Movie
+from models.records import ActorMovies, DirectorLength, DirectorMovieCount, DirectorRating
+from query_cache import query_cache
+
+'''
+Asynchronous (asyncio + motor) version of the queries of Director and Movie.
+
+The functions return typed records instead of printing, and can run concurrently on one event loop:
+    report = await dashboard("David Lynch")
+takes the time of the slowest query instead of the sum of all of them.
+
+The connection uses the same settings as database_connection (MONGO_* environment variables).
+'''
+
+# one client per event loop (a motor client is bound to the loop where it is used first)
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_database():
+    """
+    Returns the database of the application for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client, pid = _clients.get(loop, (None, None))
+    if client is None or pid != os.getpid():
+        settings = database_connection.settings
+        client = AsyncIOMotorClient(settings.uri, **settings.client_options())
+        _clients[loop] = (client, os.getpid())
+    return client[database_connection.settings.database]
+
+
+async def get_movies(director_name: str) -> List[str]:
+    """
+    Returns the titles of the movies of a director in alphabetical order (as Director.get_movies).
+    """
+    director_name = Director(director_name).name  # same validation and formatting of the name
+    director = await get_async_database()[directors_coll.name].find_one({'name': director_name}, {'movies': 1})
+    return sorted(director['movies']) if director else []
+
+
+async def get_avg_rating(director_name: str) -> Optional[DirectorRating]:
+    """
+    Returns the average rating of a director, or None if the director has no movies (as Director.get_avg_rating).
+    """
+    director_name = Director(director_name).name
+    stats = await get_async_database()[director_stats_coll.name].find_one(
+        {'_id': director_name, **WITH_MOVIES}, {'avg_rating': 1}
+    )
+    return DirectorRating(stats['_id'], stats['avg_rating']) if stats else None
+
+
+async def _top_directors(number: int, field: str, after: Optional[tuple] = None) -> list:
+    query = {**WITH_MOVIES, **keyset_filter(field, *after)} if after else WITH_MOVIES
+    cursor = get_async_database()[director_stats_coll.name].find(query, {field: 1}) \
+        .sort([(field, -1), ('_id', 1)]).limit(number)
+    return await cursor.to_list(length=number)
+
+
+async def top_rating(number: int, after: Optional[DirectorRating] = None) -> List[DirectorRating]:
+    last = (after.avg_rating, after.name) if after else None
+    return [DirectorRating(stats['_id'], stats['avg_rating'])
+            for stats in await _top_directors(number, 'avg_rating', last)]
+
+
+async def top_avg_length(number: int, after: Optional[DirectorLength] = None) -> List[DirectorLength]:
+    last = (after.avg_length, after.name) if after else None
+    return [DirectorLength(stats['_id'], stats['avg_runtime'])
+            for stats in await _top_directors(number, 'avg_runtime', last)]
+
+
+async def top_number_of_movies(number: int, after: Optional[DirectorMovieCount] = None) -> List[DirectorMovieCount]:
+    last = (after.movie_count, after.name) if after else None
+    return [DirectorMovieCount(stats['_id'], stats['movie_count'])
+            for stats in await _top_directors(number, 'movie_count', last)]
+
+
+async def top_number_of_films(number: int, after: Optional[ActorMovies] = None) -> List[ActorMovies]:
+    last = (after.movie_count, after.name) if after else None
+    cursor = get_async_database()[actor_stats_coll.name].find(top_actors_query(last)) \
+        .sort(TOP_ACTORS_SORT).limit(number)
+    return [ActorMovies(actor['_id'], actor['movies'], actor['movie_count'])
+            for actor in await cursor.to_list(length=number)]
+
+
+async def _apply_write_requests(db, requests: dict):
+    # same updates of the derived collections as the synchronous save methods (aggregation.catalog_writes)
+    for name, collection_requests in requests.items():
+        await db[name].bulk_write(collection_requests, ordered=False)
+
+
+async def save_director(director: Director) -> bool:
+    """
+    Saves the director (as Director.save_to_db). Returns True if the director already existed.
+    """
+    db = get_async_database()
+    result = await db[directors_coll.name].update_one(
+        {'name': director.name},
+        {'$addToSet': {'movies': {'$each': director.to_dict()['movies']}}},
+        upsert=True
+    )
+    await _apply_write_requests(db, director_write_requests(director.name))
+    query_cache.invalidate()
+    return result.upserted_id is None
+
+
+async def upsert_movie(movie: Movie) -> bool:
+    """
+    Adds or updates a movie (as Movie.add_movie_by_user). Returns True if the movie already existed.
+    """
+    db = get_async_database()
+    movie_dict, details = movie.to_documents()
+    movie_id = ObjectId()
+    previous = await db[movies_coll.name].find_one_and_update(
+        {'title': movie.title, 'director': movie.director, 'year': movie.year},
+        {'$set': movie_dict, '$setOnInsert': {'_id': movie_id}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    if details:
+        await db[movie_details_coll.name].bulk_write([details_request(previous['_id'] if previous else movie_id,
+                                                                      details)])
+
+    # the previous version of the movie is replaced in the derived collections (stats, rollups, change log)
+    added, removed = [{**(previous or {}), **movie.to_dict()}], [previous] if previous else []
+    await _apply_write_requests(db, movie_write_requests(added, removed))
+    query_cache.invalidate()
+    return previous is not None
+
+
+async def dashboard(director_name: str, number: int = 5, actors: int = 15) -> dict:
+    """
+    Runs the queries of main.py concurrently and returns their results.
+    """
+    movies, avg_rating, by_rating, by_length, by_count, by_actors = await asyncio.gather(
+        get_movies(director_name),
+        get_avg_rating(director_name),
+        top_rating(number),
+        top_avg_length(number),
+        top_number_of_movies(number),
+        top_number_of_films(actors)
+    )
+    return {
+        'movies': movies,
+        'avg_rating': avg_rating,
+        'top_rating': by_rating,
+        'top_avg_length': by_length,
+        'top_number_of_movies': by_count,
+        'top_number_of_films': by_actors
+    }
+
+
+if __name__ == "__main__":
+    for query, result in asyncio.run(dashboard("David Lynch")).items():
+        print(f"{query}: {result}")
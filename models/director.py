@@ -1,7 +1,39 @@
 from dataclasses import dataclass, field, asdict
-from typing import Set
+from typing import Iterator, Optional, Set
 
-from database_connection import directors_coll, movies_coll
+from aggregation.catalog_writes import apply_write_requests, director_write_requests
+from aggregation.director_stats import WITH_MOVIES
+from aggregation.pagination import keyset_filter
+from aggregation import scatter_gather
+from database_connection import director_stats_coll, directors_coll
+from instrumentation import instrumented
+from models.records import DirectorLength, DirectorMovieCount, DirectorRating
+from query_cache import cached_top_n, query_cache
+
+
+def _find_top_directors(number: int, field: str, after: Optional[tuple] = None, batch_size: Optional[int] = None):
+    # indexed query on director_stats (field, _id) instead of a $group over all the movies
+    query = {**WITH_MOVIES, **keyset_filter(field, *after)} if after else WITH_MOVIES
+    cursor = director_stats_coll.find(query, {field: 1}).sort([(field, -1), ('_id', 1)]).limit(number)
+    return cursor.batch_size(batch_size) if batch_size else cursor
+
+
+@cached_top_n('director_stats.top')
+def _cached_top_directors(number: int, field: str) -> list:
+    return list(_find_top_directors(number, field))
+
+
+def _top_directors(number: int, field: str, after: Optional[tuple], batch_size: Optional[int],
+                   partitions: Optional[list] = None):
+    """
+    The first page comes from the query cache, the next pages are read lazily from the server.
+    With partitions, the partial stats of every partition are merged (aggregation.scatter_gather).
+    """
+    if partitions is not None:
+        return iter(scatter_gather.top_directors(number, field, partitions, after))
+    if after is None and batch_size is None:
+        return iter(_cached_top_directors(number, field))
+    return _find_top_directors(number, field, after, batch_size)
 
 
 @dataclass
@@ -52,138 +84,100 @@ class Director:
             {'$addToSet': {'movies': {'$each': director_dict['movies']}}},
             upsert=True
         )
+        apply_write_requests(director_write_requests(self.name))
+        query_cache.invalidate()
         if result.modified_count > 0:
             return print(f"Data regarding {self.name} has been updated.")
 
         return print(f"Director {self.name} has been saved to database.")
 
     # funtion listing average rating of a director
-    def get_avg_rating(self):
-
-        pipeline = [
-            {
-                '$match': {
-                    'director': self.name
-                }
-            }, {
-                '$group': {
-                    '_id': '$director',
-                    'avg_rating': {
-                        '$avg': '$rating'
-                    }
-                }
-            }
-        ]
-
-        result = list(movies_coll.aggregate(pipeline))
+    @instrumented('Director.get_avg_rating')
+    def get_avg_rating(self, snapshot=None) -> Optional[DirectorRating]:
+        """
+        Returns the average rating of the director, or None if there is no movie of the director.
+        snapshot: CatalogSnapshot to compute it locally instead of querying MongoDB
+        """
+        if snapshot is not None:
+            from analytics import vectorized
+            return vectorized.get_avg_rating(snapshot, self.name)
 
-        # Print the result if it's not empty
-        if result:
-            # Access the first (and likely only) result
-            first_result = result[0]
-            print(f"The average rating of {first_result['_id']} is {first_result['avg_rating']}")
-        else:
-            print(f"No data found for director: {self.name}")
+        # read from the pre-computed stats of the director
+        result = director_stats_coll.find_one({'_id': self.name, **WITH_MOVIES}, {'avg_rating': 1})
+        return DirectorRating(result['_id'], result['avg_rating']) if result else None
 
     # Implémenter la méthode permettant de lister les films d'un réalisateur (dans sa classe)
-    def get_movies(self):
-
+    @instrumented('Director.get_movies')
+    def get_movies(self, number: Optional[int] = None, after: Optional[str] = None,
+                   batch_size: Optional[int] = None) -> Iterator[str]:
+        """
+        Returns the titles of the movies of the director in alphabetical order.
+        number: size of the page (all the movies by default)
+        after: last title of the previous page
+        """
         pipeline = [
-
-            {'$match': {'name': self.name}
-             },
-            {
-                '$project': {
-                    '_id': '$name',
-                    'movies': 1  # Include the movies array as is
-                }
-            }
+            {'$match': {'name': self.name}},
+            {'$project': {'_id': 0, 'movies': 1}},
+            {'$unwind': '$movies'},
         ]
+        if after is not None:
+            pipeline.append({'$match': {'movies': {'$gt': after}}})
+        pipeline.append({'$sort': {'movies': 1}})
+        if number:
+            pipeline.append({'$limit': number})
 
         # Execute the aggregation
-        result = directors_coll.aggregate(pipeline)
-
-        # Print the result in the desired format
-        for director in result:
-            print(f"Movies directed by {director['_id']}:")
-            for movie in director['movies']:
-                print(f"- {movie}")
+        options = {'batchSize': batch_size} if batch_size else {}
+        return (director['movies'] for director in directors_coll.aggregate(pipeline, **options))
 
     @staticmethod
-    def top_rating(number: int):
-
-        pipeline = [
-                {
-                    '$group': {
-                        '_id': '$director',
-                        'avg_rating': {
-                            '$avg': '$rating'
-                        }
-                    }
-                }, {
-                '$sort': {
-                    'avg_rating': -1
-                }
-            }, {
-                '$limit': number
-            }
-        ]
-
-        print(f"\nTop {number} directors by average rating:")
-        for i, director in enumerate(movies_coll.aggregate(pipeline), start=1):
-            print(f"{i}. {director['_id']}, rating: {director['avg_rating']}")
+    @instrumented('Director.top_rating')
+    def top_rating(number: int, after: Optional[DirectorRating] = None, batch_size: Optional[int] = None,
+                   snapshot=None, mask=None, partitions: Optional[list] = None) -> Iterator[DirectorRating]:
+        """
+        Returns the `number` directors with the best average rating.
+        after: last record of the previous page
+        snapshot, mask: CatalogSnapshot (and boolean mask of its movies) to compute it locally with NumPy
+        partitions: databases of the partitions of the catalog (database_connection.get_partitions()) to query
+        """
+        if snapshot is not None:
+            from analytics import vectorized
+            return iter(vectorized.top_rating(snapshot, number, mask, after))
+        result = _top_directors(number, 'avg_rating', (after.avg_rating, after.name) if after else None, batch_size,
+                                partitions)
+        return (DirectorRating(director['_id'], director['avg_rating']) for director in result)
 
     @staticmethod
-    def top_avg_lenght(number: int):
-
-        pipeline = [
-            {
-                '$group': {
-                    '_id': '$director',
-                    'avg_length': {
-                        '$avg': '$runtime'
-                    }
-                }
-            }, {
-                '$project': {
-                    'avg_length': {
-                        '$round': ['$avg_length', 2]
-                    }
-                }
-            }, {
-                '$sort': {
-                    'avg_length': -1
-                }
-            }, {
-                '$limit': number
-            }
-        ]
-
-        print(f"\nTop {number} directors by average lenght of the movies:")
-        for i, director in enumerate(movies_coll.aggregate(pipeline), start=1):
-            print(f"{i}. {director['_id']}, average length: {director['avg_length']} minutes")
+    @instrumented('Director.top_avg_lenght')
+    def top_avg_lenght(number: int, after: Optional[DirectorLength] = None, batch_size: Optional[int] = None,
+                       snapshot=None, mask=None, partitions: Optional[list] = None) -> Iterator[DirectorLength]:
+        """
+        Returns the `number` directors whose movies have the longest average runtime.
+        after: last record of the previous page
+        snapshot, mask: CatalogSnapshot (and boolean mask of its movies) to compute it locally with NumPy
+        partitions: databases of the partitions of the catalog (database_connection.get_partitions()) to query
+        """
+        if snapshot is not None:
+            from analytics import vectorized
+            return iter(vectorized.top_avg_length(snapshot, number, mask, after))
+        result = _top_directors(number, 'avg_runtime', (after.avg_length, after.name) if after else None, batch_size,
+                                partitions)
+        return (DirectorLength(director['_id'], director['avg_runtime']) for director in result)
 
     @staticmethod
-    def top_number_of_movies(number: int):
-
-        pipeline = [
-        {
-            '$group': {
-                '_id': '$director',
-                'films_count': {
-                    '$sum': 1
-                }
-            }
-        }, {
-            '$sort': {
-                'films_count': -1,
-                '_id': 1
-            }
-        }, {
-            '$limit': number
-        }
-    ]
-
-        print(f"\nTop {number} directors by number of movies:")
-        for i, director in enumerate(movies_coll.aggregate(pipeline), start=1):
-            print(f"{i}. {director['_id']}, {director['films_count']} films")
+    @instrumented('Director.top_number_of_movies')
+    def top_number_of_movies(number: int, after: Optional[DirectorMovieCount] = None,
+                             batch_size: Optional[int] = None, snapshot=None, mask=None,
+                             partitions: Optional[list] = None) -> Iterator[DirectorMovieCount]:
+        """
+        Returns the `number` directors with the most movies.
+        after: last record of the previous page
+        snapshot, mask: CatalogSnapshot (and boolean mask of its movies) to compute it locally with NumPy
+        partitions: databases of the partitions of the catalog (database_connection.get_partitions()) to query
+        """
+        if snapshot is not None:
+            from analytics import vectorized
+            return iter(vectorized.top_number_of_movies(snapshot, number, mask, after))
+        result = _top_directors(number, 'movie_count', (after.movie_count, after.name) if after else None, batch_size,
+                                partitions)
+        return (DirectorMovieCount(director['_id'], director['movie_count']) for director in result)
@@ -1,8 +1,52 @@
-from dataclasses import dataclass, field
-from multiprocessing.util import is_exiting
-from typing import Optional
+from dataclasses import dataclass, field, fields
+from typing import Iterable, Iterator, List, Optional, Tuple
 
-from database_connection import movies_coll
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from aggregation import scatter_gather
+from aggregation.actor_stats import top_actors
+from aggregation.catalog_writes import apply_write_requests, movie_write_requests
+from aggregation.movie_details import DETAIL_FIELDS, details_request, load_details, split_document, split_layout
+from aggregation.movie_search import search_movies
+from database_connection import movie_details_coll, movies_coll
+from importer.mapping import director_key, split_cast
+from instrumentation import instrumented
+from models.records import ActorMovies, MovieSearchResult
+from query_cache import cached_top_n, query_cache
+
+
+# validation errors, shared by the validators of a Movie and by Movie.from_rows
+TITLE_ERROR = "Title must be a non-empty string."
+DIRECTOR_ERROR = "Director must be a non-empty string."
+YEAR_ERROR = "Year must be a valid integer representing the release year."
+RUNTIME_ERROR = "Runtime must be a positive integer representing the number of minutes."
+RATING_ERROR = "Rating must be a float between 0.0 and 10.0."
+
+# optional fields of the documents, after title, year, director, director_key, cast and cast_list
+OPTIONAL_FIELDS = ('summary', 'short_summary', 'imdb_id', 'runtime', 'youtube_trailer', 'rating', 'movie_poster',
+                   'writers')
+
+
+@cached_top_n('actors.top')
+def _cached_top_actors(number: int) -> list:
+    # top actors, cached until the next write to the catalog
+    return list(top_actors(number))
+
+
+@dataclass
+class MovieBatch:
+    """Result of Movie.from_rows: the documents of the valid rows and the errors of the others."""
+
+    documents: List[dict] = field(default_factory=list)
+    positions: List[int] = field(default_factory=list)  # position in the rows of each document
+    errors: List[Tuple[int, str]] = field(default_factory=list)  # (position in the rows, message)
+
+
+def _detail_field():
+    # long text field (aggregation.movie_details): None by default, but without a class attribute (default_factory),
+    # so reading it on a movie loaded without its details goes through Movie.__getattr__
+    return field(default_factory=lambda: None)
 
 
 @dataclass
@@ -13,14 +57,28 @@ class Movie:
     year: int
     director: str
     cast: Optional[str] = field(default=None)
-    summary: Optional[str] = field(default=None)
-    short_summary: Optional[str] = field(default=None)
+    summary: Optional[str] = _detail_field()
+    short_summary: Optional[str] = _detail_field()
     imdb_id: Optional[str] = field(default=None)
     runtime: Optional[int] = field(default=None)
-    youtube_trailer: Optional[str] = field(default=None)
+    youtube_trailer: Optional[str] = _detail_field()
     rating: Optional[float] = field(default=None)
-    movie_poster: Optional[str] = field(default=None)
-    writers: Optional[str] = field(default=None)
+    movie_poster: Optional[str] = _detail_field()
+    writers: Optional[str] = _detail_field()
+
+    def __getattr__(self, name):
+        # only called for the attributes which aren't set: the long text fields of a movie loaded
+        # with the split layout (see from_document), read from movie_details at the first access
+        if name not in DETAIL_FIELDS:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        self._load_details()
+        return self.__dict__[name]
+
+    def _load_details(self):
+        movie_id = self.__dict__.pop('_details_id', None)
+        details = load_details(movie_id) if movie_id is not None else {}
+        for name in DETAIL_FIELDS:
+            self.__dict__.setdefault(name, details.get(name))  # a value set since is kept
 
     def __post_init__(self):
         """
@@ -40,7 +98,7 @@ class Movie:
         Validates and formats the movie title.
         """
         if not title or not isinstance(title, str):
-            raise ValueError("Title must be a non-empty string.")
+            raise ValueError(TITLE_ERROR)
         return title.strip().title()
 
     def _validate_director(self, director: str) -> str:
@@ -48,7 +106,7 @@ class Movie:
         Validates and formats the director's name.
         """
         if not director or not isinstance(director, str):
-            raise ValueError("Director must be a non-empty string.")
+            raise ValueError(DIRECTOR_ERROR)
         return director.strip().title()
 
     def _validate_year(self, year: int) -> int:
@@ -56,7 +114,7 @@ class Movie:
         Validates the year the movie was released.
         """
         if not isinstance(year, int) or year < 1900:  # The first movie was made in 1888.
-            raise ValueError("Year must be a valid integer representing the release year.")
+            raise ValueError(YEAR_ERROR)
         return year
 
 
@@ -65,7 +123,7 @@ class Movie:
         Validates the runtime of the movie. Can't be shorter than 0 minutes.
         """
         if not isinstance(runtime, int) or runtime <= 0:
-            raise ValueError("Runtime must be a positive integer representing the number of minutes.")
+            raise ValueError(RUNTIME_ERROR)
         return runtime
 
     def _validate_rating(self, rating: float) -> float:
@@ -73,25 +131,124 @@ class Movie:
         Validates the movie rating. Must be between 0 and 10.
         """
         if not isinstance(rating, (float, int)) or not (0.0 <= rating <= 10.0):
-            raise ValueError("Rating must be a float between 0.0 and 10.0.")
+            raise ValueError(RATING_ERROR)
         return rating
 
     def to_dict(self) -> dict:
         """Converts the Movie instance to a dictionary, excluding None values."""
-        return {key: value for key, value in {
+        movie_dict = {
             "title": self.title,
             "year": self.year,
             "director": self.director,
-            "cast": self.cast,
-            "summary": self.summary,
-            "short_summary": self.short_summary,
-            "imdb_id": self.imdb_id,
-            "runtime": self.runtime,
-            "youtube_trailer": self.youtube_trailer,
-            "rating": self.rating,
-            "movie_poster": self.movie_poster,
-            "writers": self.writers
-        }.items() if value is not None}
+            "director_key": director_key(self.director)
+        }
+        if self.cast is not None:
+            movie_dict["cast"] = self.cast
+            movie_dict["cast_list"] = split_cast(self.cast)
+        for name in OPTIONAL_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                movie_dict[name] = value
+        return movie_dict
+
+    def to_documents(self) -> Tuple[dict, dict]:
+        """
+        Returns the document of the movie in *movies* and its long text fields stored in *movie_details*
+        (empty with the single collection layout, where to_dict is the whole document).
+        """
+        movie_dict = self.to_dict()
+        return split_document(movie_dict) if split_layout() else (movie_dict, {})
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'Movie':
+        """
+        Creates a Movie from a stored document, without validating it again (the stored values were validated
+        when they were written, and the older documents may not follow the current rules, e.g. year 0).
+        With the split layout, the long text fields are loaded from movie_details when they're read.
+        """
+        movie = object.__new__(cls)
+        lazy = split_layout() and '_id' in document and not any(name in document for name in DETAIL_FIELDS)
+        for movie_field in fields(cls):
+            if not (lazy and movie_field.name in DETAIL_FIELDS):
+                movie.__dict__[movie_field.name] = document.get(movie_field.name)
+        if lazy:
+            movie.__dict__['_details_id'] = document['_id']
+        return movie
+
+    @classmethod
+    def find(cls, title: str, year: Optional[int] = None) -> Optional['Movie']:
+        """
+        Returns the stored movie with this title (and year), or None. Only the movies document is read.
+        """
+        query = {'title': title.strip().title()}
+        if year is not None:
+            query['year'] = year
+        document = movies_coll.find_one(query)
+        return cls.from_document(document) if document else None
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[dict]) -> MovieBatch:
+        """
+        Validates many rows (dictionaries with the fields of Movie) at once, with the rules of Movie,
+        and returns the documents of the valid rows (as to_dict) and the first error of each invalid row.
+        No Movie object is created and no error is raised.
+        """
+        rows = rows if isinstance(rows, list) else list(rows)
+        allowed = {movie_field.name for movie_field in fields(cls)}
+        invalid = {}  # position -> first error, in the order of the checks of __post_init__
+
+        def check(failed_positions, message):
+            for position in failed_positions:
+                invalid.setdefault(position, message)
+
+        # each field is checked over all the rows at once
+        for position, row in enumerate(rows):
+            if not allowed.issuperset(row):
+                invalid[position] = f"Unexpected fields: {', '.join(sorted(row.keys() - allowed))}"
+
+        titles = [row.get('title') for row in rows]
+        check([position for position, title in enumerate(titles) if not title or not isinstance(title, str)],
+              TITLE_ERROR)
+
+        directors = [row.get('director') for row in rows]
+        check([position for position, director in enumerate(directors)
+               if not director or not isinstance(director, str)], DIRECTOR_ERROR)
+
+        years = [row.get('year') for row in rows]
+        check([position for position, year in enumerate(years) if not isinstance(year, int) or year < 1900],
+              YEAR_ERROR)
+
+        runtimes = [row.get('runtime') for row in rows]
+        check([position for position, runtime in enumerate(runtimes)
+               if runtime and (not isinstance(runtime, int) or runtime <= 0)], RUNTIME_ERROR)
+
+        ratings = [row.get('rating') for row in rows]
+        check([position for position, rating in enumerate(ratings)
+               if rating and (not isinstance(rating, (float, int)) or not (0.0 <= rating <= 10.0))], RATING_ERROR)
+
+        batch = MovieBatch(errors=sorted(invalid.items()))
+        batch.positions = [position for position in range(len(rows)) if position not in invalid]
+
+        # the same directors come back in a catalog: their name and key are formatted once
+        formatted_directors = {}
+        for position in batch.positions:
+            director = directors[position]
+            if director not in formatted_directors:
+                name = director.strip().title()
+                formatted_directors[director] = (name, director_key(name))
+
+        # the document starts as a copy of the row (the fields were checked above), only the formatted fields change
+        for position in batch.positions:
+            document = dict(rows[position])
+            document["title"] = titles[position].strip().title()
+            document["director"], document["director_key"] = formatted_directors[directors[position]]
+            cast = document.get("cast")
+            if cast is not None:
+                document["cast_list"] = split_cast(cast)
+            if None in document.values():
+                document = {key: value for key, value in document.items() if value is not None}
+            batch.documents.append(document)
+        return batch
 
     def update_summary(self, new_summary: str):
         """
@@ -191,12 +348,22 @@ class Movie:
 
         movie_exists = bool(movies_coll.find_one({'title': movie.title}))
 
-        # Save to database (or update if it exists)
-        movies_coll.update_one(
+        # Save to database (or update if it exists), the long text fields in movie_details with the split layout
+        movie_dict, details = movie.to_documents()
+        movie_id = ObjectId()
+        previous = movies_coll.find_one_and_update(
             {'title': movie.title, 'director': movie.director, 'year': movie.year},
-            {'$set': movie.to_dict()},
-            upsert=True
+            {'$set': movie_dict, '$setOnInsert': {'_id': movie_id}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
         )
+        if details:
+            movie_details_coll.bulk_write([details_request(previous['_id'] if previous else movie_id, details)])
+
+        # the previous version of the movie is replaced in the derived collections (stats, rollups, change log)
+        added, removed = [{**(previous or {}), **movie.to_dict()}], [previous] if previous else []
+        apply_write_requests(movie_write_requests(added, removed))
+        query_cache.invalidate()
 
         if movie_exists:
             print(f"Movie '{movie.title}' by {movie.director} has been updated in the database.")
@@ -204,59 +371,46 @@ class Movie:
             print(f"Movie '{movie.title}' by {movie.director} has been added in the database.")
 
     @staticmethod
-    def top_number_of_films(number: int):
-
-        pipeline = [
-        {
-            # Removing empty cells
-            '$match': {
-                'cast': {'$ne': ''}  #
-            }
-        },
-        {
-            # Split cast into single actors
-            '$project': {
-                'title': 1,
-                'cast': {
-                    '$split': ['$cast', '|']  # Split by | as it's a separator
-                }
-            }
-        },
-        {
-            # Splitting documents per actors
-            '$unwind': '$cast'
-        },
-        {
-            # Trim white spaces
-            '$project': {
-                'title': 1,
-                'cast': {
-                    '$trim': {'input': '$cast'}
-                }
-            }
-        },
-        {
-            '$group': {
-                '_id': '$cast',
-                'movies': {'$addToSet': '$title'},
-                'movie_count': {'$sum': 1}
-            }
-        },
-        {
-            '$sort': {'movie_count': -1}
-        },
-        {
-            '$limit': number
-        }
-    ]
-
-        # Execute the aggregation
-        result = movies_coll.aggregate(pipeline)
-
-        # Print the result
-        print(f"\nTop {number} of actors by number of appearances/films:")
-        for actor in result:
-            print(f"Actor: {actor['_id']}, Movies: {actor['movies']}, Total Movies: {actor['movie_count']}")
-
-
+    @instrumented('Movie.top_number_of_films')
+    def top_number_of_films(number: int, after: Optional[ActorMovies] = None,
+                            batch_size: Optional[int] = None, snapshot=None, mask=None,
+                            partitions: Optional[list] = None) -> Iterator[ActorMovies]:
+        """
+        Returns the `number` actors with the most movies.
+        after: last record of the previous page
+        snapshot, mask: CatalogSnapshot (and boolean mask of its movies) to compute it locally with NumPy
+        partitions: databases of the partitions of the catalog (database_connection.get_partitions()) to query
+        """
+        if snapshot is not None:
+            from analytics import vectorized
+            return iter(vectorized.top_actors(snapshot, number, mask, after))
+        last = (after.movie_count, after.name) if after else None
+        if partitions is not None:
+            result = scatter_gather.top_actors(number, partitions, last)
+            return (ActorMovies(actor['_id'], actor['movies'], actor['movie_count']) for actor in result)
+        # counts maintained in actor_stats, one indexed read instead of grouping the cast of every movie
+        if after is None and batch_size is None:
+            result = iter(_cached_top_actors(number))
+        else:
+            result = top_actors(number, last, batch_size)
+        return (ActorMovies(actor['_id'], actor['movies'], actor['movie_count']) for actor in result)
 
+    @staticmethod
+    @instrumented('Movie.search')
+    def search(text: str, limit: int = 20, year_from: Optional[int] = None, year_to: Optional[int] = None,
+               min_rating: Optional[float] = None, max_rating: Optional[float] = None,
+               min_runtime: Optional[int] = None, max_runtime: Optional[int] = None) -> Iterator[MovieSearchResult]:
+        """
+        Returns the `limit` movies most relevant to the words of `text` (title, cast, writers and summaries),
+        optionally filtered on the year, rating and runtime ranges.
+        """
+        if not text or not isinstance(text, str) or not text.strip():
+            raise ValueError("The search text must be a non-empty string.")
+        if not isinstance(limit, int) or limit <= 0:
+            raise ValueError("The limit must be a positive integer.")
+
+        result = search_movies(text.strip(), limit, year_from=year_from, year_to=year_to,
+                               min_rating=min_rating, max_rating=max_rating,
+                               min_runtime=min_runtime, max_runtime=max_runtime)
+        return (MovieSearchResult(movie['title'], movie['year'], movie['director'], movie.get('rating'),
+                                  movie.get('runtime'), movie['score']) for movie in result)
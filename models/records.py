@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+'''
+Typed results of the queries of Director and Movie.
+'''
+
+
+@dataclass(frozen=True)
+class DirectorRating:
+    """Average rating of a director."""
+
+    name: str
+    avg_rating: Optional[float]
+
+
+@dataclass(frozen=True)
+class DirectorLength:
+    """Average runtime of the movies of a director, in minutes (not rounded, see round_length)."""
+
+    name: str
+    avg_length: Optional[float]
+
+
+@dataclass(frozen=True)
+class DirectorMovieCount:
+    """Number of movies of a director."""
+
+    name: str
+    movie_count: int
+
+
+@dataclass(frozen=True)
+class ActorMovies:
+    """Movies of an actor."""
+
+    name: str
+    movies: List[str]
+    movie_count: int
+
+
+@dataclass(frozen=True)
+class MovieSearchResult:
+    """Movie found by a full-text search, with its relevance."""
+
+    title: str
+    year: int
+    director: str
+    rating: Optional[float]
+    runtime: Optional[int]
+    score: float
+
+
+@dataclass(frozen=True)
+class YearStats:
+    """Stats of the movies of one year, with the number of movies per rating bucket ('0' to '9')."""
+
+    year: int
+    movie_count: int
+    avg_rating: Optional[float]
+    avg_length: Optional[float]
+    rating_histogram: Dict[str, int]
+
+
+@dataclass(frozen=True)
+class PeriodStats:
+    """Stats of the movies of a range of years (both ends included, open if None)."""
+
+    year_from: Optional[int]
+    year_to: Optional[int]
+    movie_count: int
+    avg_rating: Optional[float]
+    avg_length: Optional[float]
+    rating_histogram: Dict[str, int]
+
+
+@dataclass(frozen=True)
+class DashboardReport:
+    """Statistics of the dashboard computed in one pass (None for the statistics which weren't asked)."""
+
+    top_rating: Optional[List[DirectorRating]] = None
+    top_avg_length: Optional[List[DirectorLength]] = None
+    top_number_of_movies: Optional[List[DirectorMovieCount]] = None
+    top_number_of_films: Optional[List[ActorMovies]] = None
+
+
+def round_length(avg_runtime: Optional[float]) -> Optional[float]:
+    """
+    Rounds an average runtime to 2 decimals, as printed in the reports.
+    """
+    return round(avg_runtime, 2) if avg_runtime is not None else None
@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+'''
+In-process cache of the query results.
+
+The results of the top-N queries change only when the catalog changes, so they are kept:
+    - at most `max_size` results (the least recently used one is evicted first)
+    - for at most `ttl` seconds, as writes made by other processes can't invalidate this cache
+    - until a write goes through Director.save_to_db, Movie.add_movie_by_user or the importer,
+      which call query_cache.invalidate()
+'''
+
+
+class QueryCache:
+    """LRU cache with a time to live, keyed by (query name, parameters)."""
+
+    def __init__(self, max_size: int = 256, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0  # incremented by every invalidation
+
+    def get(self, key, usable=None):
+        """
+        Returns (True, value) if the key is cached and not expired, (False, None) otherwise.
+        usable: optional function telling if the cached value can answer the query
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None or (usable and not usable(entry[1])):
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, generation=None):
+        """
+        Caches the value, evicting the least recently used entries above max_size.
+        generation: value of self.generation when the query started; the result of a query
+        which ran during an invalidation isn't cached.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """
+        Removes all the cached results (called after every write to the catalog).
+        """
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+            self.generation += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache.
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+# cache shared by the models
+query_cache = QueryCache()
+
+
+def cached_top_n(query_name: str):
+    """
+    Caches a function f(number, *args, **kwargs) returning the list of the `number` first results.
+
+    The key doesn't contain `number`: a cached top 10 also answers a top 5,
+    and a bigger top replaces the smaller one.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(number: int, *args, **kwargs):
+            key = (query_name, args, tuple(sorted(kwargs.items())))
+
+            # cached = (number asked, results); fewer results than asked means that all of them are known
+            found, cached = query_cache.get(key, usable=lambda value: number <= value[0] or len(value[1]) < value[0])
+            if found:
+                return cached[1][:number]
+
+            generation = query_cache.generation
+            results = function(number, *args, **kwargs)
+            query_cache.set(key, (number, results), generation)
+            return results
+        return wrapper
+    return decorator
@@ -0,0 +1,18 @@
+import mongomock
+import pytest
+
+import database_connection
+from aggregation import movie_details
+from query_cache import query_cache
+
+
+@pytest.fixture
+def database():
+    """
+    Empty in-memory database (mongomock) behind the collections of database_connection.
+    """
+    database_connection.set_client(mongomock.MongoClient())
+    movie_details._split = None
+    query_cache.invalidate()
+    yield database_connection.get_database()
+    database_connection.configure()
@@ -0,0 +1,30 @@
+from database_connection import directors_coll, movies_coll
+from importer.bulk_writer import BatchWriter
+
+
+def movie_row(title: str, director: str, content_hash: str) -> dict:
+    return {'title': title, 'imdb_id': f'tt-{title}', 'director': director, 'year': 2000, 'rating': 7.0,
+            'runtime': 100, 'content_hash': content_hash}
+
+
+def test_incremental_import_moves_a_movie_to_its_new_director(database):
+    BatchWriter(movies_coll, directors_coll, upsert_changed=True).write(
+        [movie_row('Dune', 'David Lynch', 'a'), movie_row('Eraserhead', 'David Lynch', 'a')])
+
+    # the next import of the file has another director for Dune
+    report = BatchWriter(movies_coll, directors_coll, upsert_changed=True).write(
+        [movie_row('Dune', 'Denis Villeneuve', 'b'), movie_row('Eraserhead', 'David Lynch', 'a')])
+
+    assert (report.updated, report.unchanged) == (1, 1)
+    assert directors_coll.find_one({'name': 'David Lynch'})['movies'] == ['Eraserhead']
+    assert directors_coll.find_one({'name': 'Denis Villeneuve'})['movies'] == ['Dune']
+
+
+
+def test_repeated_row_of_the_same_run_is_a_duplicate(database):
+    writer = BatchWriter(movies_coll, directors_coll, upsert_changed=True)
+    writer.write([movie_row('Dune', 'David Lynch', 'a')])
+    report = writer.write([movie_row('Dune', 'David Lynch', 'b')])
+
+    assert report.duplicates == 1
+    assert movies_coll.find_one({'title': 'Dune'})['content_hash'] == 'a'
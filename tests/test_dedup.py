@@ -0,0 +1,40 @@
+from database_connection import movies_coll
+from importer.dedup import BloomFilter, DuplicateFilter
+
+
+def test_bloom_filter_has_no_false_negatives_and_about_the_chosen_rate():
+    bloom = BloomFilter(10000, false_positive_rate=0.01)
+    for number in range(10000):
+        bloom.add(f'in-{number}')
+
+    assert all(f'in-{number}' in bloom for number in range(10000))
+    false_positives = sum(f'out-{number}' in bloom for number in range(10000))
+    assert false_positives < 10000 * 0.02
+    assert len(bloom) <= 10000
+
+
+def test_split_removes_the_duplicates_of_the_batch_and_of_the_database(database):
+    movies_coll.insert_one({'title': 'Dune', 'imdb_id': 'tt1'})
+    duplicates = DuplicateFilter(movies_coll, expected_rows=100)
+    assert duplicates.seed() == 1
+
+    rows = [{'title': 'Eraserhead', 'imdb_id': 'tt2'}, {'title': 'Dune', 'imdb_id': 'tt1'},
+            {'title': 'Blue Velvet', 'imdb_id': 'tt3'}, {'title': 'Eraserhead', 'imdb_id': 'tt2'},
+            {'title': 'Dune', 'imdb_id': 'tt9'}]
+    new_rows, removed = duplicates.split(rows)
+
+    assert [row['imdb_id'] for row in new_rows] == ['tt2', 'tt3', 'tt9']
+    assert removed == 2
+
+
+def test_split_of_an_incremental_run_only_removes_the_movies_of_the_run(database):
+    movies_coll.insert_many([{'title': 'Dune', 'imdb_id': 'tt1', 'import_run': 'previous'},
+                             {'title': 'Eraserhead', 'imdb_id': 'tt2', 'import_run': 'current'}])
+    duplicates = DuplicateFilter(movies_coll, expected_rows=100, run_id='current')
+    duplicates.seed()
+
+    rows = [{'title': 'Dune', 'imdb_id': 'tt1'}, {'title': 'Eraserhead', 'imdb_id': 'tt2'}]
+    new_rows, removed = duplicates.split(rows)
+
+    assert new_rows == [{'title': 'Dune', 'imdb_id': 'tt1'}]
+    assert removed == 1
@@ -0,0 +1,38 @@
+import pytest
+from bson import ObjectId
+
+from aggregation.director_reconciliation import lost_title_requests
+from aggregation.live_refresh import batch_directors, event_directors
+from database_connection import directors_coll
+
+
+def delete_event(movie: dict) -> dict:
+    return {'operationType': 'delete', 'documentKey': {'_id': movie['_id']}, 'fullDocumentBeforeChange': movie}
+
+
+def test_deleted_last_movie_is_pulled_from_its_director(database):
+    movie = {'_id': ObjectId(), 'title': 'Eraserhead', 'director': 'David Lynch'}
+    # Twin Peaks was saved with Director.save_to_db, it isn't in the movies collection
+    directors_coll.insert_one({'name': 'David Lynch', 'movies': ['Eraserhead', 'Twin Peaks']})
+
+    changed = batch_directors([delete_event(movie)])
+    assert changed == {'David Lynch': {'Eraserhead'}}
+    directors_coll.bulk_write(lost_title_requests(changed))
+
+    assert directors_coll.find_one({'name': 'David Lynch'})['movies'] == ['Twin Peaks']
+
+
+def test_moved_movie_is_lost_by_its_previous_director_only():
+    before = {'_id': ObjectId(), 'title': 'Dune', 'director': 'David Lynch'}
+    event = {'operationType': 'update', 'documentKey': {'_id': before['_id']},
+             'fullDocumentBeforeChange': before, 'fullDocument': {**before, 'director': 'Denis Villeneuve'}}
+    assert event_directors(event) == {'David Lynch': {'Dune'}, 'Denis Villeneuve': set()}
+
+    rated = {**event, 'fullDocument': {**before, 'rating': 6.3}}
+    assert event_directors(rated) == {'David Lynch': set()}
+
+
+def test_event_without_pre_image_is_refused():
+    event = {'operationType': 'delete', 'documentKey': {'_id': ObjectId()}}
+    with pytest.raises(ValueError):
+        event_directors(event)
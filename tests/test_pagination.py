@@ -0,0 +1,23 @@
+from aggregation.pagination import keyset_filter
+from database_connection import director_stats_coll
+
+
+def test_pages_of_keyset_filter_cover_the_sort_once(database):
+    director_stats_coll.insert_many([
+        {'_id': 'Agnès Varda', 'avg_rating': 8.0}, {'_id': 'Chantal Akerman', 'avg_rating': 8.0},
+        {'_id': 'David Lynch', 'avg_rating': 7.5}, {'_id': 'Jane Campion', 'avg_rating': None},
+        {'_id': 'Claire Denis'}, {'_id': 'Abel Ferrara', 'avg_rating': 6.0},
+    ])
+    sort = [('avg_rating', -1), ('_id', 1)]
+
+    pages, query = [], {}
+    while True:
+        page = list(director_stats_coll.find(query).sort(sort).limit(2))
+        if not page:
+            break
+        pages.append([director['_id'] for director in page])
+        last = page[-1]
+        query = keyset_filter('avg_rating', last.get('avg_rating'), last['_id'])
+
+    assert pages == [['Agnès Varda', 'Chantal Akerman'], ['David Lynch', 'Abel Ferrara'],
+                     ['Claire Denis', 'Jane Campion']]
@@ -0,0 +1,45 @@
+import csv
+
+from importer.mapping import map_csv_movie
+from importer.parallel_csv import parse_csv
+
+HEADER = ['Title', 'Year', 'Director', 'Cast', 'Summary', 'Short Summary', 'IMDB ID', 'Runtime', 'YouTube Trailer',
+          'Rating', 'Movie Poster', 'Writers']
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+def csv_row(title, year='1999', director='david lynch', runtime='120', rating='7.5'):
+    return [title, year, director, 'laura dern| kyle maclachlan', 'a summary', 'short', 'tt1', runtime, 'trailer',
+            rating, 'poster', 'writer']
+
+
+def test_chunk_rows_are_validated_with_the_rules_of_movie(tmp_path):
+    path = tmp_path / 'movies.csv'
+    write_csv(path, [csv_row(' lost highway '), csv_row('old', year='1850'), csv_row('no runtime', runtime=''),
+                     csv_row('no director', director=''), csv_row('mulholland drive', rating='8')])
+
+    chunks = list(parse_csv(str(path), workers=1))
+    rows = [row for chunk in chunks for row in chunk.rows]
+    errors = [error for chunk in chunks for error in chunk.errors]
+
+    assert [row['title'] for row in rows] == ['Lost Highway', 'Mulholland Drive']
+    assert rows[0]['director'] == 'David Lynch' and rows[0]['director_key'] == 'david lynch'
+    assert rows[0]['cast_list'] == ['Laura Dern', 'Kyle Maclachlan']
+    assert all(row['content_hash'] for row in rows)
+    assert len(errors) == 3
+
+
+def test_map_csv_movie_returns_the_document_of_the_chunk_path(tmp_path):
+    path = tmp_path / 'movies.csv'
+    write_csv(path, [csv_row('eraserhead')])
+    with open(path, newline='') as csvfile:
+        row = next(csv.DictReader(csvfile))
+
+    document = next(parse_csv(str(path), workers=1)).rows[0]
+    assert dict(map_csv_movie(row), content_hash=document['content_hash']) == document
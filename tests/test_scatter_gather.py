@@ -0,0 +1,64 @@
+import random
+
+import mongomock
+import pytest
+
+from aggregation import scatter_gather
+from database_connection import movies_coll
+
+
+def partitioned_catalog(partition_count: int = 3, movie_count: int = 600):
+    # movies spread over in-memory partitions, with a skewed number of movies per actor
+    random.seed(7)
+    partitions = [mongomock.MongoClient()['cinema'] for _ in range(partition_count)]
+    actors = [f'Actor {number}' for number in range(50)]
+    weights = [1 / (number + 1) for number in range(50)]
+    movies = []
+    for number in range(movie_count):
+        movie = {'title': f'Movie {number}', 'year': 1950 + number % 70, 'director': f'Director {number % 23}',
+                 'cast_list': list(dict.fromkeys(random.choices(actors, weights=weights, k=4)))}
+        if number % 5:
+            movie['rating'] = float(number % 10)
+        if number % 7:
+            movie['runtime'] = 80 + number % 60
+        movies.append(movie)
+        partitions[random.randrange(partition_count)][movies_coll.name].insert_one(dict(movie))
+    return partitions, movies
+
+
+def brute_force_actors(movies: list) -> list:
+    titles = {}
+    for movie in movies:
+        for actor in movie['cast_list']:
+            titles.setdefault(actor, set()).add(movie['title'])
+    return sorted(((actor, len(actor_titles)) for actor, actor_titles in titles.items()),
+                  key=lambda actor: (-actor[1], actor[0]))
+
+
+def test_top_actors_over_the_partitions_is_the_exact_top():
+    partitions, movies = partitioned_catalog()
+    expected = brute_force_actors(movies)
+
+    for number in (1, 5, 20):
+        top = scatter_gather.top_actors(number, partitions)
+        assert [(actor['_id'], actor['movie_count']) for actor in top] == expected[:number]
+        assert all(len(actor['movies']) == actor['movie_count'] for actor in top)
+
+    first_page = scatter_gather.top_actors(5, partitions)
+    after = (first_page[-1]['movie_count'], first_page[-1]['_id'])
+    next_page = scatter_gather.top_actors(5, partitions, after=after)
+    assert [(actor['_id'], actor['movie_count']) for actor in next_page] == expected[5:10]
+
+
+def test_top_directors_merges_the_sums_of_the_partitions():
+    partitions, movies = partitioned_catalog()
+    ratings = {}
+    for movie in movies:
+        if 'rating' in movie:
+            ratings.setdefault(movie['director'], []).append(movie['rating'])
+    expected = sorted(((director, sum(values) / len(values)) for director, values in ratings.items()),
+                      key=lambda director: (-director[1], director[0]))
+
+    top = scatter_gather.top_directors(5, 'avg_rating', partitions)
+    assert [director['_id'] for director in top] == [director for director, _ in expected[:5]]
+    assert [director['avg_rating'] for director in top] == pytest.approx([rating for _, rating in expected[:5]])
@@ -0,0 +1,41 @@
+from aggregation.catalog_writes import apply_write_requests, movie_write_requests
+from aggregation.director_stats import movie_delta
+from database_connection import actor_stats_coll, director_stats_coll, year_director_rollups_coll, year_rollups_coll
+
+
+def movie(title: str, director: str, year: int, rating=None, runtime=None, cast_list=()) -> dict:
+    return {'title': title, 'director': director, 'year': year, 'rating': rating, 'runtime': runtime,
+            'cast_list': list(cast_list)}
+
+
+def test_movie_delta_only_counts_the_numbers():
+    assert movie_delta(movie('Dune', 'David Lynch', 1984, rating=6.5, runtime=137)) == {
+        'movie_count': 1, 'rating_sum': 6.5, 'rating_count': 1, 'runtime_sum': 137, 'runtime_count': 1}
+    assert movie_delta(movie('Dune', 'David Lynch', 1984, rating=True), sign=-1) == {
+        'movie_count': -1, 'rating_sum': 0, 'rating_count': 0, 'runtime_sum': 0, 'runtime_count': 0}
+
+
+def test_added_updated_and_moved_movies_keep_the_stats_exact(database):
+    dune = movie('Dune', 'David Lynch', 1984, rating=6.0, runtime=137, cast_list=['Kyle MacLachlan'])
+    eraserhead = movie('Eraserhead', 'David Lynch', 1977, rating=7.0, cast_list=['Jack Nance'])
+    apply_write_requests(movie_write_requests([dune, eraserhead]))
+
+    lynch = director_stats_coll.find_one({'_id': 'David Lynch'})
+    assert (lynch['movie_count'], lynch['avg_rating'], lynch['avg_runtime']) == (2, 6.5, 137)
+
+    # an update subtracts the previous version of the movie, even when it moves to another director
+    new_dune = movie('Dune', 'Denis Villeneuve', 2021, rating=8.0, runtime=155, cast_list=['Timothée Chalamet'])
+    apply_write_requests(movie_write_requests([new_dune], removed=[dune]))
+
+    lynch = director_stats_coll.find_one({'_id': 'David Lynch'})
+    assert (lynch['movie_count'], lynch['avg_rating'], lynch['avg_runtime']) == (1, 7.0, None)
+    villeneuve = director_stats_coll.find_one({'_id': 'Denis Villeneuve'})
+    assert (villeneuve['movie_count'], villeneuve['avg_rating']) == (1, 8.0)
+
+    assert year_rollups_coll.find_one({'_id': 1984})['movie_count'] == 0
+    assert year_rollups_coll.find_one({'_id': 2021})['rating_histogram'] == {'8': 1}
+    assert year_director_rollups_coll.find_one({'_id': {'year': 1977, 'director': 'David Lynch'}})['rating_sum'] == 7.0
+
+    assert actor_stats_coll.find_one({'_id': 'Kyle MacLachlan'}) == {'_id': 'Kyle MacLachlan', 'movie_count': 0,
+                                                                       'movies': []}
+    assert actor_stats_coll.find_one({'_id': 'Timothée Chalamet'})['movies'] == ['Dune']